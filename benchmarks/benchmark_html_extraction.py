@@ -0,0 +1,107 @@
+"""Compares strip_html with strip_html_streaming on saved skat.dk pages.
+
+    python benchmarks/benchmark_html_extraction.py --pages-dir data/skat_pages --fetch 200
+
+--fetch downloads pages listed in data/urls.jsonl (written by SkatUrlSpider) into --pages-dir first.
+Peak memory is measured as the growth of max RSS in a forked process, so memory allocated by libxml2 is included.
+"""
+from typing import Callable, List
+import argparse
+import glob
+import hashlib
+import itertools
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import urllib.request
+this_file_path = os.path.dirname(os.path.abspath(__file__))  # get directory of this file
+sys.path.append(this_file_path + '/..')
+sys.path.append(this_file_path + '/../data_collectors/webscrapers/skat')
+from data_processors import html_extraction
+from skat import url_checkpoint
+
+EXTRACTORS = {'strip_html': html_extraction.strip_html,
+              'strip_html_streaming': html_extraction.strip_html_streaming}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--pages-dir', default=os.path.join(this_file_path, '..', 'data', 'skat_pages'))
+    arg_parser.add_argument('--fetch', type=int, default=0, help='download this many pages from urls.jsonl first')
+    arg_parser.add_argument('--urls-file', default=os.path.join(this_file_path, '..', 'data_collectors', 'webscrapers', 'skat', 'data', 'urls.jsonl'))
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    if args.fetch:
+        fetch_pages(args.urls_file, args.pages_dir, args.fetch)
+
+    pages: List[str] = load_pages(args.pages_dir)
+    if not pages:
+        sys.exit(f'no *.html pages found in {args.pages_dir}')
+    total_mb: float = sum(len(page.encode('utf-8')) for page in pages) / 1e6
+    print(f'#{len(pages)} pages, {total_mb:.1f} MB, largest {max(len(page) for page in pages) / 1e6:.2f} MB')
+
+    differing: int = sum(html_extraction.strip_html(page) != html_extraction.strip_html_streaming(page) for page in pages)
+    print(f'pages with different output: {differing}')
+
+    for name, extract in EXTRACTORS.items():
+        seconds: float = min(time_extraction(extract, pages) for _ in range(args.repeat))
+        peak_rss_mb: float = peak_rss_growth_mb(extract, pages)
+        print(f'{name:>22}: {len(pages) / seconds:8.1f} docs/s {total_mb / seconds:7.2f} MB/s '
+              f'peak rss growth {peak_rss_mb:7.1f} MB')
+
+
+def time_extraction(extract: Callable[[str], str], pages: List[str]) -> float:
+    started_at: float = time.perf_counter()
+    for page in pages:
+        extract(page)
+
+    return time.perf_counter() - started_at
+
+
+def peak_rss_growth_mb(extract: Callable[[str], str], pages: List[str]) -> float:
+    context = multiprocessing.get_context('fork')
+    receiving_end, sending_end = context.Pipe(duplex=False)
+    process = context.Process(target=_measure_peak_rss, args=(extract, pages, sending_end))
+    process.start()
+    growth_kb: int = receiving_end.recv()
+    process.join()
+
+    return growth_kb / 1024
+
+
+def _measure_peak_rss(extract: Callable[[str], str], pages: List[str], connection):
+    baseline_kb: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for page in pages:
+        extract(page)
+    connection.send(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_kb)
+
+
+def load_pages(pages_dir: str) -> List[str]:
+    pages: List[str] = []
+    for page_path in sorted(glob.glob(os.path.join(pages_dir, '*.html'))):
+        with open(page_path, 'r') as fp:
+            pages.append(fp.read())
+
+    return pages
+
+
+def fetch_pages(urls_file: str, pages_dir: str, number_of_pages: int):
+    os.makedirs(pages_dir, exist_ok=True)
+    # a url may be listed more than once
+    urls: List[str] = list(dict.fromkeys(url_checkpoint.UrlCheckpointReader(urls_file).new_urls()))
+
+    for url in itertools.islice(urls, number_of_pages):
+        page_path: str = os.path.join(pages_dir, f'{hashlib.sha1(url.encode("utf-8")).hexdigest()}.html')
+        if os.path.exists(page_path):
+            continue
+        with urllib.request.urlopen(url) as response:
+            html: str = response.read().decode(response.headers.get_content_charset() or 'utf-8')
+        with open(page_path, 'w') as fp:
+            fp.write(html)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""Throughput of the onlaw api collectors and the section builder against local fakes of prisma and gcloud storage
+(see fake_onlaw_api.py), so runs are reproducible and need neither the network nor credentials.
+
+    python benchmarks/benchmark_onlaw_api_build.py --documents 20000 --prisma-latency-ms 30 --gcloud-latency-ms 20
+    python benchmarks/benchmark_onlaw_api_build.py --output results.json
+    python benchmarks/benchmark_onlaw_api_build.py --baseline results.json  # exits with 1 on a regression
+
+Scenarios:
+    metadata  streams the metadata of all documents from prisma (PrismaDocumentCollector.documents, metadata_only)
+    files     also downloads every content file (PrismaDocumentCollector + GcloudStorageFileCollector)
+    build     builds the section into a temporary folder (build_section_from_onlaw_api.get_verdict)
+    sections  builds the two halves of the corpus as two sections at the same time (build_sections.build_sections_with)
+
+Every scenario runs in a forked process and reports docs/s, p50/p99 latencies of its stages and the peak RSS of the
+process and of its worker processes (html stripping). The fakes run in another process.
+"""
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+this_file_path = os.path.dirname(os.path.abspath(__file__))  # get directory of this file
+sys.path.append(this_file_path + '/..')
+sys.path.append(this_file_path)
+from data_collectors import prisma_collector
+from data_collectors import file_collector_gcloud_storage
+from data_collectors import http_session
+from builders import build_section_from_onlaw_api
+from builders import build_sections
+from data_processors import near_duplicates
+from instrumentation import run_metrics
+import fake_onlaw_api
+
+SCENARIOS: List[str] = ['metadata', 'files', 'build', 'sections']
+
+
+class BenchmarkFileCollector(file_collector_gcloud_storage.GcloudStorageFileCollector):
+    """downloads from FakeGcloudStorage instead of gcloud storage"""
+
+    def __init__(self, api_root: str, **kwargs):
+        for env_var, value in (('GCLOUD_STORAGE_BUCKET_PRIVATE_NAME', fake_onlaw_api.BUCKET),
+                               ('GCLOUD_PROJECT_ID', 'benchmark'), ('GCLOUD_STORAGE_CREDENTIALS', '')):
+            os.environ.setdefault(env_var, value)
+        super().__init__(**kwargs)
+        self.bucket = fake_onlaw_api.BUCKET
+        self.api_root = api_root
+
+    def _instantiate_storage_object(self):
+        self.storage_object = fake_onlaw_api.EmulatedStorage(self.api_root, self.session)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    arg_parser.add_argument('--documents', type=int, default=5000)
+    arg_parser.add_argument('--html-kb', type=float, default=40.0, help='median size of html files')
+    arg_parser.add_argument('--pdf-kb', type=float, default=200.0, help='median size of pdf files')
+    arg_parser.add_argument('--pdf-fraction', type=float, default=0.0, help='needs pdftotext for the build scenario')
+    arg_parser.add_argument('--size-sigma', type=float, default=1.0, help='sigma of the lognormal file sizes')
+    arg_parser.add_argument('--prisma-latency-ms', type=float, default=30.0, help='median latency of a prisma query')
+    arg_parser.add_argument('--gcloud-latency-ms', type=float, default=20.0, help='median latency of a gcloud request')
+    arg_parser.add_argument('--latency-sigma', type=float, default=0.5, help='sigma of the lognormal latencies')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of gcloud requests answered with 503')
+    arg_parser.add_argument('--page-size', type=int, default=1000)
+    arg_parser.add_argument('--output', help='write the results to this json file')
+    arg_parser.add_argument('--baseline', help='results json of an earlier run to compare docs/s with')
+    arg_parser.add_argument('--max-regression', type=float, default=0.2,
+                            help='fail if docs/s of a scenario is more than this fraction below the baseline')
+    args = arg_parser.parse_args()
+
+    if {'build', 'sections'} & set(args.scenarios) and args.pdf_fraction and shutil.which('pdftotext') is None:
+        sys.exit('--pdf-fraction needs pdftotext (apt install poppler-utils) for the build scenario')
+
+    corpus_arguments: dict = {'documents': args.documents, 'html_kb': args.html_kb, 'pdf_kb': args.pdf_kb,
+                              'pdf_fraction': args.pdf_fraction, 'size_sigma': args.size_sigma}
+    server_process, prisma_port, gcloud_port = fake_onlaw_api.serve_in_process(
+        corpus_arguments,
+        prisma_latency={'latency_ms': args.prisma_latency_ms, 'sigma': args.latency_sigma},
+        gcloud_latency={'latency_ms': args.gcloud_latency_ms, 'sigma': args.latency_sigma, 'error_rate': args.error_rate})
+
+    endpoints: Dict[str, str] = {'prisma': f'http://127.0.0.1:{prisma_port}/',
+                                 'gcloud': f'http://127.0.0.1:{gcloud_port}/storage/v1/b'}
+    results: Dict[str, dict] = {}
+    try:
+        for scenario in args.scenarios:
+            results[scenario] = run_in_process(scenario, endpoints, args.page_size)
+            print_result(scenario, results[scenario])
+    finally:
+        server_process.terminate()
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'arguments': vars(args), 'results': results}, fp, indent=2)
+    if args.baseline and regressed(results, args.baseline, args.max_regression):
+        sys.exit(1)
+
+
+def run_in_process(scenario: str, endpoints: Dict[str, str], page_size: int) -> dict:
+    context = multiprocessing.get_context('fork')
+    receiving_end, sending_end = context.Pipe(duplex=False)
+    process = context.Process(target=_run_scenario, args=(scenario, endpoints, page_size, sending_end))
+    process.start()
+    result: dict = receiving_end.recv()
+    process.join()
+    if 'error' in result:
+        raise RuntimeError(f'scenario {scenario} failed: {result["error"]}')
+
+    return result
+
+
+def _run_scenario(scenario: str, endpoints: Dict[str, str], page_size: int, connection):
+    try:
+        metrics = run_metrics.RunMetrics(scenario)
+        started_at: float = time.perf_counter()
+        documents: int = asyncio.run(SCENARIO_FUNCTIONS[scenario](endpoints, page_size, metrics))
+        seconds: float = time.perf_counter() - started_at
+
+        connection.send({'documents': documents, 'seconds': round(seconds, 3),
+                         'documents_per_second': round(documents / seconds, 1),
+                         'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                         'peak_worker_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+                         'stages': {name: stage['latency_seconds'] for name, stage in metrics.snapshot()['stages'].items()}})
+    except Exception as e:
+        connection.send({'error': f'{type(e).__name__}: {e}'})
+        raise
+
+
+async def benchmark_metadata(endpoints: Dict[str, str], page_size: int, metrics: run_metrics.RunMetrics) -> int:
+    collector = prisma_collector.PrismaDocumentCollector(endpoints['prisma'], file_collector=None, token='benchmark',
+                                                         metrics=metrics)
+    async with collector:
+        return await _count(collector.documents(query=build_section_from_onlaw_api.VERDICT_QUERY, document_type='verdict',
+                                                metadata_only=True, stream=True, page_size=page_size))
+
+
+async def benchmark_files(endpoints: Dict[str, str], page_size: int, metrics: run_metrics.RunMetrics) -> int:
+    spool_path: str = tempfile.mkdtemp(prefix='odagw_benchmark_spool_')
+    file_collector = BenchmarkFileCollector(endpoints['gcloud'], spool_path=spool_path, metrics=metrics)
+    collector = prisma_collector.PrismaDocumentCollector(endpoints['prisma'], file_collector, token='benchmark',
+                                                         metrics=metrics)
+    try:
+        async with file_collector, collector:
+            await file_collector.load_object_metadata()
+            documents: int = 0
+            async for document in collector.documents(query=build_section_from_onlaw_api.VERDICT_QUERY,
+                                                      document_type='verdict', stream=True, page_size=page_size):
+                if isinstance(document['content'], file_collector_gcloud_storage.SpooledFile):
+                    document['content'].remove()
+                documents += 1
+            return documents
+    finally:
+        shutil.rmtree(spool_path, ignore_errors=True)
+
+
+async def benchmark_build(endpoints: Dict[str, str], page_size: int, metrics: run_metrics.RunMetrics) -> int:
+    data_path: str = tempfile.mkdtemp(prefix='odagw_benchmark_data_')
+    spool_path: str = os.path.join(data_path, 'spool')
+    file_collector = BenchmarkFileCollector(endpoints['gcloud'], spool_path=spool_path, metrics=metrics)
+    collector = prisma_collector.PrismaDocumentCollector(endpoints['prisma'], file_collector, token='benchmark',
+                                                         metrics=metrics)
+    try:
+        # with a near-duplicate index like build(), so its cost is part of the numbers
+        with near_duplicates.NearDuplicateIndex(os.path.join(data_path, 'near_duplicates.sqlite')) as near_duplicate_index:
+            async with file_collector, collector:
+                await build_section_from_onlaw_api.get_verdict(collector, build_section_from_onlaw_api.VERDICT_QUERY, [],
+                                                               'benchmark', batch_size=page_size, metrics=metrics,
+                                                               data_path=data_path, near_duplicate_index=near_duplicate_index)
+        with open(os.path.join(data_path, 'data.jsonl'), 'r') as fp:
+            return sum(1 for _ in fp)
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+
+
+async def benchmark_sections(endpoints: Dict[str, str], page_size: int, metrics: run_metrics.RunMetrics) -> int:
+    data_path: str = tempfile.mkdtemp(prefix='odagw_benchmark_data_')
+    spool_path: str = os.path.join(data_path, 'spool')
+    try:
+        async with http_session.create_pooled_session() as session:
+            file_collector = BenchmarkFileCollector(endpoints['gcloud'], spool_path=spool_path, metrics=metrics,
+                                                    session=session)
+            async with file_collector:
+                count_collector = prisma_collector.PrismaDocumentCollector(endpoints['prisma'], file_collector,
+                                                                           token='benchmark', session=session)
+                last_id: str = f'ck{await count_collector.count_verdicts() // 2:010d}'
+                sections: List[build_sections.SectionSpec] = [
+                    build_sections.SectionSpec('first', query_filters=[f'id_lte: "{last_id}"']),
+                    build_sections.SectionSpec('second', query_filters=[f'id_gt: "{last_id}"'])]
+                collector = prisma_collector.PrismaDocumentCollector(
+                    endpoints['prisma'], file_collector, token='benchmark', metrics=metrics, session=session,
+                    concurrent_files_collected=build_sections.concurrent_files_collected(sections))
+                async with collector:
+                    results: Dict[str, dict] = await build_sections.build_sections_with(collector, sections, metrics,
+                                                                                        data_path=data_path)
+        return sum(result['built'] for result in results.values())
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+
+
+SCENARIO_FUNCTIONS = {'metadata': benchmark_metadata, 'files': benchmark_files, 'build': benchmark_build,
+                      'sections': benchmark_sections}
+
+
+async def _count(documents) -> int:
+    count: int = 0
+    async for _ in documents:
+        count += 1
+
+    return count
+
+
+def print_result(scenario: str, result: dict):
+    print(f'{scenario:>9}: {result["documents"]} docs in {result["seconds"]}s, {result["documents_per_second"]} docs/s, '
+          f'peak rss {result["peak_rss_mb"]} MB (workers {result["peak_worker_rss_mb"]} MB)')
+    for stage, latency in result['stages'].items():
+        print(f'{"":>11}{stage:>18}: p50 {_milliseconds(latency["p50"])} p99 {_milliseconds(latency["p99"])} '
+              f'max {_milliseconds(latency["max"])}')
+
+
+def regressed(results: Dict[str, dict], baseline_path: str, max_regression: float) -> bool:
+    with open(baseline_path, 'r') as fp:
+        baseline: Dict[str, dict] = json.load(fp)['results']
+
+    any_regression: bool = False
+    for scenario, result in results.items():
+        if scenario not in baseline:
+            continue
+        change: float = result['documents_per_second'] / baseline[scenario]['documents_per_second'] - 1
+        regression: bool = change < -max_regression
+        any_regression = any_regression or regression
+        print(f'{scenario:>9}: {change:+.1%} docs/s compared to {baseline_path}{"  REGRESSION" if regression else ""}')
+
+    return any_regression
+
+
+def _milliseconds(seconds: Optional[float]) -> str:
+    return '-' if seconds is None else f'{seconds * 1000:.1f}ms'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""Local stand-ins for the services a section build talks to, for benchmarks that must not depend on the network.
+
+FakePrisma answers the graphql queries prisma_helpers and PrismaDocumentCollector send: `<type>sConnection { aggregate
+{ count } }`, offset pages (`first: skip:`) and id cursor pages (`orderBy: id_ASC, after:`), filtered by uid_in,
+updatedAt_gt, url_contains, id_gt and id_lte. Other filters are ignored.
+
+FakeGcloudStorage answers the JSON API requests of gcloud-aio-storage: object listing, object metadata and `alt=media`
+downloads of synthetic html and pdf objects. EmulatedStorage is the client side, the part of
+gcloud.aio.storage.Storage that GcloudStorageFileCollector uses, without authentication.
+
+Latencies are drawn from a lognormal distribution around latency_ms, object sizes from one around html_kb / pdf_kb.
+"""
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+import asyncio
+import base64
+import bisect
+import hashlib
+import multiprocessing
+import random
+import re
+import aiohttp
+from aiohttp import web
+
+BUCKET = 'benchmark'
+WORDS: List[str] = ['retten', 'skatteministeriet', 'afgørelse', 'klageren', 'landsskatteretten', 'fradrag', 'jf.',
+                    'stk.', 'nr.', 'ejendom', 'selskabet', 'indkomst', 'moms', 'ligningsloven', 'sagen', 'om', 'at',
+                    'der', 'ikke', 'til', 'for', 'af', 'med', 'den', 'og', 'i', 'på', 'var', 'har', 'kan', 'blev']
+
+
+class SyntheticCorpus:
+    """documents and their content files, generated from a seed so every process sees the same corpus"""
+
+    def __init__(self, documents: int = 10000, html_kb: float = 40.0, pdf_kb: float = 200.0, pdf_fraction: float = 0.0,
+                 size_sigma: float = 1.0, seed: int = 0):
+        random_ = random.Random(seed)
+        self.documents: List[dict] = []
+        self.objects: Dict[str, Tuple[str, int, int]] = {}  # object name -> (content type, size, seed)
+        for number in range(documents):
+            is_pdf: bool = random_.random() < pdf_fraction
+            content_type: str = 'application/pdf' if is_pdf else 'text/html; charset=utf-8'
+            name: str = f'verdicts/{number:08d}.{"pdf" if is_pdf else "html"}'
+            size: int = max(256, int(random_.lognormvariate(0, size_sigma) * (pdf_kb if is_pdf else html_kb) * 1024))
+            self.objects[name] = (content_type, size, random_.randrange(2 ** 31))
+            self.documents.append({
+                'id': f'ck{number:010d}', 'uid': f'uid{number}', 'documentType': 'verdict',
+                'url': f'https://info.skat.dk/data.aspx?oid={number}', 'permalink': f'/verdict/{number}',
+                'resume': 'resumé', 'resumeTitle': f'afgørelse {number}',
+                'updatedAt': f'2020-{1 + number % 12:02d}-{1 + number % 28:02d}T00:00:{number % 60:02d}.000Z',
+                'uniqueIdentifiers': [{'uidType': 'SKM', 'value': f'SKM{number}'}],
+                'contentFilesOriginal': [{'id': f'file{number}', 'url': f'gs://{BUCKET}/{name}', 'name': name,
+                                          'contentType': content_type}]})
+        self.ids: List[str] = [document['id'] for document in self.documents]  # ascending
+        self._text: str = ' '.join(random_.choice(WORDS) for _ in range(200000))
+
+    def content(self, name: str) -> bytes:
+        content_type, size, seed = self.objects[name]
+        offset: int = seed % (len(self._text) // 2)
+        text: str = self._text[offset:offset + size]
+        while len(text) < size:
+            text += ' ' + self._text[:size - len(text)]
+        if content_type == 'application/pdf':
+            return synthetic_pdf(text[:size])
+        html: str = f'<html><body><div class="MPtext"><p>{text[:size // 2]}</p><table><tr><td>tabel</td></tr></table>' \
+                    f'<p>{text[size // 2:size]}</p></div></body></html>'
+        return html.encode('utf-8')
+
+    def object_metadata(self, name: str) -> dict:
+        content_type, size, seed = self.objects[name]
+        return {'name': name, 'bucket': BUCKET, 'contentType': content_type, 'size': str(size), 'generation': str(seed),
+                'md5Hash': base64.b64encode(hashlib.md5(f'{name}{seed}'.encode()).digest()).decode()}
+
+
+def synthetic_pdf(text: str) -> bytes:
+    """a one page pdf, the text split into lines of one text object each, so pdftotext has something to extract"""
+    words: List[str] = text.split()
+    lines: List[str] = [' '.join(words[index:index + 12]) for index in range(0, len(words), 12)]
+    content: str = 'BT /F1 10 Tf 12 TL 20 800 Td ' + ' '.join(f'({_pdf_escape(line)}) \'' for line in lines) + ' ET'
+    content_bytes: bytes = content.encode('latin-1', errors='replace')
+    objects: List[bytes] = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content_bytes), content_bytes),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>']
+    pdf: bytes = b'%PDF-1.4\n'
+    offsets: List[int] = []
+    for number, object_ in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n%s\nendobj\n' % (number, object_)
+    xref_offset: int = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref_offset)
+
+    return pdf
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+class Latency:
+    def __init__(self, latency_ms: float, sigma: float = 0.5, error_rate: float = 0.0, seed: int = 0):
+        """error_rate: fraction of requests answered with 503"""
+        self.median_seconds = latency_ms / 1000
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+
+    async def wait(self):
+        if self.median_seconds > 0:
+            await asyncio.sleep(self.median_seconds * self._random.lognormvariate(0, self.sigma))
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise web.HTTPServiceUnavailable()
+
+
+class FakePrisma:
+    COUNT_QUERY = re.compile(r'(\w+)Connection\s*(?:\(\s*where\s*:\s*\{(.*)\}\s*\))?\s*\{\s*aggregate', re.DOTALL)
+    PAGE_QUERY = re.compile(r'\{\s*(\w+)\s*:\s*(\w+)\s*\((.*?)\)\s*\{(.*)\}', re.DOTALL)
+
+    def __init__(self, corpus: SyntheticCorpus, latency: Latency):
+        self.corpus = corpus
+        self.latency = latency
+        self.requests: int = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/', self.handle)
+
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        query: str = (await request.json())['query']
+        await self.latency.wait()
+
+        count_match = self.COUNT_QUERY.search(query)
+        if count_match:
+            count: int = sum(1 for _ in self._filtered(count_match.group(2) or '', after=None))
+            return web.json_response({'data': {f'{count_match.group(1)}Connection': {'aggregate': {'count': count}}}})
+
+        page_match = self.PAGE_QUERY.search(query)
+        if page_match is None:
+            return web.json_response({'errors': [{'message': f'fake prisma does not understand {query}'}]})
+        key, arguments, fields = page_match.group(1), page_match.group(3), page_match.group(4)
+
+        first: int = int(_argument(arguments, r'first\s*:\s*(\d+)') or 100)
+        skip: int = int(_argument(arguments, r'skip\s*:\s*(\d+)') or 0)
+        where: str = _argument(arguments, r'where\s*:\s*\{(.*)\}') or ''
+        page: List[dict] = []
+        for document in self._filtered(where, after=_argument(arguments, r'after\s*:\s*"([^"]*)"')):
+            if skip:
+                skip -= 1
+                continue
+            page.append(self._selected(document, fields))
+            if len(page) >= first:
+                break
+
+        return web.json_response({'data': {key: page}})
+
+    def _filtered(self, where: str, after: Optional[str]):
+        uids_listed: Optional[str] = _argument(where, r'uid_in\s*:\s*\[(.*?)\]')
+        uids: Optional[set] = set(re.findall(r'"([^"]*)"', uids_listed)) if uids_listed is not None else None
+        updated_after: Optional[str] = _argument(where, r'updatedAt_gt\s*:\s*"([^"]*)"')
+        url_contains: Optional[str] = _argument(where, r'url_contains\s*:\s*"([^"]*)"')
+        id_gt: Optional[str] = _argument(where, r'id_gt\s*:\s*"([^"]*)"')
+        id_lte: Optional[str] = _argument(where, r'id_lte\s*:\s*"([^"]*)"')
+
+        start: int = max(bisect.bisect_right(self.corpus.ids, after) if after is not None else 0,
+                         bisect.bisect_right(self.corpus.ids, id_gt) if id_gt is not None else 0)
+        stop: int = bisect.bisect_right(self.corpus.ids, id_lte) if id_lte is not None else len(self.corpus.ids)
+        for document in self.corpus.documents[start:stop]:
+            if uids is not None and document['uid'] not in uids:
+                continue
+            if updated_after is not None and not document['updatedAt'] > updated_after:
+                continue
+            if url_contains is not None and url_contains not in document['url']:
+                continue
+            yield document
+
+    @staticmethod
+    def _selected(document: dict, fields: str) -> dict:
+        """all fields, except contentType of the files when it was not asked for, because the file collector then
+        has to request the object metadata"""
+        if 'contentType' in fields:
+            return document
+        return dict(document, contentFilesOriginal=[{key: value for key, value in file_.items() if key != 'contentType'}
+                                                    for file_ in document['contentFilesOriginal']])
+
+
+class FakeGcloudStorage:
+    def __init__(self, corpus: SyntheticCorpus, latency: Latency):
+        self.corpus = corpus
+        self.latency = latency
+        self.names: List[str] = sorted(corpus.objects)
+        self.requests: int = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/storage/v1/b/{bucket}/o', self.list_objects)
+        app.router.add_get('/storage/v1/b/{bucket}/o/{name:.+}', self.get_object)
+
+        return app
+
+    async def list_objects(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await self.latency.wait()
+        prefix: str = request.query.get('prefix', '')
+        max_results: int = int(request.query.get('maxResults', 1000))
+        start: int = bisect.bisect_left(self.names, request.query.get('pageToken') or prefix)
+
+        names: List[str] = [name for name in self.names[start:start + max_results] if name.startswith(prefix)]
+        response: dict = {'items': [self.corpus.object_metadata(name) for name in names]}
+        if len(names) == max_results and start + max_results < len(self.names):
+            response['nextPageToken'] = self.names[start + max_results]
+
+        return web.json_response(response)
+
+    async def get_object(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        await self.latency.wait()
+        name: str = request.match_info['name']
+        if name not in self.corpus.objects:
+            raise web.HTTPNotFound()
+        if request.query.get('alt') != 'media':
+            return web.json_response(self.corpus.object_metadata(name))
+
+        content_type: str = self.corpus.objects[name][0]
+        return web.Response(body=self.corpus.content(name), content_type=content_type.split(';')[0])
+
+
+class EmulatedStorage:
+    """what GcloudStorageFileCollector calls on gcloud.aio.storage.Storage, against FakeGcloudStorage"""
+
+    class _Token:
+        async def get(self) -> str:
+            return 'benchmark'
+
+    def __init__(self, api_root: str, session: Optional[aiohttp.ClientSession] = None):
+        self.api_root = api_root
+        self.session = session
+        self.token = self._Token()
+
+    async def download(self, bucket: str, object_name: str, *, session: Optional[aiohttp.ClientSession] = None,
+                       timeout: float = 10) -> bytes:
+        async with self._get(bucket, object_name, {'alt': 'media'}, session, timeout) as response:
+            return await response.read()
+
+    async def download_metadata(self, bucket: str, object_name: str, *, session: Optional[aiohttp.ClientSession] = None,
+                                timeout: float = 10) -> dict:
+        async with self._get(bucket, object_name, {}, session, timeout) as response:
+            return await response.json()
+
+    async def list_objects(self, bucket: str, *, params: Optional[dict] = None,
+                           session: Optional[aiohttp.ClientSession] = None, timeout: float = 10) -> dict:
+        session = session or self.session
+        async with session.get(f'{self.api_root}/{quote(bucket, safe="")}/o', params=params or {},  # type: ignore
+                               timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    def _get(self, bucket: str, object_name: str, params: dict, session: Optional[aiohttp.ClientSession], timeout: float):
+        session = session or self.session
+        return _RaisingRequest(session.get(f'{self.api_root}/{quote(bucket, safe="")}/o/{quote(object_name, safe="")}',  # type: ignore
+                                           params=params, timeout=aiohttp.ClientTimeout(total=timeout)))
+
+
+class _RaisingRequest:
+    """`async with` a request whose response raises for error statuses, like the gcloud client does"""
+
+    def __init__(self, request_context):
+        self.request_context = request_context
+
+    async def __aenter__(self) -> aiohttp.ClientResponse:
+        response: aiohttp.ClientResponse = await self.request_context.__aenter__()
+        response.raise_for_status()
+        return response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.request_context.__aexit__(exc_type, exc, tb)
+
+
+def serve_in_process(corpus_arguments: dict, prisma_latency: dict, gcloud_latency: dict) -> Tuple[multiprocessing.Process, int, int]:
+    """starts both fakes in a forked process, so serving does not compete with the benchmarked code for the event loop.
+    Returns the process and the prisma and gcloud storage ports. Stop it with process.terminate()."""
+    context = multiprocessing.get_context('fork')
+    receiving_end, sending_end = context.Pipe(duplex=False)
+    process = context.Process(target=_serve, args=(corpus_arguments, prisma_latency, gcloud_latency, sending_end), daemon=True)
+    process.start()
+    prisma_port, gcloud_port = receiving_end.recv()
+
+    return process, prisma_port, gcloud_port
+
+
+def _serve(corpus_arguments: dict, prisma_latency: dict, gcloud_latency: dict, connection):
+    async def serve():
+        corpus = SyntheticCorpus(**corpus_arguments)
+        runners: List[web.AppRunner] = []
+        ports: List[int] = []
+        for fake in (FakePrisma(corpus, Latency(**prisma_latency)), FakeGcloudStorage(corpus, Latency(**gcloud_latency))):
+            runner = web.AppRunner(fake.app(), access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            runners.append(runner)
+            ports.append(site._server.sockets[0].getsockname()[1])  # type: ignore
+        connection.send(tuple(ports))
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def _argument(text: str, pattern: str) -> Optional[str]:
+    match = re.search(pattern, text, re.DOTALL)
+    return match.group(1) if match else None
@@ -0,0 +1,88 @@
+from typing import Deque, Dict, Tuple
+import asyncio
+import collections
+
+
+class BuildBudget:
+    """Bounds the documents, and the bytes of their content, that the sections of a build hold in memory at once.
+
+    A document is admitted when it leaves the collector and released once it is written or left out. Sections waiting
+    for room are served fairly: the one with the fewest documents in flight relative to its weight goes first, so a
+    section with large or slow documents cannot crowd out the others, and a section that finishes leaves its share
+    to the rest. A document larger than max_bytes is admitted once nothing else is in flight.
+    """
+
+    def __init__(self, max_documents: int = 2000, max_bytes: int = 1024 ** 3):
+        if max_documents < 1:
+            raise ValueError(f'max_documents must be at least 1, got {max_documents}')
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.documents: int = 0
+        self.bytes: int = 0
+        self.weights: Dict[str, float] = {}
+        self.in_flight: Dict[str, int] = collections.defaultdict(int)
+        self.admitted: Dict[str, int] = collections.defaultdict(int)
+        self.peak_documents: int = 0
+        self.peak_bytes: int = 0
+        self._waiters: Dict[str, Deque[Tuple[int, asyncio.Future]]] = collections.defaultdict(collections.deque)
+
+    def add_section(self, section: str, weight: float = 1.0):
+        """weight: share of the budget relative to the other sections, a section that is not added has weight 1"""
+        if weight <= 0:
+            raise ValueError(f'the weight of section "{section}" must be positive, got {weight}')
+        self.weights[section] = weight
+
+    async def acquire(self, section: str, size: int):
+        """waits until the document of size bytes fits, then counts it as in flight until release"""
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        waiter: Tuple[int, asyncio.Future] = (size, future)
+        self._waiters[section].append(waiter)
+        self._admit()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                if waiter in self._waiters[section]:
+                    self._waiters[section].remove(waiter)
+                # the cancelled waiter may have been the one the others were held back for
+                self._admit()
+            else:  # admitted just before the cancellation arrived
+                self.release(section, size)
+            raise
+
+    def release(self, section: str, size: int):
+        self.documents -= 1
+        self.bytes -= size
+        self.in_flight[section] -= 1
+        self._admit()
+
+    def stats(self) -> dict:
+        return {'documents': self.documents, 'bytes': self.bytes, 'peak_documents': self.peak_documents,
+                'peak_bytes': self.peak_bytes, 'admitted': dict(self.admitted)}
+
+    def _admit(self):
+        while True:
+            waiting = [section for section, waiters in self._waiters.items() if waiters]
+            if not waiting:
+                return
+            section: str = min(waiting, key=lambda section_: self.in_flight[section_] / self.weights.get(section_, 1.0))
+            size, future = self._waiters[section][0]
+            if future.cancelled():  # its acquire removes it, but may not have run yet
+                self._waiters[section].popleft()
+                continue
+            # the fairest waiter is not overtaken by smaller documents of other sections, or it could starve
+            if not self._fits(size):
+                return
+            self._waiters[section].popleft()
+            self.documents += 1
+            self.bytes += size
+            self.in_flight[section] += 1
+            self.admitted[section] += 1
+            self.peak_documents = max(self.peak_documents, self.documents)
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+            future.set_result(None)
+
+    def _fits(self, size: int) -> bool:
+        if self.documents >= self.max_documents:
+            return False
+        return self.bytes + size <= self.max_bytes or self.documents == 0
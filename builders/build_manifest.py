@@ -0,0 +1,107 @@
+from typing import Iterable, Iterator, List, Optional, Tuple
+import json
+import sqlite3
+
+
+class BuildManifest:
+    """What a section build produced, kept in sqlite next to the section.
+
+    One row per prisma document (uid) with its doc_id, updatedAt, a hash of the built text and the metadata line of
+    data.jsonl, plus the updatedAt watermark of the last completed build. An incremental build only asks prisma for
+    documents updated after the watermark, keeps doc_ids stable and skips rewriting documents whose text is unchanged.
+    """
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        # rows are also read from the thread writing data.jsonl, never concurrently
+        self.connection = sqlite3.connect(manifest_path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS documents (
+                uid TEXT PRIMARY KEY,
+                doc_id TEXT NOT NULL UNIQUE,
+                doc_number INTEGER NOT NULL,
+                updated_at TEXT,
+                content_hash TEXT,
+                metadata TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS build_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+        self.connection.commit()
+
+    def __enter__(self) -> 'BuildManifest':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def reset(self):
+        """forget everything, for full rebuilds"""
+        self.connection.execute('DELETE FROM documents')
+        self.connection.execute('DELETE FROM build_state')
+        self.connection.commit()
+
+    @property
+    def watermark(self) -> Optional[str]:
+        """largest updatedAt of the last completed build"""
+        row = self.connection.execute("SELECT value FROM build_state WHERE key = 'watermark'").fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, watermark: str):
+        self.connection.execute("INSERT OR REPLACE INTO build_state (key, value) VALUES ('watermark', ?)", (watermark,))
+        self.connection.commit()
+
+    def get(self, uid: str) -> Optional[Tuple[str, int, Optional[str]]]:
+        """(doc_id, doc_number, content_hash) of an already built document"""
+        return self.connection.execute('SELECT doc_id, doc_number, content_hash FROM documents WHERE uid = ?', (uid,)).fetchone()
+
+    def next_doc_number(self) -> int:
+        row = self.connection.execute('SELECT MAX(doc_number) FROM documents').fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def record(self, uid: str, doc_id: str, doc_number: int, updated_at: Optional[str],
+               content_hash: str, metadata: dict):
+        self.connection.execute('INSERT OR REPLACE INTO documents (uid, doc_id, doc_number, updated_at, content_hash, metadata) '
+                                'VALUES (?, ?, ?, ?, ?, ?)',
+                                (uid, doc_id, doc_number, updated_at, content_hash, json.dumps(metadata)))
+
+    def commit(self):
+        self.connection.commit()
+
+    def uids(self) -> Iterator[str]:
+        return (row[0] for row in self.connection.execute('SELECT uid FROM documents'))
+
+    def doc_ids(self) -> List[str]:
+        return [row[0] for row in self.connection.execute('SELECT doc_id FROM documents')]
+
+    def remove(self, uids: Iterable[str]) -> List[str]:
+        """removes documents, returns their doc_ids"""
+        doc_ids: List[str] = []
+        for uid in uids:
+            row = self.connection.execute('SELECT doc_id FROM documents WHERE uid = ?', (uid,)).fetchone()
+            if row is not None:
+                doc_ids.append(row[0])
+                self.connection.execute('DELETE FROM documents WHERE uid = ?', (uid,))
+        self.connection.commit()
+
+        return doc_ids
+
+    def merge(self, manifest_paths: Iterable[str]):
+        """adds the documents of other manifests, e.g. of the parts of a partitioned build. Their watermarks are left
+        out, the caller knows which one holds for all of them"""
+        for manifest_path in manifest_paths:
+            with BuildManifest(manifest_path) as other:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO documents (uid, doc_id, doc_number, updated_at, content_hash, metadata) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    other.connection.execute('SELECT uid, doc_id, doc_number, updated_at, content_hash, metadata FROM documents'))
+        self.connection.commit()
+
+    def metadatas(self) -> Iterator[dict]:
+        return (json.loads(row[0]) for row in self.connection.execute('SELECT metadata FROM documents ORDER BY doc_number'))
@@ -1,15 +1,27 @@
-from typing import List, Optional
+from typing import AsyncGenerator, Callable, Dict, Iterable, List, Optional, Set
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import hashlib
 import logging
 from datetime import datetime, timezone
 import json
 import asyncio
-import lxml.html
 import sys
 import os
 this_file_path = os.path.dirname(os.path.abspath(__file__))  # get directory of this file
 sys.path.append(this_file_path + '/..')
 from data_collectors import prisma_collector
 from data_collectors import file_collector_gcloud_storage
+from builders import build_budget
+from builders import build_manifest
+from builders import staged_pipeline
+from data_processors import html_extraction
+from data_processors import near_duplicates
+from data_processors import pdf_extraction
+from data_processors import sentence_segmentation
+from data_writers import sharded_corpus
+from instrumentation import run_metrics
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -18,96 +30,436 @@ streamHandler = logging.StreamHandler()
 streamHandler.setFormatter(formatter)
 logger.addHandler(streamHandler)
 
+PRISMA_ENDPOINT: str = 'http://localhost:4467'
+# contentType saves the file collector a metadata request per file, see GcloudStorageFileCollector.collect_file
+VERDICT_QUERY: str = """
+    contentFilesOriginal { id, url, name, contentType }
+    documentType
+    permalink
+    resume
+    resumeTitle
+    uid
+    url
+    uniqueIdentifiers { uidType, value }
+    """
+# the fields a build uses
+LAW_QUERY: str = """
+    contentFilesOriginal { id, url, name, contentType }
+    uid
+    url
+    """
+DOCUMENT_QUERIES: Dict[str, str] = {'verdict': VERDICT_QUERY, 'law': LAW_QUERY}
+
 
 async def main():
-    await build_skat()
+    # every section of builders/sections.json at once, builders/build_sections.py imports this module
+    from builders import build_sections
+    await build_sections.build_sections(build_sections.load_sections())
 
 
 async def build_skat():
     query_filters: List[str] = ['url_contains: "skat"']
-    await build(query_filters, 'verdict')
-
+    await build(query_filters, 'verdict', base_save_name='skat')
 
-async def build(query_filters: List[str], doc_type: str, limit: Optional[int] = None):
-    prisma_endpoint = 'http://localhost:4467'
-    file_collector = file_collector_gcloud_storage.GcloudStorageFileCollector()
-    prisma_collector_ = prisma_collector.PrismaDocumentCollector(prisma_endpoint, file_collector)
 
-    query: str = """
-        contentFilesOriginal { id, url, name }
-        documentType
-        permalink
-        resume
-        resumeTitle
-        uid
-        url
-        uniqueIdentifiers { uidType, value }
-        """
-
-    await get_verdict(prisma_collector_, query, query_filters, 'skat')
+async def build(query_filters: List[str], doc_type: str, limit: Optional[int] = None, base_save_name: Optional[str] = None):
+    """one section into data/, named base_save_name, which defaults to doc_type. See builders/build_sections.py"""
+    from builders import build_sections
+    section = build_sections.SectionSpec(base_save_name or doc_type, document_type=doc_type, query_filters=query_filters,
+                                         limit=limit, data_path=build_sections.DATA_PATH)
+    await build_sections.build_sections([section])
 
 
 async def get_verdict(prisma_collector_: prisma_collector,
                       query: str,
                       query_filters: List[str],
                       base_save_name: str,
-                      batch_size=1000, limit: Optional[int] = None):
+                      batch_size=1000, limit: Optional[int] = None,
+                      strip_workers: Optional[int] = None,
+                      write_workers: int = 4,
+                      queue_size: int = 1000,
+                      output_format: str = 'files',
+                      incremental: bool = False,
+                      metrics: Optional[run_metrics.RunMetrics] = None,
+                      data_path: Optional[str] = None,
+                      output_name: Optional[str] = None,
+                      first_doc_number: int = 0,
+                      near_duplicate_index: Optional[near_duplicates.NearDuplicateIndex] = None,
+                      on_near_duplicate: str = 'link',
+                      document_type: str = 'verdict',
+                      html_extractor: Optional[html_extraction.HtmlExtractor] = None,
+                      pdf_extractor: Optional[pdf_extraction.PdfExtractor] = None,
+                      text_analyzer: Optional[sentence_segmentation.TextAnalyzer] = None,
+                      budget: Optional[build_budget.BuildBudget] = None) -> dict:
+    """documents are downloaded, stripped in a process pool (html) or by pdftotext (pdf), segmented into sentences in
+    another process pool and written in a thread pool at the same time. strip_workers defaults to the number of cpus. queue_size bounds the number of documents waiting between stages.
+    output_format: 'files' writes one file per document plus data.jsonl (the DAGW layout), 'shards' writes
+        compressed JSONL shards with an offset index, see data_writers.sharded_corpus.
+    incremental: only fetch documents updated since the last build, rewrite only those whose text changed and remove
+        documents that are no longer in prisma. Otherwise the section is rebuilt from scratch.
+    metrics: records the stages strip_html, strip_pdf, segment and write, pass the one given to the collectors to get a single
+        report of the whole build
+    data_path: folder the section is written to, defaults to data/ in the repository
+    output_name: file name of the manifest and the shards, and of the metadata file (`<output_name>.data.jsonl`
+        instead of data.jsonl), so several builds can write to the same folder. Defaults to base_save_name.
+    first_doc_number: doc_ids of new documents are numbered from here on, see builders/partitioned_build.py
+    near_duplicate_index: documents are looked up in it before they are written, under the source
+        onlaw_api:<base_save_name>, and added if they are no near-duplicate of a document already in it, e.g. one
+        scraped by SkatDocSpider. A full build first removes the documents of the last build from it.
+        on_near_duplicate: 'drop' leaves near-duplicates out, 'link' writes them with near_duplicate_of (source, doc_id
+        and similarity of the document they duplicate) in their metadata
+    document_type: prisma type of the documents, e.g. 'verdict' or 'law'
+    html_extractor, pdf_extractor, text_analyzer: started pools shared with other builds running at the same time,
+        see builders/build_sections.py. They are left running. By default the build starts its own with strip_workers
+        processes. A shared text_analyzer needs minhash=True for the near-duplicate lookup.
+    budget: documents are admitted to it, under output_name, before they are stripped and released once written
+    returns the number of documents built and of documents that failed"""
 
-    data_path: str = os.path.abspath(os.path.join(this_file_path + '/..', 'data'))
+    if output_format not in ('files', 'shards'):
+        raise ValueError(f'unknown output_format "{output_format}"')
+    if on_near_duplicate not in ('drop', 'link'):
+        raise ValueError(f'unknown on_near_duplicate "{on_near_duplicate}"')
+    data_path = data_path or os.path.abspath(os.path.join(this_file_path + '/..', 'data'))
     logger.info(f'saving data to: {data_path}')
-    if not os.path.exists(data_path):
-        os.makedirs(data_path)
-    limit = 3
-    count_verdicts: int = await prisma_collector_.count_verdicts()
-    if limit:
-        max_documents = limit
-    else:
-        max_documents = count_verdicts
-    logger.info('starting to get')
-    batch_size = 1
-    for i in range(0, max_documents, batch_size):
-        metadatas: List[dict] = []
-        async for document in prisma_collector_.documents(query=query, document_type='verdict',
-                                                          offset=i, query_filters=query_filters, limit=min(batch_size, max_documents)):
-
-            doc_id: str = f'{base_save_name}_{i}'
-            metadata: dict = {'doc_id': doc_id,
-                              'uri': document['url'],
-                              'date_built': get_iso_formated_datetime_string_utc()
-                              }
-            metadatas.append(metadata)
-
-            content: str = strip_html(document['content'])
-            with open(f'{data_path}/{doc_id}', 'w') as fp:
-                fp.write(content)
-            # TODO add metadatas
-
-        with open(f'{data_path}/data.jsonl', 'a') as fp:
-            for metadata in metadatas:
-                fp.write(f'{json.dumps(metadata)}\n')
-
-
-def strip_html(html: str) -> str:
-    parsed_html = lxml.html.fromstring(html)
-
-    for table in parsed_html.xpath('//table'):
-        table.getparent().remove(table)
-
-    # for paragraph in parsed_html.xpath('//p'):
-    #     paragraph_text = f'{paragraph.text_content()}{paragraph.tail}'.strip()
-    #     breakpoint()
-    #     if not paragraph_text.endswith('.'):
-    #         paragraph.tail = paragraph.tail + '. '
-
-    all_content_no_html = ' '.join(lxml.etree.XPath("//text()")(parsed_html))
-
-    content_no_extra_whitespaces = ' '.join(all_content_no_html.split())
-
-    return content_no_extra_whitespaces
-
-
-def document2sentences(self, document: str) -> List[str]:
-    return [paragraph_dict['token'] for paragraph_dict in self.sentence_tokenizer.get_sentence_spans(document)]
+    os.makedirs(data_path, exist_ok=True)
+    strip_workers = strip_workers or os.cpu_count() or 1
+    output_name = output_name or base_save_name
+
+    manifest = build_manifest.BuildManifest(os.path.join(data_path, f'{output_name}.manifest.sqlite'))
+    if not incremental:
+        reset_manifest(manifest, data_path, near_duplicate_index, near_duplicate_source(base_save_name))
+    build = _SectionBuild(prisma_collector_, manifest, base_save_name, output_name, data_path,
+                          metrics or run_metrics.RunMetrics(base_save_name), document_type, budget, first_doc_number)
+    build.open_writer(output_format, incremental, near_duplicate_index, on_near_duplicate)
+    fetched_documents = build.fetch_documents(query, build.updated_query_filters(query_filters, incremental), limit,
+                                              batch_size)
+
+    loop = asyncio.get_running_loop()
+    with manifest, contextlib.ExitStack() as pools, ThreadPoolExecutor(write_workers) as thread_pool:
+        build.start_pools(pools, strip_workers, html_extractor, pdf_extractor, text_analyzer,
+                          minhash=near_duplicate_index is not None)
+        try:
+            async for built_document_ in build.pipeline(thread_pool, strip_workers, write_workers, queue_size).run(
+                    fetched_documents):
+                build.record(built_document_, batch_size)
+            manifest.commit()
+
+            if incremental:
+                await remove_deleted_documents(prisma_collector_, query_filters, manifest, data_path, build.corpus_writer,
+                                               near_duplicate_index, build.source, document_type)
+        finally:
+            if build.corpus_writer is not None:
+                await loop.run_in_executor(thread_pool, build.corpus_writer.close)
+        await build.finish(thread_pool, complete=limit is None)
+    logger.info(f'built #{build.built_documents} documents')
+    if build.failed_documents:
+        logger.warning(f'#{len(build.failed_documents)} documents failed and were left out: {build.failed_documents}')
+
+    return {'built': build.built_documents, 'failed': len(build.failed_documents)}
+
+
+class _SectionBuild:
+    """the state of one get_verdict call, shared by its stages: listing and numbering the documents (fetch_documents),
+    stripping and segmenting them (strip_document, segment_document) and writing them (write_document)"""
+
+    def __init__(self, prisma_collector_: prisma_collector, manifest: build_manifest.BuildManifest, base_save_name: str,
+                 output_name: str, data_path: str, metrics: run_metrics.RunMetrics, document_type: str,
+                 budget: Optional[build_budget.BuildBudget], first_doc_number: int):
+        self.prisma_collector_ = prisma_collector_
+        self.manifest = manifest
+        self.base_save_name = base_save_name
+        self.output_name = output_name
+        self.data_path = data_path
+        self.metrics = metrics
+        self.document_type = document_type
+        self.budget = budget
+        self.source: str = near_duplicate_source(base_save_name)
+        self.latest_updated_at: Optional[str] = manifest.watermark
+        self.next_doc_number: int = max(manifest.next_doc_number(), first_doc_number)
+        # of this build only, the collector may be shared with builds of other sections
+        self.collector_failures: List[dict] = []
+        self.failed_documents: List[dict] = []
+        self.built_documents: int = 0
+        self.corpus_writer: Optional[sharded_corpus.ShardedCorpusWriter] = None
+        self.write: Callable[[dict], Optional[dict]]
+        self.html_extractor: html_extraction.HtmlExtractor
+        self.pdf_extractor: pdf_extraction.PdfExtractor
+        self.text_analyzer: sentence_segmentation.TextAnalyzer
+
+    # listing and fetching
+
+    def updated_query_filters(self, query_filters: List[str], incremental: bool) -> List[str]:
+        updated_query_filters: List[str] = list(query_filters)
+        if incremental and self.manifest.watermark:
+            logger.info(f'incremental build of documents updated after {self.manifest.watermark}')
+            updated_query_filters.append(f'updatedAt_gt: "{self.manifest.watermark}"')
+
+        return updated_query_filters
+
+    async def fetch_documents(self, query: str, query_filters: List[str], limit: Optional[int],
+                              page_size: int) -> AsyncGenerator[dict, None]:
+        """the documents with their content, admitted to the budget"""
+        logger.info('starting to get')
+        async for document in self.prisma_collector_.documents(query=f'updatedAt\n{query}', document_type=self.document_type,
+                                                               query_filters=query_filters, limit=limit, stream=True,
+                                                               page_size=page_size, failed_documents=self.collector_failures):
+            numbered_document: dict = self.numbered_document(document)
+            if self.budget is not None:
+                await self.budget.acquire(self.output_name, numbered_document['content_size'])
+            yield numbered_document
+
+    def numbered_document(self, document: dict) -> dict:
+        """the doc_id the manifest has for its uid, or a new one"""
+        built_document_ = self.manifest.get(document['uid'])
+        if built_document_ is not None:
+            doc_id, doc_number, previous_content_hash = built_document_
+        else:
+            doc_number, previous_content_hash = self.next_doc_number, None
+            doc_id = f'{self.base_save_name}_{doc_number}'
+            self.next_doc_number += 1
+        if self.latest_updated_at is None or document['updatedAt'] > self.latest_updated_at:
+            self.latest_updated_at = document['updatedAt']
+
+        return {'doc_id': doc_id, 'doc_number': doc_number, 'uid': document['uid'], 'updated_at': document['updatedAt'],
+                'uri': document['url'], 'content': document['content'], 'previous_content_hash': previous_content_hash,
+                'content_size': content_bytes(document['content'])}
+
+    def release(self, document: dict):
+        if self.budget is not None:
+            self.budget.release(self.output_name, document['content_size'])
+
+    # stripping and segmenting
+
+    def start_pools(self, pools: contextlib.ExitStack, processes: int,
+                    html_extractor: Optional[html_extraction.HtmlExtractor],
+                    pdf_extractor: Optional[pdf_extraction.PdfExtractor],
+                    text_analyzer: Optional[sentence_segmentation.TextAnalyzer], minhash: bool):
+        """the shared pools, or pools of this build which are shut down with `pools`"""
+        self.html_extractor = html_extractor or pools.enter_context(html_extraction.HtmlExtractor(processes))
+        self.pdf_extractor = pdf_extractor or pools.enter_context(pdf_extraction.PdfExtractor(processes))
+        self.text_analyzer = text_analyzer or pools.enter_context(
+            sentence_segmentation.TextAnalyzer(processes, minhash=minhash))
+
+    def pipeline(self, thread_pool: ThreadPoolExecutor, strip_workers: int, write_workers: int,
+                 queue_size: int) -> staged_pipeline.StagedPipeline:
+        return staged_pipeline.StagedPipeline([
+            staged_pipeline.Stage('strip', self.strip_document, workers=strip_workers),
+            # enough documents in flight to fill a batch for every analyzer process
+            staged_pipeline.Stage('segment', self.segment_document,
+                                  workers=self.text_analyzer.batch_size * self.text_analyzer.processes),
+            staged_pipeline.Stage('write', functools.partial(self.write_document, thread_pool), workers=write_workers)
+        ], queue_size=queue_size)
+
+    async def strip_document(self, document: dict) -> Optional[dict]:
+        """a document that cannot be stripped is logged and left out instead of failing the build"""
+        content = document['content']
+        try:
+            text: str = await self._strip(content)
+        except Exception as e:
+            logger.error(f'could not strip {document["uid"]}: {type(e).__name__} {e}')
+            self.failed_documents.append({'uid': document['uid'], 'error': f'{type(e).__name__}: {e}'})
+            self.release(document)
+            return None
+        finally:
+            if isinstance(content, file_collector_gcloud_storage.SpooledFile):
+                content.remove()
+
+        return dict(document, content=text)
+
+    async def _strip(self, content) -> str:
+        if isinstance(content, file_collector_gcloud_storage.SpooledFile):
+            with self.metrics.timed('strip_pdf') as observation:
+                observation.bytes = content.size
+                return await self.pdf_extractor.extract_async(content.path)
+        if isinstance(content, bytes):
+            with self.metrics.timed('strip_pdf') as observation:
+                observation.bytes = len(content)
+                return await self.pdf_extractor.extract_async(content)
+        with self.metrics.timed('strip_html') as observation:
+            observation.bytes = len(content)  # characters, not bytes, encoding every page costs too much
+            return await self.html_extractor.extract_async(content)
+
+    async def segment_document(self, document: dict) -> dict:
+        with self.metrics.timed('segment') as observation:
+            text_metadata: dict = await self.text_analyzer.analyze_async(document['content'])
+            observation.bytes = len(document['content'])
+            observation.tokens = text_metadata['token_count']
+
+        minhash: Optional[List[int]] = text_metadata.pop('minhash', None)
+
+        return dict(document, text_metadata=text_metadata, minhash=minhash)
+
+    # writing
+
+    def open_writer(self, output_format: str, incremental: bool,
+                    near_duplicate_index: Optional[near_duplicates.NearDuplicateIndex], on_near_duplicate: str):
+        if output_format == 'shards':
+            if not incremental:
+                # a full build replaces the section, the index of an earlier one would still list its documents
+                sharded_corpus.remove_corpus(self.data_path, self.output_name)
+            self.corpus_writer = sharded_corpus.ShardedCorpusWriter(self.data_path, name=self.output_name)
+            write = functools.partial(write_document_to_shards, self.corpus_writer)
+        else:
+            write = functools.partial(write_document, self.data_path)
+        self.write = functools.partial(timed_write, self.metrics, write)
+        if near_duplicate_index is not None:
+            self.write = functools.partial(write_unless_near_duplicate, near_duplicate_index, self.source,
+                                           on_near_duplicate, self.write)
+
+    async def write_document(self, thread_pool: ThreadPoolExecutor, document: dict) -> Optional[dict]:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(thread_pool, self.write, document)
+        finally:
+            self.release(document)
+
+    def record(self, built_document_: dict, batch_size: int):
+        self.manifest.record(**built_document_)
+        self.built_documents += 1
+        if self.built_documents % batch_size == 0:
+            self.manifest.commit()
+
+    async def finish(self, thread_pool: ThreadPoolExecutor, complete: bool):
+        """writes the metadata file and, if complete, i.e. all documents were fetched, moves the watermark"""
+        if self.corpus_writer is None:
+            metadata_file_name: str = 'data.jsonl' if self.output_name == self.base_save_name else f'{self.output_name}.data.jsonl'
+            await asyncio.get_running_loop().run_in_executor(thread_pool, write_metadata_file, self.data_path,
+                                                             self.manifest.metadatas(), metadata_file_name)
+        self.failed_documents.extend(self.collector_failures)
+        # only a completed build of all documents moves the watermark, an interrupted one is simply redone, and so is one
+        # where documents failed, which are then fetched again by the next incremental build
+        if self.latest_updated_at is not None and complete and not self.failed_documents:
+            self.manifest.set_watermark(self.latest_updated_at)
+
+
+def near_duplicate_source(base_save_name: str) -> str:
+    return f'onlaw_api:{base_save_name}'
+
+
+def reset_manifest(manifest: build_manifest.BuildManifest, data_path: str,
+                   near_duplicate_index: Optional[near_duplicates.NearDuplicateIndex], source: str):
+    """for a full build, which numbers the doc_ids anew. The document files of the last build are removed, as
+    open_writer removes its shards, and so are their signatures, a document would otherwise be found as a
+    near-duplicate of itself under its old doc_id"""
+    doc_ids: List[str] = manifest.doc_ids()
+    for doc_id in doc_ids:
+        if os.path.exists(f'{data_path}/{doc_id}'):
+            os.remove(f'{data_path}/{doc_id}')
+    if near_duplicate_index is not None:
+        near_duplicate_index.remove(source, doc_ids)
+    manifest.reset()
+
+
+async def remove_deleted_documents(prisma_collector_: prisma_collector, query_filters: List[str],
+                                   manifest: build_manifest.BuildManifest, data_path: str,
+                                   corpus_writer: Optional[sharded_corpus.ShardedCorpusWriter],
+                                   near_duplicate_index: Optional[near_duplicates.NearDuplicateIndex] = None, source: str = '',
+                                   document_type: str = 'verdict'):
+    existing_uids: Set[str] = {document['uid'] async for document in
+                               prisma_collector_.documents(query='uid', document_type=document_type, query_filters=query_filters,
+                                                           metadata_only=True, stream=True)}
+    deleted_uids: List[str] = [uid for uid in manifest.uids() if uid not in existing_uids]
+
+    deleted_doc_ids: List[str] = manifest.remove(deleted_uids)
+    for doc_id in deleted_doc_ids:
+        if corpus_writer is not None:
+            corpus_writer.delete(doc_id)
+        elif os.path.exists(f'{data_path}/{doc_id}'):
+            os.remove(f'{data_path}/{doc_id}')
+    if near_duplicate_index is not None:
+        near_duplicate_index.remove(source, deleted_doc_ids)
+    logger.info(f'removed #{len(deleted_uids)} documents deleted from prisma')
+
+
+def write_unless_near_duplicate(near_duplicate_index: near_duplicates.NearDuplicateIndex, source: str, on_near_duplicate: str,
+                                write: Callable[[dict], Optional[dict]], document: dict) -> Optional[dict]:
+    """runs in the write threads, the index serialises them. A document whose text is unchanged since the last build
+    is neither looked up nor rewritten, it keeps what that build decided, and its signature is still in the index"""
+    if document['minhash'] is None:  # no words
+        return write(document)
+    if hash_content(document['content']) == document['previous_content_hash']:
+        return None
+    match: Optional[near_duplicates.Match] = near_duplicate_index.find_or_add(source, document['doc_id'], document['minhash'])
+    if match is None:
+        return write(document)
+
+    logger.info(f'{document["uid"]} is a near-duplicate of {match.doc_id} from {match.source} ({match.similarity:.2f})')
+    if on_near_duplicate == 'drop':
+        return None
+    return write(dict(document, near_duplicate_of=match))
+
+
+def timed_write(metrics: run_metrics.RunMetrics, write: Callable[[dict], Optional[dict]], document: dict) -> Optional[dict]:
+    """runs in the write threads, so encoding the text to count its bytes does not hold up the event loop"""
+    with metrics.timed('write') as observation:
+        built_document_: Optional[dict] = write(document)
+        if built_document_ is None:  # unchanged, nothing was written
+            observation.documents = 0
+        else:
+            observation.bytes = len(document['content'].encode('utf-8'))
+            observation.tokens = document['text_metadata']['token_count']
+
+    return built_document_
+
+
+def write_document(data_path: str, document: dict) -> Optional[dict]:
+    content_hash: str = hash_content(document['content'])
+    if content_hash == document['previous_content_hash']:
+        return None
+
+    with open(f'{data_path}/{document["doc_id"]}', 'w') as fp:
+        fp.write(document['content'])
+
+    return built_document(document, content_hash)
+
+
+def write_document_to_shards(corpus_writer: sharded_corpus.ShardedCorpusWriter, document: dict) -> Optional[dict]:
+    content_hash: str = hash_content(document['content'])
+    if content_hash == document['previous_content_hash']:
+        return None
+
+    built_document_ = built_document(document, content_hash)
+    corpus_writer.write(document['doc_id'], document['content'], built_document_['metadata'])
+
+    return built_document_
+
+
+def built_document(document: dict, content_hash: str) -> dict:
+    """arguments of BuildManifest.record"""
+    metadata: dict = {'doc_id': document['doc_id'],
+                      'uri': document['uri'],
+                      'date_built': get_iso_formated_datetime_string_utc(),
+                      'token_count': document['text_metadata']['token_count'],
+                      # [start, end) character offsets into the text
+                      'sentences': document['text_metadata']['sentences']
+                      }
+    if document.get('near_duplicate_of') is not None:
+        metadata['near_duplicate_of'] = document['near_duplicate_of']._asdict()
+
+    return {'uid': document['uid'], 'doc_id': document['doc_id'], 'doc_number': document['doc_number'],
+            'updated_at': document['updated_at'], 'content_hash': content_hash, 'metadata': metadata}
+
+
+def content_bytes(content) -> int:
+    """of a document's content as collected: html, pdf bytes or a pdf spooled to disk"""
+    if isinstance(content, file_collector_gcloud_storage.SpooledFile):
+        return content.size
+    return len(content)
+
+
+def hash_content(content: str) -> str:
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def write_metadata_file(data_path: str, metadatas: Iterable[dict], file_name: str = 'data.jsonl'):
+    """(re)writes data.jsonl, replacing the old file only once the new one is complete"""
+    with open(f'{data_path}/{file_name}.tmp', 'w') as fp:
+        for metadata in metadatas:
+            fp.write(f'{json.dumps(metadata)}\n')
+    os.replace(f'{data_path}/{file_name}.tmp', f'{data_path}/{file_name}')
+
+
+def document2sentences(document: str) -> List[str]:
+    return sentence_segmentation.sentences(document)
 
 
 def get_iso_formated_datetime_string_utc() -> str:
@@ -0,0 +1,188 @@
+"""Builds several sections in one run, e.g. a full refresh of the onlaw part of DAGW, from a declarative spec:
+
+    python builders/build_sections.py                        # every section of builders/sections.json
+    python builders/build_sections.py --section skat --sections my_sections.json
+
+The spec is a json list of sections, with the fields of SectionSpec. Only name is required:
+
+    [
+        {"name": "skat", "document_type": "verdict", "query_filters": ["url_contains: \\"skat\\""]},
+        {"name": "laws", "document_type": "law", "output_format": "shards", "weight": 2}
+    ]
+
+Every section is written to its own folder, data/<name> unless data_path is set. The sections are built at the same
+time and share one pooled http session, and with it the adaptive concurrency limits of prisma and gcloud storage, one
+set of html, pdf and text analysis processes sized to the cpus, the near-duplicate index and a
+builders.build_budget.BuildBudget of the documents and content bytes in flight. The budget is shared out by the
+sections' weights, so one section's downloads overlap with the stripping of another's, and a large section does not
+hold up the small ones.
+"""
+from typing import Dict, List, NamedTuple, Optional
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+this_file_path = os.path.dirname(os.path.abspath(__file__))  # get directory of this file
+sys.path.append(this_file_path + '/..')
+from data_collectors import prisma_collector
+from data_collectors import file_collector_gcloud_storage
+from data_collectors import http_session
+from builders import build_budget
+from builders import build_section_from_onlaw_api
+from data_processors import html_extraction
+from data_processors import near_duplicates
+from data_processors import pdf_extraction
+from data_processors import sentence_segmentation
+from instrumentation import run_metrics
+
+logger = logging.getLogger(__name__)
+DATA_PATH: str = os.path.abspath(os.path.join(this_file_path + '/..', 'data'))
+SECTIONS_PATH: str = os.path.join(this_file_path, 'sections.json')
+
+
+class SectionSpec(NamedTuple):
+    name: str  # base_save_name, doc_ids are <name>_<number>
+    document_type: str = 'verdict'  # prisma type
+    query_filters: Optional[List[str]] = None  # prisma where filters, e.g. 'url_contains: "skat"'
+    query: Optional[str] = None  # prisma fields, defaults to build_section_from_onlaw_api.DOCUMENT_QUERIES[document_type]
+    limit: Optional[int] = None
+    output_format: str = 'files'  # or 'shards'
+    incremental: bool = False
+    data_path: Optional[str] = None
+    weight: float = 1.0  # share of the build budget relative to the other sections
+    on_near_duplicate: str = 'link'  # or 'drop'
+
+
+def load_sections(sections_path: str = SECTIONS_PATH) -> List[SectionSpec]:
+    with open(sections_path, 'r') as fp:
+        entries: List[dict] = json.load(fp)
+
+    sections: List[SectionSpec] = []
+    for entry in entries:
+        unknown_fields: List[str] = [field for field in entry if field not in SectionSpec._fields]
+        if unknown_fields or 'name' not in entry:
+            raise ValueError(f'{sections_path}: section {entry.get("name")} needs a name and has unknown fields '
+                             f'{unknown_fields}, the fields are {SectionSpec._fields}')
+        sections.append(SectionSpec(**entry))
+
+    return sections
+
+
+async def build_sections(sections: List[SectionSpec], max_documents: int = 2000, max_bytes: int = 1024 ** 3,
+                         processes: Optional[int] = None, data_path: str = DATA_PATH) -> Dict[str, dict]:
+    """builds the sections at the same time, see the module docstring. max_documents and max_bytes bound the documents
+    and the bytes of their content held between download and write, over all sections. processes: of each of the
+    html, pdf and text analysis pools, defaults to the number of cpus. Returns the result of get_verdict by section."""
+    check_sections(sections)
+    os.makedirs(data_path, exist_ok=True)
+    # large pdfs are streamed to disk instead of being held in memory until their text is extracted
+    spool_path: str = tempfile.mkdtemp(prefix='odagw_spool_')
+    run_name: str = sections[0].name if len(sections) == 1 else 'sections'
+    # written every 30s to data/<run name>.metrics.json and .prom, and summarised at the end
+    metrics = run_metrics.RunMetrics(run_name, report_path=os.path.join(data_path, f'{run_name}.metrics'))
+    try:
+        with metrics:
+            async with http_session.create_pooled_session() as session:
+                file_collector = file_collector_gcloud_storage.GcloudStorageFileCollector(spool_path=spool_path,
+                                                                                          metrics=metrics, session=session)
+                prisma_collector_ = prisma_collector.PrismaDocumentCollector(
+                    build_section_from_onlaw_api.PRISMA_ENDPOINT, file_collector, metrics=metrics, session=session,
+                    concurrent_files_collected=concurrent_files_collected(sections))
+                async with file_collector, prisma_collector_:
+                    # the queries ask for the files' contentType, so the bucket is not listed for the build, only by
+                    # estimate_build for the sizes
+                    return await build_sections_with(prisma_collector_, sections, metrics, max_documents, max_bytes,
+                                                     processes, data_path)
+    finally:
+        shutil.rmtree(spool_path, ignore_errors=True)
+
+
+async def build_sections_with(prisma_collector_: prisma_collector.PrismaDocumentCollector, sections: List[SectionSpec],
+                              metrics: run_metrics.RunMetrics, max_documents: int = 2000, max_bytes: int = 1024 ** 3,
+                              processes: Optional[int] = None, data_path: str = DATA_PATH) -> Dict[str, dict]:
+    """build_sections with a collector that is already set up, e.g. against the fakes of the benchmarks"""
+    check_sections(sections)
+    processes = processes or os.cpu_count() or 1
+    budget = build_budget.BuildBudget(max_documents, max_bytes)
+    for section in sections:
+        budget.add_section(section.name, section.weight)
+
+    # the index is shared with SkatDocSpider, so a ruling is stored once whether it came from onlaw or skat.dk
+    with near_duplicates.NearDuplicateIndex(os.path.join(data_path, 'near_duplicates.sqlite')) as near_duplicate_index, \
+            html_extraction.HtmlExtractor(processes) as html_extractor, \
+            pdf_extraction.PdfExtractor(processes) as pdf_extractor, \
+            sentence_segmentation.TextAnalyzer(processes, minhash=True) as text_analyzer:
+        results: List[dict] = await asyncio.gather(*(
+            build_section(section, prisma_collector_, metrics, data_path, near_duplicate_index,
+                          html_extractor=html_extractor, pdf_extractor=pdf_extractor, text_analyzer=text_analyzer,
+                          budget=budget, strip_workers=processes)
+            for section in sections))
+    logger.info(f'build budget: {budget.stats()}')
+
+    return {section.name: result for section, result in zip(sections, results)}
+
+
+def check_sections(sections: List[SectionSpec]):
+    names: List[str] = [section.name for section in sections]
+    if len(set(names)) < len(names):
+        raise ValueError(f'section names must be unique, got {names}')
+    for section in sections:
+        if section.query is None and section.document_type not in build_section_from_onlaw_api.DOCUMENT_QUERIES:
+            raise ValueError(f'section {section.name}: no default query for document_type "{section.document_type}", '
+                             f'set query')
+
+
+def concurrent_files_collected(sections: List[SectionSpec], total: int = 300) -> int:
+    """the download window of a single build is shared out, as the downloads waiting for the budget are held in it"""
+    return max(1, total // len(sections))
+
+
+async def build_section(section: SectionSpec, prisma_collector_: prisma_collector.PrismaDocumentCollector,
+                        metrics: run_metrics.RunMetrics, data_path: str,
+                        near_duplicate_index: near_duplicates.NearDuplicateIndex, **shared) -> dict:
+    """shared: the pools, budget and strip_workers passed on to get_verdict"""
+    query_filters: List[str] = section.query_filters or []
+    if not section.incremental:
+        # the estimate streams the metadata of the whole section, an incremental build fetches only what changed
+        estimate = await prisma_collector_.estimate_build(document_type=section.document_type, query_filters=query_filters)
+        logger.info(f'{section.name}: about to build {estimate}')
+    result: dict = await build_section_from_onlaw_api.get_verdict(
+        prisma_collector_, section.query or build_section_from_onlaw_api.DOCUMENT_QUERIES[section.document_type],
+        query_filters, section.name, limit=section.limit, output_format=section.output_format,
+        incremental=section.incremental, metrics=metrics, data_path=section.data_path or os.path.join(data_path, section.name),
+        near_duplicate_index=near_duplicate_index, on_near_duplicate=section.on_near_duplicate,
+        document_type=section.document_type, **shared)
+    logger.info(f'{section.name}: {result}')
+
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--sections', dest='sections_path', default=SECTIONS_PATH, help='the spec, a json file')
+    arg_parser.add_argument('--section', dest='names', action='append',
+                            help='build only this section of the spec, may be repeated')
+    arg_parser.add_argument('--max-documents', type=int, default=2000,
+                            help='documents between download and write, over all sections')
+    arg_parser.add_argument('--max-megabytes', type=float, default=1024.0,
+                            help='content of the documents between download and write, over all sections')
+    arg_parser.add_argument('--processes', type=int, help='of each of the html, pdf and text analysis pools, defaults '
+                            'to the number of cpus')
+    arguments = arg_parser.parse_args()
+
+    sections: List[SectionSpec] = load_sections(arguments.sections_path)
+    if arguments.names:
+        unknown_names: List[str] = sorted(set(arguments.names) - {section.name for section in sections})
+        if unknown_names:
+            arg_parser.error(f'no section {unknown_names} in {arguments.sections_path}')
+        sections = [section for section in sections if section.name in arguments.names]
+    asyncio.run(build_sections(sections, arguments.max_documents, int(arguments.max_megabytes * 1024 ** 2),
+                               arguments.processes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""Builds a section in parallel: the documents are split into id ranges, which any number of workers build at once.
+
+    python builders/partitioned_build.py plan
+    python builders/partitioned_build.py work --processes 4    # on every machine sharing data/
+    python builders/partitioned_build.py status
+    python builders/partitioned_build.py merge                 # once every range is done
+
+plan lists the ids of all documents of --document-type matching the query filters and stores ranges of range_size documents in the work
+manifest, data/<name>.work.sqlite (see builders/work_manifest.py). Every worker claims a range, builds it with
+get_verdict into its own part (data/<name>-partNNNNN shards, or the document files plus <name>-partNNNNN.data.jsonl),
+marks it done and claims the next one. Ranges keep their place in the doc_id numbering, so doc_ids do not depend on
+which worker built what. merge then joins the parts into one section, i.e. <name>.index.jsonl or data.jsonl, and
+their manifests into <name>.manifest.sqlite.
+
+A partitioned build is a full build of the documents that existed at planning time. Its manifest's watermark is the
+latest updatedAt seen by plan, so the incremental build of build_section_from_onlaw_api (same name and query filters)
+updates the section afterwards. A range that lost its lease, because its worker was not heard of for --lease-seconds,
+is given up by that worker and built by the one that claimed it.
+"""
+from typing import Awaitable, List, Optional
+import argparse
+import asyncio
+import glob
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+this_file_path = os.path.dirname(os.path.abspath(__file__))  # get directory of this file
+sys.path.append(this_file_path + '/..')
+from data_collectors import prisma_collector
+from data_collectors import file_collector_gcloud_storage
+from builders import build_manifest
+from builders import build_section_from_onlaw_api
+from builders import work_manifest
+from data_processors import near_duplicates
+from data_writers import sharded_corpus
+from instrumentation import run_metrics
+
+logger = logging.getLogger(__name__)
+DATA_PATH: str = os.path.abspath(os.path.join(this_file_path + '/..', 'data'))
+
+
+async def plan_build(prisma_collector_: prisma_collector.PrismaDocumentCollector, manifest: work_manifest.WorkManifest,
+                     query_filters: List[str], base_save_name: str, output_format: str = 'shards',
+                     range_size: int = 5000, document_type: str = 'verdict', query: Optional[str] = None,
+                     near_duplicate_index: Optional[near_duplicates.NearDuplicateIndex] = None) -> List[work_manifest.WorkRange]:
+    """only the ids of the documents are fetched, in id order, and cut into ranges of range_size documents.
+    document_type: prisma type of the documents, e.g. 'verdict' or 'law'
+    query: prisma fields the workers fetch, defaults to build_section_from_onlaw_api.DOCUMENT_QUERIES[document_type]
+    near_duplicate_index: the one the workers use. The section's documents of an earlier build are removed from it, the
+        merge of that build removed the manifests of its parts that listed them"""
+    if query is None:
+        if document_type not in build_section_from_onlaw_api.DOCUMENT_QUERIES:
+            raise ValueError(f'no default query for document_type "{document_type}", pass a query')
+        query = build_section_from_onlaw_api.DOCUMENT_QUERIES[document_type]
+    ranges: List[work_manifest.WorkRange] = []
+    after_id: Optional[str] = None
+    documents_in_range: int = 0
+    last_id: Optional[str] = None
+    latest_updated_at: Optional[str] = None
+    async for document in prisma_collector_.documents(query='id\nupdatedAt', document_type=document_type,
+                                                      query_filters=query_filters, metadata_only=True, stream=True):
+        last_id = document['id']
+        latest_updated_at = max(latest_updated_at or document['updatedAt'], document['updatedAt'])
+        documents_in_range += 1
+        if documents_in_range == range_size:
+            ranges.append(work_manifest.WorkRange(len(ranges), after_id, last_id, len(ranges) * range_size, range_size))
+            after_id, documents_in_range = last_id, 0
+    if documents_in_range:
+        ranges.append(work_manifest.WorkRange(len(ranges), after_id, last_id, len(ranges) * range_size, documents_in_range))  # type: ignore
+
+    if near_duplicate_index is not None:
+        near_duplicate_index.remove_source(build_section_from_onlaw_api.near_duplicate_source(base_save_name))
+    manifest.plan(ranges, {'base_save_name': base_save_name, 'query_filters': query_filters, 'output_format': output_format,
+                           'document_type': document_type, 'query': query, 'watermark': latest_updated_at})
+    logger.info(f'planned #{len(ranges)} ranges of up to {range_size} documents')
+
+    return ranges
+
+
+async def work(prisma_collector_: prisma_collector.PrismaDocumentCollector, manifest: work_manifest.WorkManifest,
+               worker: str, data_path: str = DATA_PATH, lease_seconds: float = 600.0, strip_workers: Optional[int] = None,
+               metrics: Optional[run_metrics.RunMetrics] = None,
+               near_duplicate_index: Optional[near_duplicates.NearDuplicateIndex] = None) -> int:
+    """builds ranges until none is left to claim, returns how many this worker built"""
+    settings: dict = manifest.settings
+    built_ranges: int = 0
+    while True:
+        work_range: Optional[work_manifest.WorkRange] = manifest.claim(worker, lease_seconds)
+        if work_range is None:
+            return built_ranges
+
+        logger.info(f'{worker} builds range {work_range.range_id}: {work_range.documents} documents after {work_range.after_id}')
+        name: str = part_name(settings['base_save_name'], work_range.range_id)
+        # a range claimed again after its worker died may have left part of its output behind. Its manifest is kept,
+        # get_verdict removes the documents it lists from the near-duplicate index before it resets it
+        remove_part(data_path, name)
+        # limit: documents created after planning would otherwise shift into the doc numbers of the next range
+        result: Optional[dict] = await build_leased(
+            manifest, work_range, worker, lease_seconds, build_section_from_onlaw_api.get_verdict(
+                prisma_collector_, settings['query'], settings['query_filters'] + id_range_filters(work_range),
+                settings['base_save_name'], document_type=settings['document_type'],
+                limit=work_range.documents, strip_workers=strip_workers, output_format=settings['output_format'],
+                metrics=metrics, data_path=data_path, output_name=name, first_doc_number=work_range.first_doc_number,
+                near_duplicate_index=near_duplicate_index))
+        if result is None:
+            continue
+        manifest.done(work_range.range_id, worker, result['built'], result['failed'])
+        built_ranges += 1
+        logger.info(f'{worker} finished range {work_range.range_id}, progress: {manifest.progress()}')
+
+
+async def build_leased(manifest: work_manifest.WorkManifest, work_range: work_manifest.WorkRange, worker: str,
+                       lease_seconds: float, build: Awaitable[dict]) -> Optional[dict]:
+    """awaits build while renewing the lease of work_range. Returns None, after cancelling build, if the lease was
+    lost: the worker that claimed the range meanwhile builds it into the same part. On an error the range is released."""
+    build_task: asyncio.Future = asyncio.ensure_future(build)
+    heartbeat: asyncio.Task = asyncio.create_task(renew_lease(manifest, work_range.range_id, worker, lease_seconds / 3))
+    try:
+        await asyncio.wait([build_task, heartbeat], return_when=asyncio.FIRST_COMPLETED)
+        if not build_task.done():
+            heartbeat.result()  # raises if renewing failed, otherwise the lease is lost
+            build_task.cancel()
+            await asyncio.gather(build_task, return_exceptions=True)
+            logger.warning(f'{worker} lost the lease of range {work_range.range_id} and stopped building it')
+            return None
+
+        return build_task.result()
+    except BaseException:
+        build_task.cancel()
+        manifest.release(work_range.range_id, worker)
+        raise
+    finally:
+        heartbeat.cancel()
+
+
+async def renew_lease(manifest: work_manifest.WorkManifest, range_id: int, worker: str, interval: float):
+    """returns once the lease is lost"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        # sqlite may wait for the lock of another worker, which must not stall the build
+        if not await loop.run_in_executor(None, manifest.heartbeat, range_id, worker):
+            return
+
+
+def merge(manifest: work_manifest.WorkManifest, data_path: str = DATA_PATH):
+    """joins the parts into one section once every range is done and removes what only the parts needed"""
+    progress: dict = manifest.progress()
+    if progress['pending'] or progress['claimed']:
+        raise RuntimeError(f'cannot merge before every range is built: {progress}')
+    settings: dict = manifest.settings
+    base_save_name: str = settings['base_save_name']
+    names: List[str] = [part_name(base_save_name, work_range.range_id) for work_range in manifest.ranges()]
+
+    if settings['output_format'] == 'shards':
+        # shards of an earlier build of the section are not referenced by the new index
+        for shard_path in sharded_corpus.shard_paths(data_path, base_save_name):
+            os.remove(shard_path)
+        # the parts' shards stay where they are, their index lines name them
+        concatenate(data_path, [f'{name}.index.jsonl' for name in names], f'{base_save_name}.index.jsonl')
+    else:
+        concatenate(data_path, [f'{name}.data.jsonl' for name in names], 'data.jsonl')
+    merge_manifests(data_path, base_save_name, names, settings.get('watermark') if not progress['failed'] else None)
+
+    for name in names:
+        for file_name in (f'{name}.index.jsonl', f'{name}.data.jsonl', f'{name}.manifest.sqlite'):
+            if os.path.exists(os.path.join(data_path, file_name)):
+                os.remove(os.path.join(data_path, file_name))
+    logger.info(f'merged #{len(names)} parts into {base_save_name}: {progress["built"]} documents built, '
+                f'{progress["failed"]} failed')
+
+
+def merge_manifests(data_path: str, base_save_name: str, names: List[str], watermark: Optional[str]):
+    """the section's manifest, as get_verdict would have left it, so an incremental build can follow.
+    watermark: None if documents failed, the next incremental build then fetches all documents again"""
+    with build_manifest.BuildManifest(os.path.join(data_path, f'{base_save_name}.manifest.sqlite')) as section_manifest:
+        section_manifest.reset()
+        section_manifest.merge(os.path.join(data_path, f'{name}.manifest.sqlite') for name in names)
+        if watermark is not None:
+            section_manifest.set_watermark(watermark)
+
+
+def concatenate(data_path: str, file_names: List[str], merged_file_name: str):
+    """in order, replacing merged_file_name only once the merged file is complete"""
+    with open(os.path.join(data_path, f'{merged_file_name}.tmp'), 'wb') as merged_fp:
+        for file_name in file_names:
+            with open(os.path.join(data_path, file_name), 'rb') as fp:
+                shutil.copyfileobj(fp, merged_fp)
+    os.replace(os.path.join(data_path, f'{merged_file_name}.tmp'), os.path.join(data_path, merged_file_name))
+
+
+def part_name(base_save_name: str, range_id: int) -> str:
+    return f'{base_save_name}-part{range_id:05d}'
+
+
+def id_range_filters(work_range: work_manifest.WorkRange) -> List[str]:
+    query_filters: List[str] = [f'id_lte: "{work_range.last_id}"']
+    if work_range.after_id is not None:
+        query_filters.append(f'id_gt: "{work_range.after_id}"')
+
+    return query_filters
+
+
+def remove_part(data_path: str, name: str):
+    """all but its manifest (and the manifest's journal)"""
+    manifest_path_: str = os.path.join(data_path, f'{name}.manifest.sqlite')
+    for path in sharded_corpus.shard_paths(data_path, name) + glob.glob(os.path.join(data_path, f'{name}.*')):
+        if not path.startswith(manifest_path_):
+            os.remove(path)
+
+
+def manifest_path(base_save_name: str, data_path: str = DATA_PATH) -> str:
+    return os.path.join(data_path, f'{base_save_name}.work.sqlite')
+
+
+def near_duplicate_index_path(data_path: str = DATA_PATH) -> str:
+    return os.path.join(data_path, 'near_duplicates.sqlite')
+
+
+async def run_with_collectors(command: str, arguments: argparse.Namespace, worker: str = ''):
+    spool_path: str = tempfile.mkdtemp(prefix='odagw_spool_')
+    run_name: str = '-'.join(name for name in (arguments.base_save_name, command, worker) if name)
+    metrics = run_metrics.RunMetrics(run_name, report_path=os.path.join(DATA_PATH, f'{run_name}.metrics'))
+    file_collector = file_collector_gcloud_storage.GcloudStorageFileCollector(spool_path=spool_path, metrics=metrics)
+    prisma_collector_ = prisma_collector.PrismaDocumentCollector(build_section_from_onlaw_api.PRISMA_ENDPOINT, file_collector,
+                                                                 metrics=metrics)
+    try:
+        with metrics, work_manifest.WorkManifest(manifest_path(arguments.base_save_name)) as manifest:
+            async with file_collector, prisma_collector_:
+                if command == 'plan':
+                    range_size: int = arguments.range_size
+                    if range_size is None:
+                        estimate = await prisma_collector_.estimate_build(document_type=arguments.document_type,
+                                                                          query_filters=arguments.query_filters)
+                        logger.info(f'{estimate}')
+                        range_size = estimate.suggested_range_size
+                    with near_duplicates.NearDuplicateIndex(near_duplicate_index_path()) as near_duplicate_index:
+                        await plan_build(prisma_collector_, manifest, arguments.query_filters, arguments.base_save_name,
+                                         arguments.output_format, range_size, arguments.document_type,
+                                         near_duplicate_index=near_duplicate_index)
+                else:
+                    # workers share the index through sqlite's locking like the manifest
+                    with near_duplicates.NearDuplicateIndex(near_duplicate_index_path()) as near_duplicate_index:
+                        await work(prisma_collector_, manifest, worker, lease_seconds=arguments.lease_seconds,
+                                   strip_workers=arguments.strip_workers, metrics=metrics,
+                                   near_duplicate_index=near_duplicate_index)
+    finally:
+        shutil.rmtree(spool_path, ignore_errors=True)
+
+
+def run_worker(arguments: argparse.Namespace):
+    asyncio.run(run_with_collectors('work', arguments, worker=f'{socket.gethostname()}-{os.getpid()}'))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('command', choices=['plan', 'work', 'status', 'merge'])
+    arg_parser.add_argument('--base-save-name', default='skat')
+    arg_parser.add_argument('--query-filter', dest='query_filters', action='append', help='plan: prisma where filter, '
+                            'may be repeated. Defaults to url_contains: "skat"')
+    arg_parser.add_argument('--document-type', choices=sorted(build_section_from_onlaw_api.DOCUMENT_QUERIES),
+                            default='verdict', help='plan: prisma type of the documents')
+    arg_parser.add_argument('--output-format', choices=['shards', 'files'], default='shards', help='plan')
+    arg_parser.add_argument('--range-size', type=int, help='plan: documents per range, defaults to about 1GB of '
+                            'content files per range, estimated from the object sizes in gcloud storage')
+    arg_parser.add_argument('--processes', type=int, default=1, help='work: worker processes on this machine')
+    arg_parser.add_argument('--strip-workers', type=int, help='work: html stripping processes per worker, '
+                            'defaults to the number of cpus divided by --processes')
+    arg_parser.add_argument('--lease-seconds', type=float, default=600.0,
+                            help='work: a range whose worker has not been heard of for this long is built again')
+    arguments = arg_parser.parse_args()
+    arguments.query_filters = arguments.query_filters or ['url_contains: "skat"']
+    arguments.strip_workers = arguments.strip_workers or max(1, (os.cpu_count() or 1) // arguments.processes)
+    os.makedirs(DATA_PATH, exist_ok=True)
+
+    if arguments.command == 'plan':
+        asyncio.run(run_with_collectors('plan', arguments))
+    elif arguments.command == 'work':
+        processes = [multiprocessing.Process(target=run_worker, args=(arguments,)) for _ in range(arguments.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        if any(process.exitcode for process in processes):
+            sys.exit(1)
+    else:
+        with work_manifest.WorkManifest(manifest_path(arguments.base_save_name)) as manifest:
+            if arguments.command == 'merge':
+                merge(manifest)
+            print(manifest.progress())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+from typing import Any, AsyncGenerator, AsyncIterable, Callable, List, Optional
+from concurrent.futures import Executor
+import asyncio
+import time
+import logging
+
+
+class Stage:
+    def __init__(self, name: str, function: Callable[[Any], Any], workers: int = 1, executor: Optional[Executor] = None):
+        """function: called with each item, its return value is passed on to the next stage. Returning None drops
+            the item. With an executor it must be a plain (picklable, for process pools) function, without one it
+            may also be a coroutine function.
+        workers: number of items this stage works on at the same time
+        """
+        if workers < 1:
+            raise ValueError(f'stage "{name}" needs at least one worker, got {workers}')
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.executor = executor
+        self.processed: int = 0
+        self.busy_seconds: float = 0.0
+
+    async def __call__(self, item: Any) -> Any:
+        started_at: float = time.monotonic()
+        if self.executor is not None:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, self.function, item)
+        elif asyncio.iscoroutinefunction(self.function):
+            result = await self.function(item)
+        else:
+            result = self.function(item)
+        self.busy_seconds += time.monotonic() - started_at
+        self.processed += 1
+
+        return result
+
+    def stats(self) -> dict:
+        return {'stage': self.name, 'workers': self.workers, 'processed': self.processed,
+                'busy_seconds': round(self.busy_seconds, 3)}
+
+
+class StagedPipeline:
+    """Runs items through a chain of stages connected by bounded queues.
+
+    Every stage works concurrently with the others, so e.g. downloading, html stripping in a process pool and
+    writing in a thread pool overlap. A full queue makes the stage in front of it wait (backpressure), which also
+    stops the source from being consumed faster than the slowest stage.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 100):
+        if not stages:
+            raise ValueError('a pipeline needs at least one stage')
+        self.logger = logging.getLogger(__name__)
+        self.stages = stages
+        self.queue_size = queue_size
+
+    async def run(self, source: AsyncIterable) -> AsyncGenerator:
+        """yields the output of the last stage. Output order is not preserved."""
+        run = _PipelineRun(self.stages, self.queue_size)
+        run.start(source)
+        try:
+            while True:
+                result = await run.output_queue.get()
+                if result is _END_OF_STREAM:
+                    break
+                if isinstance(result, _Failure):
+                    raise result.exception
+                yield result
+        finally:
+            run.cancel()
+            for stage in self.stages:
+                self.logger.info(f'pipeline stage: {stage.stats()}')
+
+
+class _PipelineRun:
+    """the queues and tasks of one StagedPipeline.run"""
+
+    def __init__(self, stages: List[Stage], queue_size: int):
+        self.stages = stages
+        self.queues: List[asyncio.Queue] = [asyncio.Queue(queue_size) for _ in range(len(stages) + 1)]
+        self.workers_left: List[int] = [stage.workers for stage in stages]
+        self.output_queue: asyncio.Queue = self.queues[-1]
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self, source: AsyncIterable):
+        self.tasks.append(asyncio.create_task(self._feed(source)))
+        for stage_index, stage in enumerate(self.stages):
+            self.tasks.extend(asyncio.create_task(self._work(stage_index)) for _ in range(stage.workers))
+        for task in self.tasks:
+            task.add_done_callback(self._on_task_done)
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def _feed(self, source: AsyncIterable):
+        async for item in source:
+            await self.queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            await self.queues[0].put(_END_OF_STREAM)
+
+    async def _work(self, stage_index: int):
+        stage: Stage = self.stages[stage_index]
+        in_queue: asyncio.Queue = self.queues[stage_index]
+        out_queue: asyncio.Queue = self.queues[stage_index + 1]
+        while True:
+            item = await in_queue.get()
+            if item is _END_OF_STREAM:
+                break
+            result = await stage(item)
+            if result is not None:
+                await out_queue.put(result)
+
+        self.workers_left[stage_index] -= 1
+        if self.workers_left[stage_index] == 0:
+            # every worker of the next stage, or the consumer, gets its own end of stream
+            next_workers: int = self.stages[stage_index + 1].workers if stage_index + 1 < len(self.stages) else 1
+            for _ in range(next_workers):
+                await out_queue.put(_END_OF_STREAM)
+
+    def _on_task_done(self, task: asyncio.Task):
+        if task.cancelled() or task.exception() is None:
+            return
+        self.cancel()
+        # the consumer may be waiting on an empty queue, make sure it wakes up to the error
+        while not self.output_queue.empty():
+            self.output_queue.get_nowait()
+        self.output_queue.put_nowait(_Failure(task.exception()))
+
+
+class _Failure:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+_END_OF_STREAM = object()
@@ -0,0 +1,155 @@
+from typing import Iterable, List, NamedTuple, Optional
+import json
+import sqlite3
+import threading
+import time
+
+
+class WorkRange(NamedTuple):
+    """documents with after_id < id <= last_id, numbered from first_doc_number on"""
+    range_id: int
+    after_id: Optional[str]
+    last_id: str
+    first_doc_number: int
+    documents: int
+
+
+class WorkManifest:
+    """Queue of the id ranges of a partitioned build, kept in sqlite so any number of workers can share it.
+
+    The planner stores the ranges, workers claim one at a time, build it and mark it done. A claim is a lease: a worker
+    that stops renewing it (heartbeat) for lease_seconds, e.g. because it crashed, loses the range to the next worker
+    that asks. Claiming takes sqlite's write lock, so workers on several machines need the manifest on a file system
+    with working POSIX locks, which rules out some network file systems.
+
+    Thread safe, e.g. a worker renews its lease from an executor thread while it builds.
+    """
+
+    def __init__(self, manifest_path: str, timeout: float = 60.0):
+        self.manifest_path = manifest_path
+        # transactions are explicit, see _transaction. The connection is shared by the threads of a worker, _lock
+        # keeps them from using it at the same time
+        self.connection = sqlite3.connect(manifest_path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS work_ranges (
+                range_id INTEGER PRIMARY KEY,
+                after_id TEXT,
+                last_id TEXT NOT NULL,
+                first_doc_number INTEGER NOT NULL,
+                documents INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                claimed_at REAL,
+                built INTEGER,
+                failed INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS work_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+
+    def __enter__(self) -> 'WorkManifest':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    def plan(self, ranges: Iterable[WorkRange], settings: dict):
+        """replaces the plan. settings: what every worker needs to know to build a range, e.g. the query filters"""
+        with self._transaction():
+            self.connection.execute('DELETE FROM work_ranges')
+            self.connection.execute('DELETE FROM work_settings')
+            self.connection.executemany('INSERT INTO work_ranges (range_id, after_id, last_id, first_doc_number, documents) '
+                                        'VALUES (?, ?, ?, ?, ?)', ranges)
+            self.connection.executemany('INSERT INTO work_settings (key, value) VALUES (?, ?)',
+                                        [(key, json.dumps(value)) for key, value in settings.items()])
+
+    @property
+    def settings(self) -> dict:
+        with self._lock:
+            rows: list = self.connection.execute('SELECT key, value FROM work_settings').fetchall()
+
+        return {key: json.loads(value) for key, value in rows}
+
+    def claim(self, worker: str, lease_seconds: float = 600.0) -> Optional[WorkRange]:
+        """the next pending range, or one whose lease expired. None once every range is done or claimed"""
+        now: float = time.time()
+        with self._transaction():
+            row = self.connection.execute(
+                "SELECT range_id, after_id, last_id, first_doc_number, documents FROM work_ranges "
+                "WHERE status = 'pending' OR (status = 'claimed' AND claimed_at < ?) ORDER BY range_id LIMIT 1",
+                (now - lease_seconds,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE work_ranges SET status = 'claimed', worker = ?, claimed_at = ? WHERE range_id = ?",
+                                    (worker, now, row[0]))
+
+        return WorkRange(*row)
+
+    def heartbeat(self, range_id: int, worker: str) -> bool:
+        """renews the lease, returns False if the range was meanwhile claimed by another worker"""
+        with self._transaction():
+            updated: int = self.connection.execute(
+                "UPDATE work_ranges SET claimed_at = ? WHERE range_id = ? AND worker = ? AND status = 'claimed'",
+                (time.time(), range_id, worker)).rowcount
+
+        return updated == 1
+
+    def done(self, range_id: int, worker: str, built: int, failed: int):
+        with self._transaction():
+            self.connection.execute("UPDATE work_ranges SET status = 'done', built = ?, failed = ? WHERE range_id = ? AND worker = ?",
+                                    (built, failed, range_id, worker))
+
+    def release(self, range_id: int, worker: str):
+        """gives a range back, e.g. after an error, so another worker can claim it right away"""
+        with self._transaction():
+            self.connection.execute("UPDATE work_ranges SET status = 'pending', worker = NULL, claimed_at = NULL "
+                                    "WHERE range_id = ? AND worker = ? AND status = 'claimed'", (range_id, worker))
+
+    def ranges(self) -> List[WorkRange]:
+        with self._lock:
+            return [WorkRange(*row) for row in self.connection.execute(
+                'SELECT range_id, after_id, last_id, first_doc_number, documents FROM work_ranges ORDER BY range_id')]
+
+    def progress(self) -> dict:
+        """number of ranges per status, plus the documents built and failed so far"""
+        progress: dict = {'pending': 0, 'claimed': 0, 'done': 0}
+        with self._lock:
+            progress.update(self.connection.execute('SELECT status, COUNT(*) FROM work_ranges GROUP BY status').fetchall())
+            built, failed = self.connection.execute(
+                "SELECT SUM(built), SUM(failed) FROM work_ranges WHERE status = 'done'").fetchone()
+        progress.update({'built': built or 0, 'failed': failed or 0})
+
+        return progress
+
+    def _transaction(self) -> '_ImmediateTransaction':
+        return _ImmediateTransaction(self.connection, self._lock)
+
+
+class _ImmediateTransaction:
+    """BEGIN IMMEDIATE takes the write lock up front, so two workers can never read the same pending range. lock is
+    held for the whole transaction, so the threads sharing the connection do not interleave theirs"""
+
+    def __init__(self, connection: sqlite3.Connection, lock: threading.RLock):
+        self.connection = connection
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.connection.execute('BEGIN IMMEDIATE')
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        finally:
+            self.lock.release()
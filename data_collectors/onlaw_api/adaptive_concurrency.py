@@ -0,0 +1,147 @@
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+import asyncio
+import collections
+import logging
+import random
+import time
+import aiohttp
+
+T = TypeVar('T')
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+def is_retryable(exception: BaseException) -> bool:
+    if isinstance(exception, aiohttp.ClientResponseError):
+        return exception.status in RETRYABLE_STATUSES
+    return isinstance(exception, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+
+class AdaptiveLimiter:
+    """Limits the requests in flight to one endpoint and adapts the limit AIMD style.
+
+    Every successful request raises the limit by 1/limit, i.e. by about one per round of requests. An overload signal
+    (429/5xx, timeout, dropped connection), or optionally a latency well above the recent best of its kind of request
+    (see LatencyBaseline), halves it, at most once per smoothed latency so one burst of errors counts once. The limit
+    stays within [minimum, maximum].
+    """
+
+    def __init__(self, name: str, initial: int = 16, minimum: int = 1, maximum: int = 300,
+                 decrease_factor: float = 0.5, latency_tolerance: Optional[float] = None,
+                 retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 30.0, baseline_window: int = 100):
+        """latency_tolerance: if set, a smoothed latency above latency_tolerance times the lowest one of the last
+            baseline_window requests of the same kind counts as overload. Only useful when requests of a kind are of
+            similar size, e.g. prisma pages of one query, not files of any size.
+        retries, backoff_base, backoff_max: see call"""
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.limit: float = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.baseline_window = baseline_window
+
+        self.in_flight: int = 0
+        self.requests: int = 0
+        self.errors: int = 0
+        self.retried: int = 0
+        self.smoothed_latency: Optional[float] = None
+        self.baselines: Dict[str, LatencyBaseline] = {}
+        self._last_decrease_at: float = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+
+    async def call(self, request: Callable[[], Awaitable[T]], kind: str = '') -> T:
+        """awaits request() inside the limit. Retryable errors are retried up to `retries` times after a full jitter
+        exponential backoff: a random delay between 0 and min(backoff_max, backoff_base * 2 ** attempt).
+        kind: requests of different cost, e.g. counts and pages, are compared with their own latency baseline"""
+        attempt: int = 0
+        while True:
+            try:
+                return await self._call_once(request, kind)
+            except Exception as e:
+                if attempt >= self.retries or not is_retryable(e):
+                    raise
+                delay: float = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                self.retried += 1
+                self.logger.warning(f'{self.name}: retrying after {type(e).__name__} {e} in {delay:.2f}s (attempt {attempt + 1})')
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _call_once(self, request: Callable[[], Awaitable[T]], kind: str) -> T:
+        if self._condition is None:  # created here so it belongs to the running event loop
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+        started_at: float = time.monotonic()
+        try:
+            result: T = await request()
+        except Exception as e:
+            if is_retryable(e):
+                self.errors += 1
+                self._decrease(type(e).__name__)
+            raise
+        else:
+            self._on_success(time.monotonic() - started_at, kind)
+        finally:
+            self.requests += 1
+            async with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+        return result
+
+    def stats(self) -> dict:
+        return {'endpoint': self.name, 'limit': int(self.limit), 'requests': self.requests, 'errors': self.errors,
+                'retried': self.retried,
+                'smoothed_latency': round(self.smoothed_latency, 4) if self.smoothed_latency is not None else None}
+
+    def _on_success(self, latency: float, kind: str):
+        self.smoothed_latency = latency if self.smoothed_latency is None else 0.9 * self.smoothed_latency + 0.1 * latency
+        baseline: LatencyBaseline = self.baselines.setdefault(kind, LatencyBaseline(self.baseline_window))
+        baseline.add(latency)
+
+        if self.latency_tolerance is not None and baseline.smoothed > self.latency_tolerance * baseline.lowest:  # type: ignore
+            self._decrease(f'latency {baseline.smoothed:.3f}s of {kind or "requests"}')
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def _decrease(self, reason: str):
+        now: float = time.monotonic()
+        if now - self._last_decrease_at < (self.smoothed_latency or 0.0):
+            return
+        self._last_decrease_at = now
+        self.limit = max(self.minimum, self.limit * self.decrease_factor)
+        self.logger.info(f'{self.name}: lowered concurrency to {int(self.limit)} ({reason})')
+
+
+class LatencyBaseline:
+    """The smoothed latency of one kind of request and the lowest it has been over the last `window` requests.
+
+    A minimum over all time would never recover once a kind of request got slower for good, e.g. larger pages, and
+    every later request would count as overload.
+    """
+
+    def __init__(self, window: int = 100):
+        self.window = window
+        self.smoothed: Optional[float] = None
+        self.samples: int = 0
+        # (sample number, smoothed latency) with increasing latencies, the first is the minimum of the window
+        self._minima: Deque[Tuple[int, float]] = collections.deque()
+
+    def add(self, latency: float):
+        self.smoothed = latency if self.smoothed is None else 0.9 * self.smoothed + 0.1 * latency
+        self.samples += 1
+        while self._minima and self._minima[-1][1] >= self.smoothed:
+            self._minima.pop()
+        self._minima.append((self.samples, self.smoothed))
+        if self._minima[0][0] <= self.samples - self.window:
+            self._minima.popleft()
+
+    @property
+    def lowest(self) -> float:
+        return self._minima[0][1]
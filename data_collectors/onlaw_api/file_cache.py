@@ -0,0 +1,108 @@
+from typing import Optional
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+
+class DiskCache:
+    """Content addressed file cache with a size budget and least-recently-used eviction.
+
+    Keys should change whenever the content does, e.g. bucket/object name plus gcloud generation and md5, so stale
+    entries are never returned and simply age out. Writes go to a temporary file which is renamed into place, so a
+    crashed build never leaves a partial entry behind. Last use is kept in the file mtime, which survives restarts.
+    """
+
+    def __init__(self, cache_path: str, max_bytes: int = 10 * 1024 ** 3):
+        self.logger = logging.getLogger(__name__)
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()  # entry path -> size, least recently used first
+        self._size: int = 0
+
+        os.makedirs(cache_path, exist_ok=True)
+        self._load_entries()
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry_path: str = self._entry_path(key)
+        try:
+            with open(entry_path, 'rb') as fp:
+                data: bytes = fp.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if entry_path in self._entries:
+                self._entries.move_to_end(entry_path)
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:  # evicted meanwhile, the data read is still valid
+            pass
+
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        entry_path: str = self._entry_path(key)
+        entry_folder: str = os.path.dirname(entry_path)
+        os.makedirs(entry_folder, exist_ok=True)
+
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=entry_folder, prefix='.tmp-')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            self._size += len(data) - self._entries.pop(entry_path, 0)
+            self._entries[entry_path] = len(data)
+            self._evict()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self._size}
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            entry_path, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.unlink(entry_path)
+            except FileNotFoundError:
+                pass
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_path, key[:2], key)
+
+    def _load_entries(self):
+        entries = []
+        for folder in os.scandir(self.cache_path):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.startswith('.tmp-'):  # left behind by an interrupted write
+                    os.unlink(entry.path)
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+
+        for _, entry_path, size in sorted(entries):
+            self._entries[entry_path] = size
+            self._size += size
+        self._evict()
+        self.logger.info(f'file cache at {self.cache_path} holds #{len(self._entries)} files, {self._size} bytes')
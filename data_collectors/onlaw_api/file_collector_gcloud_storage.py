@@ -1,15 +1,63 @@
 import os
 import asyncio
+import contextlib
+import tempfile
+import types
+from urllib.parse import quote
 import aiohttp
 from gcloud.aio.storage import Storage
-from typing import List, Dict
+from typing import List, Dict, Optional
 import logging
+
+import sys
+this_file_path = os.path.dirname(os.path.abspath(__file__))  # get directory of this file
+sys.path.append(this_file_path + '/..')
+from data_collectors import http_session
+from data_collectors import file_cache
+from data_collectors import adaptive_concurrency
 ListOfFiles = List[Dict]
+BINARY_CONTENT_TYPES = ('application/octet-stream', 'application/pdf')
+STORAGE_API_ROOT = 'https://storage.googleapis.com/storage/v1/b'
+
+
+class SpooledFile:
+    """content of a large binary object that was streamed to a local file instead of being kept in memory.
+    Whoever consumes it is responsible for calling remove()."""
+
+    def __init__(self, path: str, size: int, content_type: str):
+        self.path = path
+        self.size = size
+        self.content_type = content_type
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self) -> str:
+        return f'SpooledFile({self.path!r}, size={self.size}, content_type={self.content_type!r})'
 
 
 class GcloudStorageFileCollector:
 
-    def __init__(self):
+    def __init__(self, tcp_connections=110, tcp_connections_per_host=100,
+                 cache_path: Optional[str] = None, cache_max_bytes: int = 10 * 1024 ** 3,
+                 spool_path: Optional[str] = None, spool_threshold_bytes: int = 8 * 1024 ** 2,
+                 spool_chunk_bytes: int = 1024 ** 2, metrics=None, session: Optional[aiohttp.ClientSession] = None):
+        """Use as `async with GcloudStorageFileCollector() as file_collector:` to download all files through one
+        pooled session. Outside of a context the session passed to collect_file is used.
+
+        cache_path: keep downloaded files on local disk, keyed by object name, generation and md5, so unchanged
+            objects are not downloaded again on the next build. Least recently used files are removed once the cache
+            grows beyond cache_max_bytes. Defaults to the GCLOUD_STORAGE_CACHE_PATH env var, if set.
+        spool_path: pdf/octet-stream objects larger than spool_threshold_bytes (or of unknown size) are streamed to a
+            file in this folder in chunks of spool_chunk_bytes, and collect_file returns a SpooledFile instead of
+            bytes. Keeps memory flat no matter how large the objects are. Spooled objects bypass the cache.
+        metrics: an instrumentation.run_metrics.RunMetrics, records the stages gcs_list, gcs_metadata, gcs_download
+            and gcs_cache_lookup. Latencies include waiting for the concurrency limit and retries.
+        session: a pooled session shared with other collectors, used instead of one of its own and left open
+        """
         self.logger = logging.getLogger(__name__)
         self.logger.debug('instantiating FileCollector')
         os_env_vars = os.environ
@@ -19,34 +67,195 @@ class GcloudStorageFileCollector:
             self.credentials_file = os_env_vars['GCLOUD_STORAGE_CREDENTIALS']
         except KeyError as e:
             raise KeyError('required env var: "{}" not set'.format(e.args[0]))
+        self.tcp_connections = tcp_connections
+        self.tcp_connections_per_host = tcp_connections_per_host
         self.storage_object = None
+        self.session: Optional[aiohttp.ClientSession] = session
+        self._owns_session: bool = session is None
+        cache_path = cache_path or os_env_vars.get('GCLOUD_STORAGE_CACHE_PATH')
+        self.cache: Optional[file_cache.DiskCache] = file_cache.DiskCache(cache_path, cache_max_bytes) if cache_path else None
+        self.object_metadata: Dict[str, dict] = {}  # object name -> gcloud object metadata, see load_object_metadata
+        # requests in flight grow until gcloud answers 429/5xx or times out, never beyond the connection pool
+        self.limiter = adaptive_concurrency.AdaptiveLimiter('gcloud storage', maximum=tcp_connections_per_host or tcp_connections)
+        self.spool_path = spool_path
+        self.spool_threshold_bytes = spool_threshold_bytes
+        self.spool_chunk_bytes = spool_chunk_bytes
+        self.metrics = metrics
+        self.api_root: str = STORAGE_API_ROOT  # of the requests made without the storage object, i.e. spooled downloads
+        if spool_path is not None:
+            os.makedirs(spool_path, exist_ok=True)
         self.logger.debug('Done instantiating FileCollector')
 
+    async def __aenter__(self) -> 'GcloudStorageFileCollector':
+        if self.session is None:
+            self.session = http_session.create_pooled_session(self.tcp_connections, self.tcp_connections_per_host)
+            self.storage_object = None
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.logger.info(f'gcloud storage requests: {self.limiter.stats()}')
+        if self.cache is not None:
+            self.logger.info(f'file cache: {self.cache.stats()}')
+        if self.session is not None and self._owns_session:
+            await self.session.close()
+            self.session = None
+            self.storage_object = None
+
     def _instantiate_storage_object(self):
-        self.storage_object = Storage(service_file=self.credentials_file)
+        # the storage object also refreshes its access token through this session
+        self.storage_object = Storage(service_file=self.credentials_file, session=self.session)
+
+    async def load_object_metadata(self, prefix: str = '', session: Optional[aiohttp.ClientSession] = None,
+                                   timeout=1000) -> int:
+        """lists the bucket (1000 objects per request) and keeps name, contentType, generation, md5Hash and size of
+        every object under prefix in memory. collect_file then needs a single request per file instead of two.
+        Returns the number of objects listed."""
+        if not self.storage_object:
+            self._instantiate_storage_object()
+        session = self.session or session
+
+        params: Dict[str, str] = {'prefix': prefix, 'maxResults': '1000',
+                                  'fields': 'items(name,contentType,generation,md5Hash,size),nextPageToken'}
+        number_of_objects: int = 0
+        while True:
+            with self._timed('gcs_list') as observation:
+                response: dict = await self.limiter.call(
+                    lambda: self.storage_object.list_objects(self.bucket, params=dict(params), session=session, timeout=timeout))
+                observation.documents = len(response.get('items', []))
+            for item in response.get('items', []):
+                self.object_metadata[item['name']] = item
+                number_of_objects += 1
+
+            if not response.get('nextPageToken'):
+                break
+            params['pageToken'] = response['nextPageToken']
+
+        self.logger.info(f'loaded metadata of #{number_of_objects} objects with prefix "{prefix}"')
+
+        return number_of_objects
 
     async def collect_file(self, file_name: str, file_id: str,
-                           session: aiohttp.ClientSession, timeout=1000) -> tuple:
+                           session: Optional[aiohttp.ClientSession] = None, timeout=1000,
+                           content_type: Optional[str] = None) -> tuple:
+        """content_type: e.g. from prisma file metadata. When it is given, or the object metadata was loaded with
+        load_object_metadata, the object metadata is not requested separately"""
         if not self.storage_object:
             self._instantiate_storage_object()
 
-        metadata_task = \
-            asyncio.create_task(self.storage_object.download_metadata(self.bucket, file_name,
-                                                                      session=session,
-                                                                      timeout=timeout))
-        data_task = asyncio.create_task(self.storage_object.download(self.bucket, file_name, session=session, timeout=timeout))
+        if self.session is not None:
+            session = self.session
+
+        metadata: Optional[dict] = self.object_metadata.get(file_name)
+        if self.spool_path is not None:
+            if metadata is None and content_type is None:
+                metadata = await self._download_metadata(file_name, session, timeout)
+            spooled_file: Optional[SpooledFile] = await self._spool_if_large(
+                file_name, content_type or metadata['contentType'], metadata, session, timeout)  # type: ignore
+            if spooled_file is not None:
+                return (file_id, spooled_file)
+
+        data_bytes, metadata = await self._download_with_metadata(file_name, metadata, content_type, session, timeout)
 
-        metadata = await metadata_task
-        data_bytes = await data_task
+        return (file_id, self._decode(data_bytes, content_type or metadata['contentType']))  # type: ignore
 
-        content_type = metadata['contentType']
+    async def _spool_if_large(self, file_name: str, content_type: str, metadata: Optional[dict],
+                              session: Optional[aiohttp.ClientSession], timeout) -> Optional[SpooledFile]:
+        """the object streamed to a spool file, or None if it is small enough to be kept in memory"""
+        if not self._should_spool(content_type, metadata):
+            return None
+        with self._timed('gcs_download') as observation:
+            spooled_file: SpooledFile = await self.limiter.call(
+                lambda: self._download_to_spool(file_name, content_type, session, timeout))
+            observation.bytes = spooled_file.size
 
+        return spooled_file
+
+    async def _download_with_metadata(self, file_name: str, metadata: Optional[dict], content_type: Optional[str],
+                                      session: Optional[aiohttp.ClientSession], timeout) -> tuple:
+        """the object's bytes, and its metadata if it is needed: for the cache key or the content type"""
+        if self.cache is not None:
+            if metadata is None:
+                metadata = await self._download_metadata(file_name, session, timeout)
+            return await self._download_with_cache(file_name, metadata, session, timeout), metadata  # type: ignore
+        if metadata is None and content_type is None:
+            metadata_task = asyncio.create_task(self._download_metadata(file_name, session, timeout))
+            data_task = asyncio.create_task(self._download(file_name, session, timeout))
+            metadata = await metadata_task
+            return await data_task, metadata
+
+        return await self._download(file_name, session, timeout), metadata
+
+    @staticmethod
+    def _decode(data_bytes: bytes, content_type: str):
         if content_type in ('text/html', 'text/html; charset=utf-8', 'text/plain; charset=utf-8', 'text/plain'):
-            content = data_bytes.decode('utf-8')
-        elif content_type in ('application/octet-stream', 'application/pdf'):
-            content = data_bytes
-        else:
-            err_str = 'Do not know how to handle contentType: "{}"'.format(content_type)
-            raise TypeError(err_str)
-
-        return (file_id, content)
+            return data_bytes.decode('utf-8')
+        if content_type in BINARY_CONTENT_TYPES:
+            return data_bytes
+
+        err_str = 'Do not know how to handle contentType: "{}"'.format(content_type)
+        raise TypeError(err_str)
+
+    async def _download_with_cache(self, file_name: str, metadata: dict,
+                                   session: Optional[aiohttp.ClientSession], timeout) -> bytes:
+        cache_key: str = self.cache.key(self.bucket, file_name, str(metadata.get('generation')), str(metadata.get('md5Hash')))
+
+        loop = asyncio.get_running_loop()
+        with self._timed('gcs_cache_lookup') as observation:
+            data_bytes: Optional[bytes] = await loop.run_in_executor(None, self.cache.get, cache_key)
+            # documents counts the hits
+            observation.documents, observation.bytes = (0, 0) if data_bytes is None else (1, len(data_bytes))
+        if data_bytes is None:
+            data_bytes = await self._download(file_name, session, timeout)
+            await loop.run_in_executor(None, self.cache.put, cache_key, data_bytes)
+
+        return data_bytes
+
+    async def _download(self, file_name: str, session: Optional[aiohttp.ClientSession], timeout) -> bytes:
+        with self._timed('gcs_download') as observation:
+            data_bytes: bytes = await self.limiter.call(
+                lambda: self.storage_object.download(self.bucket, file_name, session=session, timeout=timeout))
+            observation.bytes = len(data_bytes)
+
+        return data_bytes
+
+    async def _download_metadata(self, file_name: str, session: Optional[aiohttp.ClientSession], timeout) -> dict:
+        with self._timed('gcs_metadata'):
+            return await self.limiter.call(lambda: self.storage_object.download_metadata(self.bucket, file_name, session=session, timeout=timeout))
+
+    def _timed(self, stage: str):
+        """metrics.timed(stage), or a block that records nothing without metrics"""
+        return self.metrics.timed(stage) if self.metrics is not None else contextlib.nullcontext(types.SimpleNamespace())
+
+    def _should_spool(self, content_type: str, metadata: Optional[dict]) -> bool:
+        if content_type not in BINARY_CONTENT_TYPES:
+            return False
+        if metadata is None or 'size' not in metadata:
+            return True
+
+        return int(metadata['size']) > self.spool_threshold_bytes
+
+    async def _download_to_spool(self, file_name: str, content_type: str,
+                                 session: Optional[aiohttp.ClientSession], timeout) -> SpooledFile:
+        token: str = await self.storage_object.token.get()
+        url: str = f'{self.api_root}/{quote(self.bucket, safe="")}/o/{quote(file_name, safe="")}'
+        session = session or self.session
+
+        file_descriptor, spool_file_path = tempfile.mkstemp(dir=self.spool_path, suffix='.pdf' if content_type == 'application/pdf' else '')
+        size: int = 0
+        loop = asyncio.get_running_loop()
+        try:
+            with os.fdopen(file_descriptor, 'wb') as fp:
+                async with session.get(url, params={'alt': 'media'}, headers={'Authorization': f'Bearer {token}'},  # type: ignore
+                                       timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(self.spool_chunk_bytes):
+                        # a chunk is up to a megabyte, written in a thread so a slow disk does not hold up the event loop
+                        await loop.run_in_executor(None, fp.write, chunk)
+                        size += len(chunk)
+        except BaseException:
+            os.unlink(spool_file_path)
+            raise
+
+        self.logger.debug(f'spooled {file_name} ({size} bytes) to {spool_file_path}')
+
+        return SpooledFile(spool_file_path, size, content_type)
@@ -0,0 +1,20 @@
+import aiohttp
+
+
+def create_pooled_session(tcp_connections: int = 110,
+                          tcp_connections_per_host: int = 100,
+                          keepalive_timeout: float = 60,
+                          dns_cache_ttl: int = 300) -> aiohttp.ClientSession:
+    """ClientSession backed by a connector meant to live for a whole build.
+
+    Connections are kept alive between requests, DNS lookups are cached for dns_cache_ttl seconds and
+    tcp_connections_per_host keeps one slow host (e.g. prisma) from starving the other (e.g. gcloud storage).
+    Must be called from a running event loop.
+    """
+    connector = aiohttp.TCPConnector(limit=tcp_connections,
+                                     limit_per_host=tcp_connections_per_host,
+                                     keepalive_timeout=keepalive_timeout,
+                                     use_dns_cache=True,
+                                     ttl_dns_cache=dns_cache_ttl)
+
+    return aiohttp.ClientSession(connector=connector)
@@ -1,31 +1,61 @@
-from typing import AsyncGenerator, List, Optional
+from typing import AsyncGenerator, AsyncIterable, List, NamedTuple, Optional, Union
+from contextlib import asynccontextmanager, nullcontext
 from datetime import datetime
 from dateutil import parser
 import asyncio
+import functools
+import types
 import aiohttp
 import jwt
-from prisma_helpers import prisma_helpers
+from prisma_helpers import prisma_query_builders
 
 import sys
 import os
 this_file_path = os.path.dirname(os.path.abspath(__file__))  # get directory of this file
 sys.path.append(this_file_path + '/..')
+from data_collectors import adaptive_concurrency
 from data_collectors import graphql_connection
+from data_collectors import http_session
+from data_collectors import prisma_queries
+from data_collectors import sliding_window
 
 import logging
 
 
+class BuildEstimate(NamedTuple):
+    """what a build of the documents matching a filter amounts to, see PrismaDocumentCollector.estimate_build"""
+    documents: int
+    estimated_bytes: int  # of the content files, as stored in gcloud storage
+    documents_without_size: int  # their size is estimated as the mean size of the others
+    suggested_shards: int  # upper bound, shards hold compressed text
+    suggested_page_size: int
+    suggested_range_size: int  # for builders/partitioned_build.py
+
+
 class PrismaDocumentCollector:
+    # documents per query of documents(stream=False), as prisma_helpers.all_of_type pages them
+    METADATA_PAGE_SIZE = 1000
 
     def __init__(self, endpoint: str, file_collector,
-                 token: str = None, tcp_connections=110, concurrent_files_collected=300):
-        """query_filter: determines which laws are collected. e.g. only non-historic.."""
+                 token: str = None, tcp_connections=110, concurrent_files_collected=300,
+                 tcp_connections_per_host=100, metrics=None, session: Optional[aiohttp.ClientSession] = None):
+        """query_filter: determines which laws are collected. e.g. only non-historic..
+
+        Use as `async with PrismaDocumentCollector(...) as collector:` to keep one connection pool warm for all
+        calls. Outside of a context each call opens and closes its own session.
+
+        metrics: an instrumentation.run_metrics.RunMetrics, records every prisma query as the stage prisma_metadata
+        session: a pooled session (see http_session) shared with other collectors, used instead of one of its own and
+            left open, whoever created it closes it
+        """
         self.logger = logging.getLogger(__name__)
         self.logger.debug('starting PrismaDocumentCollector constructor')
         self.endpoint: str = endpoint
         self.file_collector = file_collector
         self.tcp_connections = tcp_connections
+        self.tcp_connections_per_host = tcp_connections_per_host
         self.concurrent_files_collected = concurrent_files_collected
+        self.metrics = metrics
         if token is None:
             self.logger.info('prisma token not set. aquiring token...')
             self.token = self.get_prisma_token()
@@ -33,22 +63,107 @@ class PrismaDocumentCollector:
         else:
             self.token = token
 
-        self.session: aiohttp.ClientSession = None
+        self.session: aiohttp.ClientSession = session
+        self._owns_session: bool = session is None
+        # queries of a kind (see _query) are of similar size, so a growing latency also means prisma is overloaded
+        self.prisma_limiter = adaptive_concurrency.AdaptiveLimiter('prisma', maximum=tcp_connections_per_host or tcp_connections,
+                                                                   latency_tolerance=3.0)
+        self._object_metadata_lock: Optional[asyncio.Lock] = None
+        # documents whose content could not be collected, they are logged and left out instead of failing the run
+        self.failed_documents: List[dict] = []
         self.logger.debug('Done instantiating PrismaDocumentCollector')
 
-    async def count_laws(self) -> int:
-        return await self._count_record_for_type('law')
+    async def __aenter__(self) -> 'PrismaDocumentCollector':
+        if self.session is None:
+            self.session = http_session.create_pooled_session(self.tcp_connections, self.tcp_connections_per_host)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.session is not None and self._owns_session:
+            await self.session.close()
+            self.session = None
+        self.logger.info(f'prisma requests: {self.prisma_limiter.stats()}')
+        if self.failed_documents:
+            self.logger.warning(f'#{len(self.failed_documents)} documents failed')
+
+    @asynccontextmanager
+    async def _client_session(self):
+        if self.session is not None:
+            yield self.session
+        else:
+            async with http_session.create_pooled_session(self.tcp_connections, self.tcp_connections_per_host) as session:
+                yield session
+
+    async def _query(self, request, kind: str):
+        """awaits request(), a prisma query, inside the concurrency limit.
+        kind: queries of a kind cost about the same, e.g. 'count' or the pages of one document type"""
+        with self._timed('prisma_metadata') as observation:
+            result = await self.prisma_limiter.call(request, kind)
+            observation.documents = len(result) if isinstance(result, list) else 0
+
+        return result
+
+    def _timed(self, stage: str):
+        """metrics.timed(stage), or a block that records nothing without metrics"""
+        return self.metrics.timed(stage) if self.metrics is not None else nullcontext(types.SimpleNamespace())
+
+    async def count_laws(self, query_filter: str = '', query_filters: Optional[List[str]] = None) -> int:
+        return await self._count_record_for_type('law', self._join_query_filters(query_filter,
+                                                                                 self._build_query_filter(None, query_filters)))
+
+    async def count_verdicts(self, query_filter: str = '', query_filters: Optional[List[str]] = None,
+                             uids: List[str] = None) -> int:
+        """query_filter: prisma where filter, e.g. 'url_contains: "skat"'. query_filters and uids filter as in documents"""
+        return await self._count_record_for_type('verdict', self._join_query_filters(query_filter,
+                                                                                     self._build_query_filter(uids, query_filters)))
+
+    async def estimate_build(self, *, document_type: str, query_filters: Optional[List[str]] = None,
+                             uids: List[str] = None, max_shard_bytes: int = 256 * 1024 ** 2,
+                             range_bytes: int = 1024 ** 3, page_size: int = 1000) -> BuildEstimate:
+        """counts the matching documents and adds up the sizes of their content files, before any content is fetched.
+        Sizes come from the file collector's object metadata, which is loaded if it was not yet.
+        max_shard_bytes: see data_writers.sharded_corpus.ShardedCorpusWriter
+        range_bytes: content size a range of a partitioned build should have"""
+        if self._object_metadata_lock is None:
+            self._object_metadata_lock = asyncio.Lock()
+        # estimates of sections built at the same time share one listing of the bucket
+        async with self._object_metadata_lock:
+            object_metadata: dict = getattr(self.file_collector, 'object_metadata', {})
+            if not object_metadata and hasattr(self.file_collector, 'load_object_metadata'):
+                await self.file_collector.load_object_metadata()
+
+        documents: int = 0
+        known_bytes: int = 0
+        documents_without_size: int = 0
+        async for document in self.documents(query='contentFilesOriginal { name }', document_type=document_type,
+                                             query_filters=query_filters, uids=uids, metadata_only=True, stream=True,
+                                             page_size=page_size):
+            documents += 1
+            # a document without content files fails in the build (see _get_content_files), it must not fail the estimate
+            content_files: List[dict] = document.get('contentFilesOriginal') or []
+            size: Optional[str] = object_metadata.get(content_files[0]['name'], {}).get('size') if content_files else None
+            if size is None:
+                documents_without_size += 1
+            else:
+                known_bytes += int(size)
 
-    async def count_verdicts(self, query_filter: str = '') -> int:
-        return await self._count_record_for_type('verdict')
+        documents_with_size: int = documents - documents_without_size
+        mean_bytes: float = known_bytes / documents_with_size if documents_with_size else 0.0
+        estimated_bytes: int = known_bytes + int(documents_without_size * mean_bytes)
+
+        return BuildEstimate(documents=documents, estimated_bytes=estimated_bytes,
+                             documents_without_size=documents_without_size,
+                             suggested_shards=max(1, -(-estimated_bytes // max_shard_bytes)),
+                             suggested_page_size=max(1, min(page_size, documents)),
+                             suggested_range_size=max(1, min(documents, int(range_bytes / mean_bytes))) if mean_bytes else max(1, documents))
 
     async def _count_record_for_type(self, document_type: str, query_filter: str = '') -> int:
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.tcp_connections)) as session:
+        """query_filter: prisma where filter, without `where` and braces"""
+        async with self._client_session() as session:
             graphql_connection_ = graphql_connection.GraphQLConnection(session, self.endpoint, self.token)
 
-            return await prisma_helpers.count_of_type(graphql_connection_,
-                                                      gql_type=document_type,
-                                                      query_filter=query_filter)
+            return await self._query(lambda: prisma_queries.count_of_type(graphql_connection_, document_type, query_filter),
+                                     kind='count')
 
     async def get_date_of_latest_document(self) -> datetime:
         date_of_latest_law_update_str = await self._get_date_of_latest_document_from_prisma()
@@ -58,29 +173,118 @@ class PrismaDocumentCollector:
 
     async def documents(self, *, query: str,
                         document_type: str,
-                        offset: int,
+                        offset: int = 0,
                         limit: int = None,
                         metadata_only: bool = False,
                         query_filters: Optional[List[str]] = None,
-                        uids: List[str] = None) -> AsyncGenerator:
-        """async generator. see e.g. https://www.python.org/dev/peps/pep-0525/"""
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.tcp_connections)) as session:
-            document_metadata: List[dict] = await self._collect_document_metadata(session, query, document_type,
-                                                                                  offset=offset, limit=limit,
-                                                                                  query_filters=query_filters, uids=uids)
-            if metadata_only:
+                        uids: List[str] = None,
+                        stream: bool = False,
+                        page_size: int = 1000,
+                        ordered: bool = False,
+                        uid_batch_size: int = 500,
+                        failed_documents: Optional[List[dict]] = None) -> AsyncGenerator:
+        """async generator. see e.g. https://www.python.org/dev/peps/pep-0525/
+
+        stream: page through the whole filtered result set with an id cursor (`after:`) instead of a single
+            offset query. The next metadata page is fetched while the files of the current page download.
+        ordered: yield documents in metadata order instead of in the order their files finish downloading.
+        uid_batch_size: more uids than this are fetched in batches of uid_batch_size, see documents_by_uid. offset and
+            limit cannot be used then.
+        failed_documents: documents whose content could not be collected are appended to it as well as to
+            self.failed_documents, which is shared by all calls, e.g. of the sections of one build
+        """
+        if uids is not None and len(uids) > uid_batch_size:
+            if offset or limit is not None:
+                raise ValueError(f'offset and limit cannot be used with more than uid_batch_size ({uid_batch_size}) uids')
+            async for document in self.documents_by_uid(uids, query=query, document_type=document_type,
+                                                        metadata_only=metadata_only, query_filters=query_filters,
+                                                        ordered=ordered, uid_batch_size=uid_batch_size,
+                                                        failed_documents=failed_documents):
+                yield document
+            return
+
+        async with self._client_session() as session:
+            document_metadata: Union[List[dict], AsyncIterable[dict]]
+            if stream:
+                document_metadata = self._flatten_pages(
+                    self._stream_document_metadata(session, query, document_type, offset=offset, limit=limit,
+                                                   query_filters=query_filters, uids=uids, page_size=page_size))
+            else:
+                document_metadata = await self._collect_document_metadata(session, query, document_type,
+                                                                          offset=offset, limit=limit,
+                                                                          query_filters=query_filters, uids=uids)
+            if metadata_only and isinstance(document_metadata, list):
                 for document in document_metadata:
                     yield document
+            elif metadata_only:
+                async for document in document_metadata:
+                    yield document
+            else:
+                async for document in self._documents_with_content(session, document_metadata, ordered, failed_documents):
+                    yield document
+
+    async def documents_by_uid(self, uids: List[str], *, query: str, document_type: str, metadata_only: bool = False,
+                               query_filters: Optional[List[str]] = None, ordered: bool = False,
+                               uid_batch_size: int = 500, failed_documents: Optional[List[dict]] = None) -> AsyncGenerator:
+        """the documents with the given uids. The uids are queried in batches of uid_batch_size, all batches at once
+        within the prisma concurrency limit, and the documents of a batch are yielded (or their files downloaded) as
+        soon as its response arrives. Order is not preserved, ordered only applies to the downloads."""
+        async with self._client_session() as session:
+            document_metadata: AsyncIterable[dict] = self._flatten_pages(
+                self._uid_batch_metadata(session, query, document_type, uids, query_filters, uid_batch_size))
+            if metadata_only:
+                async for document in document_metadata:
+                    yield document
             else:
-                for count_files in range(0, len(document_metadata), self.concurrent_files_collected):
-                    coros = [self._get_content_files(metadata, session) for metadata in document_metadata[count_files:count_files + self.concurrent_files_collected]]
-                    for document_awaitable in asyncio.as_completed(coros):
-                        yield await document_awaitable
-        pass
+                async for document in self._documents_with_content(session, document_metadata, ordered, failed_documents):
+                    yield document
 
-    async def _get_content_files(self, metadata, session) -> dict:
-        contentFile_metadata = metadata['contentFilesOriginal'][0]
-        content = await self.file_collector.collect_file(contentFile_metadata['name'], contentFile_metadata['id'], session)
+    async def _uid_batch_metadata(self, session, query: str, document_type: str, uids: List[str],
+                                  query_filters: Optional[List[str]], uid_batch_size: int) -> AsyncGenerator[List[dict], None]:
+        unique_uids: List[str] = list(dict.fromkeys(uids))
+        batches: List[List[str]] = [unique_uids[start:start + uid_batch_size]
+                                    for start in range(0, len(unique_uids), uid_batch_size)]
+        # uids are unique, so limit saves the count query of each batch
+        window = sliding_window.SlidingWindow(max(1, self.tcp_connections_per_host or self.tcp_connections))
+        async for document_metadata in window.map(
+                lambda batch: self._collect_document_metadata(session, query, document_type, limit=len(batch), offset=0,
+                                                              query_filters=query_filters, uids=batch),
+                batches):
+            yield document_metadata
+
+    async def _documents_with_content(self, session, document_metadata: Union[List[dict], AsyncIterable[dict]],
+                                      ordered: bool = False,
+                                      failed_documents: Optional[List[dict]] = None) -> AsyncGenerator:
+        """keeps concurrent_files_collected downloads in flight until all files are collected"""
+        window = sliding_window.SlidingWindow(self.concurrent_files_collected)
+        try:
+            async for document in window.map(lambda metadata: self._get_content_files(metadata, session, failed_documents),
+                                             document_metadata, ordered=ordered):
+                if document is not None:
+                    yield document
+        finally:
+            self.logger.info(f'file download window: {window.stats()}')
+
+    @staticmethod
+    async def _flatten_pages(pages: AsyncIterable[List[dict]]) -> AsyncGenerator:
+        async for page in pages:
+            for document in page:
+                yield document
+
+    async def _get_content_files(self, metadata, session, failed_documents: Optional[List[dict]] = None) -> Optional[dict]:
+        """returns None if the file could not be collected, after the file collector's retries"""
+        try:
+            contentFile_metadata = metadata['contentFilesOriginal'][0]
+            # contentType is used when the query asks for it, which saves the file collector a metadata request
+            content = await self.file_collector.collect_file(contentFile_metadata['name'], contentFile_metadata['id'], session,
+                                                             content_type=contentFile_metadata.get('contentType'))
+        except Exception as e:
+            self.logger.error(f'could not collect the content of {metadata.get("uid", metadata.get("id"))}: {type(e).__name__} {e}')
+            failure: dict = {'uid': metadata.get('uid'), 'id': metadata.get('id'), 'error': f'{type(e).__name__}: {e}'}
+            self.failed_documents.append(failure)
+            if failed_documents is not None:
+                failed_documents.append(failure)
+            return None
 
         metadata['content'] = content[1]
 
@@ -94,33 +298,103 @@ class PrismaDocumentCollector:
                                          query_filters: Optional[List[str]] = None,
                                          uids: List[str] = None) -> List[dict]:
 
-        query_filter: str = self._add_uids_to_query_filter(uids)
-
-        if query_filters:
-            query_filter += self.query_filters2query_filter_string(query_filters)
+        query_filter: str = self._build_query_filter(uids, query_filters)
 
         graphql_connection_ = graphql_connection.GraphQLConnection(session, self.endpoint, self.token)
-        document_metadata = await prisma_helpers.all_of_type(graphql_connection_,
-                                                             gql_type=document_type,
-                                                             limit=limit,
-                                                             offset=offset,
-                                                             query_filter=query_filter,
-                                                             query_str=query)
+        # as prisma_helpers.all_of_type, but each page goes through the limiter on its own
+        if limit is None or limit > self.METADATA_PAGE_SIZE:
+            count: int = await self._query(lambda: prisma_queries.count_of_type(graphql_connection_, document_type,
+                                                                                query_filter),
+                                           kind='count')
+        else:
+            count = limit
+        page_queries: List[str] = prisma_query_builders.build_all_of_type_queries(
+            count, gql_type=document_type, query_str=query, limit=limit, query_filter=query_filter,
+            batch_size=self.METADATA_PAGE_SIZE, offset=offset or 0)
+        pages: List[List[dict]] = await asyncio.gather(*[
+            self._query(functools.partial(prisma_queries.submit_query, graphql_connection_, page_query),
+                        kind=f'{document_type} page')
+            for page_query in page_queries])
+        document_metadata: List[dict] = [document for page in pages for document in page]
 
         self.logger.info(f'collected metadata for #{len(document_metadata)} {document_type}, offset is {offset}')
 
         return document_metadata
 
-    def _add_uids_to_query_filter(self, uids: List[str] = None) -> str:
-        query_filter: str = ''
-        if uids:
-            query_filter += ', uid_in : [ '
-            for uid in uids:
-                query_filter += f'"{uid}",'
-            query_filter += '], '
+    async def _stream_document_metadata(self, session, query: str,
+                                        document_type: str,
+                                        offset: int = 0,
+                                        limit: int = None,
+                                        query_filters: Optional[List[str]] = None,
+                                        uids: List[str] = None,
+                                        page_size: int = 1000) -> AsyncGenerator[List[dict], None]:
+        """yields pages of document metadata ordered by id. Keyset pagination keeps the cost of a page independent
+        of how far into the result set it is"""
+        query_filter: str = self._build_query_filter(uids, query_filters)
+
+        graphql_connection_ = graphql_connection.GraphQLConnection(session, self.endpoint, self.token)
+
+        def fetch_page(after: Optional[str], skip: int, first: int) -> asyncio.Task:
+            page_query: str = self._build_cursor_page_query(document_type, query, query_filter,
+                                                            first=first, after=after, skip=skip)
+            return asyncio.create_task(self._query(
+                lambda: prisma_queries.submit_query(graphql_connection_, page_query), kind=f'{document_type} page'))
+
+        remaining: Optional[int] = limit
+        next_page: Optional[asyncio.Task] = fetch_page(None, offset, page_size if remaining is None else min(page_size, remaining))
+        try:
+            while next_page is not None:
+                document_metadata: List[dict] = await next_page
+                next_page = None
+                if remaining is not None:
+                    remaining -= len(document_metadata)
+
+                # prefetch the next page while the caller downloads the files of this one
+                if len(document_metadata) == page_size and (remaining is None or remaining > 0):
+                    first = page_size if remaining is None else min(page_size, remaining)
+                    next_page = fetch_page(document_metadata[-1]['id'], 0, first)
+
+                self.logger.info(f'collected metadata page of #{len(document_metadata)} {document_type}')
+                if document_metadata:
+                    yield document_metadata
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    @staticmethod
+    def _build_cursor_page_query(document_type: str, query: str, query_filter: str,
+                                 first: int, after: Optional[str] = None, skip: int = 0) -> str:
+        all_type_key: str = prisma_queries.all_type_key(document_type)
+        # id is the cursor, so it is always selected. Selecting it twice is valid graphql.
+        query_cleaned: str = prisma_query_builders.cleanup_query(f'id\n{query}')
+
+        arguments: str = f'first: {first}, orderBy: id_ASC'
+        if after is not None:
+            arguments += f', after: "{after}"'
+        if skip:
+            arguments += f', skip: {skip}'
+        if query_filter:
+            arguments += f', where : {{ {query_filter} }}'
+
+        return f'{{page:{all_type_key}({arguments}){{ {query_cleaned} }}}}'
+
+    def _build_query_filter(self, uids: Optional[List[str]], query_filters: Optional[List[str]]) -> str:
+        query_filter: str = self._add_uids_to_query_filter(uids)
+        if query_filters:
+            query_filter += self.query_filters2query_filter_string(query_filters)
 
         return query_filter
 
+    @staticmethod
+    def _join_query_filters(*query_filters: str) -> str:
+        """the non-empty ones, so an empty filter leaves no stray comma"""
+        return ', '.join(query_filter.strip(', ') for query_filter in query_filters if query_filter.strip(', '))
+
+    def _add_uids_to_query_filter(self, uids: List[str] = None) -> str:
+        if not uids:
+            return ''
+        return ', uid_in : [ ' + ''.join(f'"{uid}",' for uid in uids) + '], '
+
     @classmethod
     def query_filters2query_filter_string(cls, query_filters: Optional[List[str]]) -> str:
         if query_filters is None:
@@ -130,12 +404,13 @@ class PrismaDocumentCollector:
     async def _get_date_of_latest_document_from_prisma(self, query_filters: List[str] = None) -> str:
         query_str = 'updatedAt'
 
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.tcp_connections)) as session:
+        async with self._client_session() as session:
             graphql_connection_ = graphql_connection.GraphQLConnection(session, self.endpoint, self.token)
-            date_of_latest_law_update_response = await prisma_helpers.all_of_type(graphql_connection_,
-                                                                                  gql_type='law', limit=1,
-                                                                                  query_filter=self.query_filters2query_filter_string(query_filters),
-                                                                                  query_str=query_str)
+            page_query: str = prisma_query_builders.build_all_of_type_queries(
+                1, gql_type='law', query_str=query_str, limit=1,
+                query_filter=self.query_filters2query_filter_string(query_filters))[0]
+            date_of_latest_law_update_response = await self._query(
+                lambda: prisma_queries.submit_query(graphql_connection_, page_query), kind='law latest')
 
         try:
             date_of_latest_law_update_str = date_of_latest_law_update_response[0]['updatedAt']
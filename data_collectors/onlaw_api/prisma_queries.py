@@ -0,0 +1,53 @@
+"""The prisma queries PrismaDocumentCollector sends, built on the public parts of prisma_helpers only.
+
+Unlike prisma_helpers, which retries a non-200 response itself, a query is posted once: the response raises
+aiohttp.ClientResponseError, so the caller's adaptive_concurrency.AdaptiveLimiter sees a 5xx as overload, backs off and
+retries it.
+"""
+from typing import List
+import json
+from prisma_helpers import prisma_helpers
+from data_collectors import graphql_connection
+
+
+async def submit_query(graphql_connection_: graphql_connection.GraphQLConnection, query: str) -> List[dict]:
+    """the results of all fields of the query, concatenated like prisma_helpers.all_of_type does"""
+    headers: dict = {'Accept': 'application/json', 'content-type': 'application/json'}
+    if graphql_connection_.token is not None:
+        headers['Authorization'] = f'Bearer {graphql_connection_.token}'
+
+    async with graphql_connection_.session.post(graphql_connection_.endpoint, data=json.dumps({'query': query}),
+                                                headers=headers) as response:
+        response.raise_for_status()
+        result: dict = await response.json(content_type=None)
+    if 'errors' in result:
+        raise prisma_helpers.GraphQLException(f'query was not successful: {result["errors"]}')
+
+    results: List[dict] = []
+    for field_result in (result.get('data') or {}).values():
+        if isinstance(field_result, dict):
+            results.append(field_result)
+        elif isinstance(field_result, list):
+            results.extend(field_result)
+
+    return results
+
+
+async def count_of_type(graphql_connection_: graphql_connection.GraphQLConnection, document_type: str,
+                        query_filter: str = '') -> int:
+    """query_filter: prisma where filter, without `where` and braces"""
+    where: str = f'(where : {{ {query_filter} }})' if query_filter else ''
+    results: List[dict] = await submit_query(graphql_connection_,
+                                             f'{{ {all_type_key(document_type)}Connection {where}{{ aggregate {{ count }} }} }}')
+
+    return results[0]['aggregate']['count'] if results else 0
+
+
+def all_type_key(document_type: str) -> str:
+    """the field listing all documents of a type, e.g. verdicts for verdict"""
+    if document_type.endswith('s'):
+        return f'{document_type}es'
+    if document_type.endswith('y'):
+        return f'{document_type[:-1]}ies'
+
+    return f'{document_type}s'
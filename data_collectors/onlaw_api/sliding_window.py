@@ -0,0 +1,160 @@
+from typing import Any, AsyncGenerator, AsyncIterable, Awaitable, Callable, Dict, Iterable, Optional, Set, Union
+import asyncio
+import time
+
+
+class SlidingWindow:
+    """Keeps up to `size` coroutines in flight and starts the next one as soon as any of them finishes.
+
+    Unlike running fixed chunks through asyncio.as_completed, one slow coroutine only occupies one slot instead of
+    stalling the whole chunk.
+    """
+
+    def __init__(self, size: int, reorder_buffer: Optional[int] = None):
+        """reorder_buffer: only used with ordered=True. Max number of finished results held back while waiting for
+        an earlier, slower one. Defaults to size."""
+        if size < 1:
+            raise ValueError(f'window size must be at least 1, got {size}')
+        self.size = size
+        self.reorder_buffer = size if reorder_buffer is None else reorder_buffer
+        self.in_flight: int = 0
+        self.peak_in_flight: int = 0
+        self.completed: int = 0
+        self._occupancy_area: float = 0.0
+        self._started_at: Optional[float] = None
+        self._last_change_at: Optional[float] = None
+
+    async def map(self, function: Callable[[Any], Awaitable],
+                  items: Union[Iterable, AsyncIterable],
+                  ordered: bool = False) -> AsyncGenerator:
+        """yields function(item) for every item. Completion order by default, input order with ordered=True.
+        items may be an async iterable, in which case it is consumed concurrently with the running coroutines."""
+        run = _MapRun(function, items, ordered)
+        self._start_clock()
+        try:
+            self._fill(run)
+            while run.running or run.next_item_task is not None:
+                waitables: Set[asyncio.Future] = set(run.running)
+                if run.next_item_task is not None and not run.next_item_task.done():
+                    waitables.add(run.next_item_task)
+                done, _ = await asyncio.wait(waitables, return_when=asyncio.FIRST_COMPLETED)
+                results: list = self._drain(run, done)
+                # refill before handing results to the caller, so downloads continue while the caller works
+                self._fill(run)
+                for result in results:
+                    yield result
+        finally:
+            run.cancel()
+            self._set_in_flight(0)
+
+    def _can_launch(self, run: '_MapRun') -> bool:
+        if len(run.running) >= self.size:
+            return False
+        return not run.ordered or run.launched - run.next_to_yield < self.size + self.reorder_buffer
+
+    def _fill(self, run: '_MapRun'):
+        while not run.source_exhausted and self._can_launch(run):
+            item = run.next_item()
+            if item is _NOT_READY or item is _SOURCE_EXHAUSTED:
+                break
+            run.running[asyncio.create_task(run.function(item))] = run.launched
+            run.launched += 1
+        self._set_in_flight(len(run.running))
+
+    def _drain(self, run: '_MapRun', done: Set[asyncio.Future]) -> list:
+        """the results that can be yielded now: all finished ones, or with ordered those next in input order"""
+        results: list = []
+        for task in done:
+            if task is run.next_item_task:
+                continue
+            index: int = run.running.pop(task)  # type: ignore
+            self.completed += 1
+            if run.ordered:
+                run.finished[index] = task.result()
+            else:
+                results.append(task.result())
+        self._set_in_flight(len(run.running))
+
+        while run.next_to_yield in run.finished:
+            results.append(run.finished.pop(run.next_to_yield))
+            run.next_to_yield += 1
+
+        return results
+
+    def stats(self) -> dict:
+        """occupancy is the time averaged fraction of the window that was in use"""
+        elapsed: float = 0.0
+        if self._started_at is not None:
+            self._set_in_flight(self.in_flight)
+            elapsed = self._last_change_at - self._started_at  # type: ignore
+
+        return {'size': self.size,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'completed': self.completed,
+                'occupancy': self._occupancy_area / (elapsed * self.size) if elapsed > 0 else 0.0}
+
+    def _start_clock(self):
+        if self._started_at is None:
+            self._started_at = self._last_change_at = time.monotonic()
+
+    def _set_in_flight(self, in_flight: int):
+        now: float = time.monotonic()
+        if self._last_change_at is not None:
+            self._occupancy_area += self.in_flight * (now - self._last_change_at)
+        self._last_change_at = now
+        self.in_flight = in_flight
+        self.peak_in_flight = max(self.peak_in_flight, in_flight)
+
+
+class _MapRun:
+    """the state of one SlidingWindow.map call"""
+
+    def __init__(self, function: Callable[[Any], Awaitable], items: Union[Iterable, AsyncIterable], ordered: bool):
+        self.function = function
+        self.ordered = ordered
+        self.is_async_source: bool = hasattr(items, '__aiter__')
+        self.source = items.__aiter__() if self.is_async_source else iter(items)  # type: ignore
+        self.source_exhausted: bool = False
+        self.next_item_task: Optional[asyncio.Task] = None
+        self.running: Dict[asyncio.Task, int] = {}
+        self.finished: Dict[int, Any] = {}
+        self.launched: int = 0
+        self.next_to_yield: int = 0
+
+    def next_item(self):
+        """the next item, _NOT_READY while an async source is still producing it, or _SOURCE_EXHAUSTED"""
+        if not self.is_async_source:
+            try:
+                return next(self.source)
+            except StopIteration:
+                self.source_exhausted = True
+                return _SOURCE_EXHAUSTED
+
+        if self.next_item_task is None:
+            self.next_item_task = asyncio.create_task(_next_item(self.source))
+        if not self.next_item_task.done():
+            return _NOT_READY
+        item = self.next_item_task.result()
+        self.next_item_task = None
+        if item is _SOURCE_EXHAUSTED:
+            self.source_exhausted = True
+
+        return item
+
+    def cancel(self):
+        for task in self.running:
+            task.cancel()
+        if self.next_item_task is not None:
+            self.next_item_task.cancel()
+
+
+_SOURCE_EXHAUSTED = object()
+_NOT_READY = object()
+
+
+async def _next_item(source):
+    try:
+        return await source.__anext__()
+    except StopAsyncIteration:
+        return _SOURCE_EXHAUSTED
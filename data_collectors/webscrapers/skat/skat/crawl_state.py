@@ -0,0 +1,145 @@
+"""What SkatDocSpider knows about every url it has seen: whether it was scraped, the hash of the stripped content,
+where the document was written and the validators (ETag, Last-Modified) of the response, for conditional recrawls. Kept in sqlite (data/skat.state.sqlite), keyed by a hash of the url, so resuming a
+crawl is one indexed lookup per url instead of reading skat.jsonl into memory first.
+"""
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+import hashlib
+import json
+import sqlite3
+import time
+
+SCRAPED = 'scraped'
+FAILED = 'failed'
+
+
+class UrlState(NamedTuple):
+    url: str
+    status: str
+    content_hash: Optional[str]
+    output_path: Optional[str]
+    doc_id: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    updated_at: float
+
+
+COLUMNS: str = 'url, status, content_hash, output_path, doc_id, etag, last_modified, updated_at'
+
+
+class CrawlState:
+
+    def __init__(self, state_path: str):
+        self.state_path = state_path
+        self.connection = sqlite3.connect(state_path, isolation_level=None)
+        # a crash loses at most the last few writes, which are then scraped again
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS urls (
+                url_hash TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                status TEXT NOT NULL,
+                content_hash TEXT,
+                output_path TEXT,
+                doc_id TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                updated_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        # stores created before conditional recrawls
+        columns: List[str] = [row[1] for row in self.connection.execute('PRAGMA table_info(urls)')]
+        for column in ('etag', 'last_modified'):
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE urls ADD COLUMN {column} TEXT')
+
+    def __enter__(self) -> 'CrawlState':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+
+    def get(self, url: str) -> Optional[UrlState]:
+        row = self.connection.execute(f'SELECT {COLUMNS} FROM urls WHERE url_hash = ?', (url_hash(url),)).fetchone()
+
+        return None if row is None else UrlState(*row)
+
+    def record(self, url: str, status: str, content_hash: Optional[str] = None, output_path: Optional[str] = None,
+               doc_id: Optional[str] = None, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        self.record_many([(url, status, content_hash, output_path, doc_id, etag, last_modified)])
+
+    def record_many(self, records: Iterable[Tuple[str, str, Optional[str], Optional[str], Optional[str], Optional[str],
+                                                  Optional[str]]]):
+        """(url, status, content_hash, output_path, doc_id, etag, last_modified) tuples, in one transaction"""
+        now: float = time.time()
+        with self._transaction():
+            self.connection.executemany(f'INSERT OR REPLACE INTO urls (url_hash, {COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                        [(url_hash(record[0]), *record, now) for record in records])
+
+    def not_modified(self, url: str):
+        """the server confirmed the scraped document is still current"""
+        self.connection.execute('UPDATE urls SET updated_at = ? WHERE url_hash = ?', (time.time(), url_hash(url)))
+
+    def urls(self, status: Optional[str] = None) -> Iterator[UrlState]:
+        """streamed from sqlite, in no particular order"""
+        query: str = f'SELECT {COLUMNS} FROM urls'
+        cursor = self.connection.execute(query + ' WHERE status = ?', (status,)) if status else self.connection.execute(query)
+        for row in cursor:
+            yield UrlState(*row)
+
+    def import_jsonl(self, jsonl_path: str, output_path_of, batch_size: int = 1000) -> int:
+        """records every document of a skat.jsonl written before this store existed as scraped, without a content
+        hash. output_path_of(doc_id) is where the document was written. Returns the number of documents imported."""
+        imported: int = 0
+        with open(jsonl_path, 'r') as fp:
+            for batch in _batches((json.loads(line) for line in fp if line.strip()), batch_size):
+                now: float = time.time()
+                with self._transaction():
+                    self.connection.executemany(
+                        'INSERT OR REPLACE INTO urls (url_hash, url, status, output_path, doc_id, updated_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        [(url_hash(metadata['uri']), metadata['uri'], SCRAPED, output_path_of(metadata['doc_id']),
+                          metadata['doc_id'], now) for metadata in batch])
+                imported += len(batch)
+
+        return imported
+
+    def _transaction(self) -> '_Transaction':
+        return _Transaction(self.connection)
+
+
+class _Transaction:
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN')
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+def url_hash(url: str) -> str:
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def _batches(items: Iterable, batch_size: int) -> Iterator[Tuple]:
+    batch: list = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield tuple(batch)
+            batch = []
+    if batch:
+        yield tuple(batch)
@@ -0,0 +1,83 @@
+"""Run metrics of a crawl (see instrumentation/run_metrics.py), written to SKAT_METRICS_PATH/<spider name>.metrics.json
+and .prom every SKAT_METRICS_FLUSH_INTERVAL seconds and summarised when the spider closes.
+
+Stages: scrapy_download (download latency and response size), scrapy_parse (spider callbacks) and, recorded by
+SkatPipeline, strip_html, segment, pipeline_write and metadata_flush.
+"""
+import os
+import sys
+import time
+from scrapy import signals
+this_file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(this_file_path, '../../../..'))  # repository root
+from instrumentation import run_metrics
+
+PARSE_STARTED_AT_KEY = 'skat_parse_started_at'
+
+
+def crawl_metrics(crawler) -> run_metrics.RunMetrics:
+    """the RunMetrics of this crawl, shared by the extension, the middleware and the pipeline"""
+    if not hasattr(crawler, 'skat_run_metrics'):
+        metrics_path: str = crawler.settings.get('SKAT_METRICS_PATH') or os.path.join(this_file_path, '../data')
+        crawler.skat_run_metrics = run_metrics.RunMetrics(
+            crawler.spidercls.name, report_path=os.path.join(os.path.abspath(metrics_path), f'{crawler.spidercls.name}.metrics'),
+            flush_interval=crawler.settings.getfloat('SKAT_METRICS_FLUSH_INTERVAL', 30.0))
+
+    return crawler.skat_run_metrics
+
+
+class RunMetricsExtension:
+    """flushes the metrics while the spider runs and records every downloaded response"""
+
+    def __init__(self, metrics: run_metrics.RunMetrics):
+        self.metrics = metrics
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        extension = cls(crawl_metrics(crawler))
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.response_received, signal=signals.response_received)
+
+        return extension
+
+    def spider_opened(self, spider):
+        self.metrics.start()
+
+    def spider_closed(self, spider):
+        self.metrics.stop()
+
+    def response_received(self, response, request, spider):
+        # download_latency is set by scrapy's downloader: from sending the request until the response headers arrived
+        self.metrics.observe('scrapy_download', request.meta.get('download_latency', 0.0), bytes=len(response.body))
+
+
+class ParseTimingMiddleware:
+    """spider middleware recording the time from handing a response to the spider until its callback's output has
+    been consumed. Enable it closest to the spider, i.e. with the highest order in SPIDER_MIDDLEWARES."""
+
+    def __init__(self, metrics: run_metrics.RunMetrics):
+        self.metrics = metrics
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawl_metrics(crawler))
+
+    def process_spider_input(self, response, spider):
+        response.meta[PARSE_STARTED_AT_KEY] = time.monotonic()
+
+    def process_spider_output(self, response, result, spider):
+        for output in result:
+            yield output
+        self._record_parse(response)
+
+    async def process_spider_output_async(self, response, result, spider):
+        """used instead of process_spider_output by scrapy versions with asynchronous spider output"""
+        async for output in result:
+            yield output
+        self._record_parse(response)
+
+    def _record_parse(self, response):
+        started_at: float = response.meta.pop(PARSE_STARTED_AT_KEY, None)
+        if started_at is not None:
+            self.metrics.observe('scrapy_parse', time.monotonic() - started_at, bytes=len(response.body))
@@ -0,0 +1,107 @@
+from typing import List, Optional, Set, Tuple
+import os
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from twisted.internet import defer, threads
+from skat import response_archive
+
+# request.meta key holding the crawl_state.UrlState of a document that is scraped again
+URL_STATE_KEY = 'skat_url_state'
+
+
+class NotModified(IgnoreRequest):
+    """the server answered a conditional request with 304, the document scraped earlier is still current"""
+
+
+class ConditionalRequestMiddleware:
+    """Downloader middleware making requests that carry an earlier UrlState (request.meta[URL_STATE_KEY])
+    conditional: If-None-Match and If-Modified-Since are sent with the ETag and Last-Modified stored for the url. A 304
+    response is turned into NotModified, so it never reaches the spider or the pipeline, and the request's errback
+    gets it instead."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats)
+
+    def process_request(self, request, spider):
+        url_state = request.meta.get(URL_STATE_KEY)
+        if url_state is None:
+            return None
+        if url_state.etag:
+            request.headers.setdefault('If-None-Match', url_state.etag)
+        if url_state.last_modified:
+            request.headers.setdefault('If-Modified-Since', url_state.last_modified)
+        if url_state.etag or url_state.last_modified:
+            self.stats.inc_value('skat/conditional_requests')
+
+        return None
+
+    def process_response(self, request, response, spider):
+        if response.status == 304 and URL_STATE_KEY in request.meta:
+            self.stats.inc_value('skat/not_modified')
+            raise NotModified(f'{request.url} is not modified')
+
+        return response
+
+
+class ResponseArchiveMiddleware:
+    """Downloader middleware appending every 200 response of a spider with archive_responses = True to a
+    response_archive.ResponseArchiveWriter at SKAT_ARCHIVE_PATH, data/archive by default, so skat/reprocess.py can
+    replay them. Enable it after HttpCompressionMiddleware, i.e. with a lower order, so the bodies are stored decoded.
+    The records are compressed and written in the reactor's thread pool, the response goes on to the spider meanwhile."""
+
+    def __init__(self, archive_path: Optional[str], stats):
+        self.archive_path = archive_path
+        self.stats = stats
+        self.writer: Optional[response_archive.ResponseArchiveWriter] = None
+        self.pending: Set[defer.Deferred] = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('SKAT_ARCHIVE_RESPONSES'):
+            raise NotConfigured
+        middleware = cls(crawler.settings.get('SKAT_ARCHIVE_PATH'), crawler.stats)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+
+        return middleware
+
+    def process_response(self, request, response, spider):
+        if response.status != 200 or not getattr(spider, 'archive_responses', False):
+            return response
+        if self.writer is None:
+            self.writer = response_archive.ResponseArchiveWriter(
+                self.archive_path or os.path.join(spider.data_folder, 'archive'), name='skat')
+
+        headers: List[Tuple[str, str]] = [(name.decode('latin-1'), value.decode('latin-1'))
+                                          for name, values in response.headers.items() for value in values]
+        deferred = threads.deferToThread(self.writer.write, response.url, response.status, headers, response.body)
+        self.pending.add(deferred)
+        deferred.addCallbacks(self.archived, self.archive_failed, errbackArgs=(response.url, spider))
+        deferred.addBoth(self._done, deferred)
+
+        return response
+
+    def archived(self, entry: response_archive.IndexEntry):
+        self.stats.inc_value('skat/archived_responses')
+        self.stats.inc_value('skat/archived_bytes', entry.length)
+
+    def archive_failed(self, failure, url: str, spider):
+        self.stats.inc_value('skat/archive_failures')
+        spider.logger.error(f'failed to archive the response of {url}: {failure.getErrorMessage()}')
+
+    def _done(self, result, deferred: defer.Deferred):
+        self.pending.discard(deferred)
+
+    def spider_closed(self, spider):
+        # scrapy waits for the Deferred, the last records are written before the writer is closed
+        deferred = defer.DeferredList(list(self.pending))
+        deferred.addCallback(self._close_writer)
+
+        return deferred
+
+    def _close_writer(self, _):
+        if self.writer is not None:
+            return threads.deferToThread(self.writer.close)
@@ -1,44 +1,258 @@
 # from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
 import arrow
 import json
-import lxml.html
-import lxml.etree
+import os
+import sys
+import time
+from scrapy.exceptions import DropItem
+from twisted.internet import defer, task, threads
+this_file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(this_file_path, '../../../..'))  # repository root
+from data_processors import html_extraction
+from data_processors import near_duplicates
+from data_processors import sentence_segmentation
+from data_writers import sharded_corpus
+from skat import crawl_state
+from skat import metrics
+
+# documents are added to the near-duplicate index under this source, the onlaw builder uses onlaw_api:<section>
+NEAR_DUPLICATE_SOURCE = 'skat.dk'
+
+
+def document_filename(item) -> str:
+    return f'skat_{item["SKM-nummer"]}'.replace('.', '_')
+
+
+def document_metadata(filename: str, item, text_metadata: dict) -> dict:
+    """the line of skat.jsonl, text_metadata: of sentence_segmentation.analyze"""
+    date_format = "%c %Z %z"
+
+    return {
+        'doc_id': filename,
+        'uri': item['url'],
+        'date_built': arrow.now().replace(tzinfo="Europe/Copenhagen").strftime(date_format),
+        # 'date_built': datetime.now(timezone.utc).isoformat()
+        'token_count': text_metadata['token_count'],
+        # [start, end) character offsets into the text
+        'sentences': text_metadata['sentences']
+    }
 
 
 class SkatPipeline:
+    """Nothing runs on the reactor thread for long: html is stripped in worker processes and documents are written in
+    the reactor's thread pool. Metadata, i.e. the lines of skat.jsonl and the crawl state, is buffered and written
+    every SKAT_METADATA_BATCH_SIZE documents or SKAT_METADATA_FLUSH_INTERVAL seconds, and once more on close_spider.
+    Lines are appended, so a document rewritten by a recrawl has several, close_spider keeps only the latest."""
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls()
+        pipeline.metrics = metrics.crawl_metrics(crawler)
+
+        return pipeline
+
+    def open_spider(self, spider):
+        # html is stripped in worker processes so the reactor keeps downloading meanwhile
+        self.html_extractor = html_extraction.HtmlExtractor()
+        self.html_extractor.start()
+        self.on_near_duplicate: Optional[str] = spider.settings.get('SKAT_ON_NEAR_DUPLICATE', 'link')
+        self.near_duplicate_index: Optional[near_duplicates.NearDuplicateIndex] = None
+        if self.on_near_duplicate is not None:
+            if self.on_near_duplicate not in ('drop', 'link'):
+                raise ValueError(f'unknown SKAT_ON_NEAR_DUPLICATE "{self.on_near_duplicate}"')
+            index_path: str = spider.settings.get('SKAT_NEAR_DUPLICATE_INDEX') or os.path.join(
+                this_file_path, '../../../..', 'data', 'near_duplicates.sqlite')
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            self.near_duplicate_index = near_duplicates.NearDuplicateIndex(index_path)
+        # sentence offsets, token counts and minhash signatures, in batches in worker processes as well
+        self.text_analyzer = sentence_segmentation.TextAnalyzer(minhash=self.near_duplicate_index is not None)
+        self.text_analyzer.start()
+
+        self.corpus_writer = None
+        output_format: str = spider.settings.get('SKAT_OUTPUT_FORMAT', 'files')
+        if output_format == 'shards':
+            self.corpus_writer = sharded_corpus.ShardedCorpusWriter(spider.data_folder, name='skat')
+        elif output_format != 'files':
+            raise ValueError(f'unknown SKAT_OUTPUT_FORMAT "{output_format}"')
+
+        self.metadata_batch_size: int = spider.settings.getint('SKAT_METADATA_BATCH_SIZE', 100)
+        self.metadata_lines: List[str] = []
+        self.crawl_state_records: List[tuple] = []
+        self.metadata_appended: bool = False
+        # flushes one after another, so skat.jsonl keeps the order the documents were written in
+        self.flush_lock = defer.DeferredLock()
+        self.flush_loop = task.LoopingCall(self.flush_metadata, spider)
+        # a failed flush stops the loop, the metadata is then written by the batch flushes and by close_spider
+        self.flush_loop.start(spider.settings.getfloat('SKAT_METADATA_FLUSH_INTERVAL', 5.0), now=False).addErrback(
+            lambda failure: spider.logger.error(f'periodic metadata flush stopped: {failure.getErrorMessage()}'))
+
+    @defer.inlineCallbacks
+    def close_spider(self, spider):
+        # scrapy calls close_spider once every item has been processed, so only the buffered metadata is left
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+        try:
+            yield self.flush_metadata(spider)
+            if self.metadata_appended:
+                yield threads.deferToThread(self._compact_lines, spider.urls_already_scraped_file_path)
+        finally:
+            self.html_extractor.shutdown()
+            self.text_analyzer.shutdown()
+            if self.near_duplicate_index is not None:
+                self.near_duplicate_index.close()
+            if self.corpus_writer is not None:
+                yield threads.deferToThread(self.corpus_writer.close)
+
     def process_item(self, item, spider):
-        content: str = self.strip_html(item['body'])
+        # includes the time waiting for a free worker process
+        strip_started_at: float = time.monotonic()
+        deferred = self.html_extractor.extract_deferred(item['body'])
+        deferred.addCallback(self.record_strip, item, strip_started_at)
+        deferred.addCallback(self.analyze_text)
+        deferred.addCallback(self.save_item, item, spider)
+
+        return deferred
+
+    def record_strip(self, content: str, item, strip_started_at: float) -> str:
+        self.metrics.observe('strip_html', time.monotonic() - strip_started_at, bytes=len(item['body']))
+        return content
+
+    def analyze_text(self, content: str):
+        segment_started_at: float = time.monotonic()
+        deferred = self.text_analyzer.analyze_deferred(content)
+        deferred.addCallback(self.record_segment, content, segment_started_at)
 
-        filename: str = f'skat_{item["SKM-nummer"]}'.replace('.', '_')
-        with open(f'{spider.data_folder}/{filename}', 'w') as fp:
-            fp.write(content)
+        return deferred
 
-        date_format = "%c %Z %z"
+    def record_segment(self, text_metadata: dict, content: str, segment_started_at: float) -> Tuple[str, dict]:
+        self.metrics.observe('segment', time.monotonic() - segment_started_at, bytes=len(content),
+                             tokens=text_metadata['token_count'])
+        return content, text_metadata
 
-        metadata: dict = {
-            'doc_id': filename,
-            'uri': item['url'],
-            'date_built': arrow.now().replace(tzinfo="Europe/Copenhagen").strftime(date_format)
-            # 'date_built': datetime.now(timezone.utc).isoformat()
-        }
+    def save_item(self, analyzed_content: Tuple[str, dict], item, spider):
+        content, text_metadata = analyzed_content
+        minhash: Optional[List[int]] = text_metadata.pop('minhash', None)
+        filename: str = document_filename(item)
+        metadata: dict = document_metadata(filename, item, text_metadata)
 
-        with open(spider.urls_already_scraped_file_path, 'a') as fp:
-            fp.write(f'{json.dumps(metadata)}\n')
+        content_hash: str = crawl_state.content_hash(content)
+        if self.is_unchanged(content_hash, item, spider):
+            # a page without working validators, only the validators are updated
+            spider.crawler.stats.inc_value('skat/unchanged')
+            self.crawl_state_records.append(self.crawl_state_record(content_hash, filename, item, spider))
+            return item
 
-        collected_tokens: int = len(content.split())
+        deferred = threads.deferToThread(self.write_document, content, filename, metadata, minhash, spider)
+        deferred.addCallback(self.document_written, content, content_hash, filename, metadata, item, spider)
+
+        return deferred
+
+    def write_document(self, content: str, filename: str, metadata: dict, minhash: Optional[List[int]],
+                       spider) -> Optional[near_duplicates.Match]:
+        """runs in the reactor's thread pool. Returns the document's near-duplicate, if there is one, a dropped
+        near-duplicate is not written."""
+        match: Optional[near_duplicates.Match] = None
+        if self.near_duplicate_index is not None and minhash is not None:
+            match = self.near_duplicate_index.find_or_add(NEAR_DUPLICATE_SOURCE, filename, minhash)
+        if match is not None:
+            if self.on_near_duplicate == 'drop':
+                return match
+            metadata['near_duplicate_of'] = match._asdict()
+
+        write_started_at: float = time.monotonic()
+        if self.corpus_writer is not None:
+            self.corpus_writer.write(filename, content, metadata)
+        else:
+            with open(f'{spider.data_folder}/{filename}', 'w') as fp:
+                fp.write(content)
+        self.metrics.observe('pipeline_write', time.monotonic() - write_started_at, bytes=len(content.encode('utf-8')),
+                             tokens=metadata['token_count'])
+
+        return match
+
+    def document_written(self, match: Optional[near_duplicates.Match], content: str, content_hash: str, filename: str,
+                         metadata: dict, item, spider):
+        if match is not None:
+            spider.crawler.stats.inc_value('skat/near_duplicates')
+            spider.logger.info(f'{item["SKM-nummer"]} is a near-duplicate of {match.doc_id} from {match.source} '
+                               f'({match.similarity:.2f})')
+            if self.on_near_duplicate == 'drop':
+                # without an output path, so the url counts as scraped and is not fetched again on resume
+                self.crawl_state_records.append((item['url'], crawl_state.SCRAPED, content_hash, None, filename,
+                                                 item.get('etag'), item.get('last_modified')))
+                raise DropItem(f'{item["SKM-nummer"]} is a near-duplicate of {match.doc_id}')
+
+        self.metadata_lines.append(f'{json.dumps(metadata)}\n')
+        # recorded after the document is written, a document whose write failed is scraped again on resume
+        self.crawl_state_records.append(self.crawl_state_record(content_hash, filename, item, spider))
+        if len(self.metadata_lines) >= self.metadata_batch_size:
+            self.flush_metadata(spider).addErrback(
+                lambda failure: spider.logger.error(f'failed to write metadata: {failure.getErrorMessage()}'))
+
+        collected_tokens: int = metadata['token_count']
         spider.collected_tokens += collected_tokens
         spider.logger.info(f'collected { item["SKM-nummer"]} which has #{collected_tokens} tokens.')
         spider.logger.info(f'Collected #{spider.collected_tokens} tokens in total')
         return item
 
-    def strip_html(self, html: str) -> str:
-        parsed_html = lxml.html.fromstring(html)
+    def is_unchanged(self, content_hash: str, item, spider) -> bool:
+        """whether the document was scraped before with the same content and is still where it was written"""
+        url_state = spider.crawl_state.get(item['url'])
 
-        for table in parsed_html.xpath('//table'):
-            table.getparent().remove(table)
+        return spider.is_scraped(url_state) and url_state.content_hash == content_hash
 
-        all_content_no_html = ' '.join(lxml.etree.XPath("//text()")(parsed_html))
+    @staticmethod
+    def crawl_state_record(content_hash: str, filename: str, item, spider) -> tuple:
+        return (item['url'], crawl_state.SCRAPED, content_hash, spider.output_path(filename), filename,
+                item.get('etag'), item.get('last_modified'))
 
-        content_no_extra_whitespaces = ' '.join(all_content_no_html.split())
+    def flush_metadata(self, spider):
+        """writes the buffered metadata, returns a Deferred firing once it is written"""
+        if not self.metadata_lines and not self.crawl_state_records:
+            return defer.succeed(None)
+        metadata_lines, self.metadata_lines = self.metadata_lines, []
+        crawl_state_records, self.crawl_state_records = self.crawl_state_records, []
 
-        return content_no_extra_whitespaces
+        deferred = self.flush_lock.run(self._flush_metadata, metadata_lines, crawl_state_records, spider)
+        deferred.addErrback(self._restore_metadata, metadata_lines, crawl_state_records)
+
+        return deferred
+
+    def _restore_metadata(self, failure, metadata_lines: List[str], crawl_state_records: List[tuple]):
+        """puts the metadata of a failed flush back, so the next flush writes it. Lines it did append are written
+        twice, close_spider keeps one of them"""
+        self.metadata_lines[:0] = metadata_lines
+        self.crawl_state_records[:0] = crawl_state_records
+
+        return failure
+
+    @defer.inlineCallbacks
+    def _flush_metadata(self, metadata_lines: List[str], crawl_state_records: List[tuple], spider):
+        flush_started_at: float = time.monotonic()
+        if metadata_lines:
+            self.metadata_appended = True
+            yield threads.deferToThread(self._append_lines, spider.urls_already_scraped_file_path, metadata_lines)
+        # the crawl state's sqlite connection belongs to the reactor thread, one transaction per batch is cheap
+        spider.crawl_state.record_many(crawl_state_records)
+        self.metrics.observe('metadata_flush', time.monotonic() - flush_started_at, documents=len(metadata_lines))
+
+    @staticmethod
+    def _append_lines(path: str, lines: List[str]):
+        with open(path, 'a') as fp:
+            fp.writelines(lines)
+
+    @staticmethod
+    def _compact_lines(path: str):
+        """keeps the last line of every doc_id, in the place of its first one, like the shards' index does"""
+        lines: Dict[str, str] = {}
+        with open(path, 'r') as fp:
+            for line in fp:
+                if line.strip():
+                    lines[json.loads(line)['doc_id']] = line
+        with open(f'{path}.tmp', 'w') as fp:
+            fp.writelines(lines.values())
+        os.replace(f'{path}.tmp', path)
+
+    def strip_html(self, html: str) -> str:
+        return html_extraction.strip_html(html)
@@ -0,0 +1,179 @@
+"""Replays the responses archived by SkatDocSpider (skat/response_archive.py) through SkatDocSpider.parse and the steps
+of SkatPipeline, without touching the network, e.g. after a change to the parsing or to html_extraction.strip_html:
+
+    python -m skat.reprocess                                    # in the skat folder, writes data/reprocessed
+    python -m skat.reprocess --output-format shards --processes 8 --output /tmp/skat
+
+The latest response of every archived url is parsed, stripped and segmented in worker processes, a chunk of responses
+at a time in the order they are stored, so the archive is read sequentially and the cpus, not the network, set the pace.
+The documents and their skat.jsonl are written to a new output folder, the crawl's data folder and crawl state are left
+as they are. Near-duplicates are looked up like SkatPipeline does, in a new index in the output folder by default, so
+the index the crawl and the onlaw builder share is left as it is as well. A response that no longer parses is logged
+and left out.
+"""
+from typing import Deque, List, Optional, Tuple
+from concurrent.futures import Future, ProcessPoolExecutor
+import argparse
+import collections
+import json
+import logging
+import os
+import time
+from scrapy.http import HtmlResponse
+from scrapy.utils.project import get_project_settings
+from skat import pipelines
+from skat import response_archive
+from skat.spiders.doc_bot import SkatDocSpider
+from data_processors import html_extraction
+from data_processors import near_duplicates
+from data_processors import sentence_segmentation
+from data_writers import sharded_corpus
+
+logger = logging.getLogger(__name__)
+# (item, filename, content, text metadata) of the documents of a chunk, and (url, error) of the responses that failed
+ChunkResult = Tuple[List[Tuple[dict, str, str, dict]], List[Tuple[str, str]]]
+
+_spider: Optional[SkatDocSpider] = None
+
+
+def reprocess(archive_path: str, output_path: str, output_format: str = 'files', processes: Optional[int] = None,
+              chunk_size: int = 64, near_duplicate_index_path: Optional[str] = None,
+              on_near_duplicate: Optional[str] = 'link') -> dict:
+    """near_duplicate_index_path: defaults to near_duplicates.sqlite in output_path. An existing index, e.g. the crawl's,
+    is added to, a document whose filename changed with the parsing is then found as a near-duplicate of itself.
+    on_near_duplicate None turns the near-duplicate lookup off"""
+    if output_format not in ('files', 'shards'):
+        raise ValueError(f'unknown output_format "{output_format}"')
+    if on_near_duplicate not in (None, 'drop', 'link'):
+        raise ValueError(f'unknown on_near_duplicate "{on_near_duplicate}"')
+    metadata_path: str = os.path.join(output_path, 'skat.jsonl')
+    if os.path.exists(metadata_path):
+        raise FileExistsError(f'{metadata_path} exists, reprocess into a new output folder')
+    os.makedirs(output_path, exist_ok=True)
+    processes = processes or os.cpu_count() or 1
+
+    entries: List[response_archive.IndexEntry] = response_archive.ResponseArchiveReader(archive_path).entries()
+    logger.info(f'reprocessing #{len(entries)} archived responses from {archive_path} into {output_path}')
+    near_duplicate_index: Optional[near_duplicates.NearDuplicateIndex] = None
+    if on_near_duplicate is not None:
+        near_duplicate_index_path = near_duplicate_index_path or os.path.join(output_path, 'near_duplicates.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(near_duplicate_index_path)), exist_ok=True)
+        near_duplicate_index = near_duplicates.NearDuplicateIndex(near_duplicate_index_path)
+    corpus_writer: Optional[sharded_corpus.ShardedCorpusWriter] = None
+    if output_format == 'shards':
+        corpus_writer = sharded_corpus.ShardedCorpusWriter(output_path, name='skat')
+
+    result: dict = {'documents': 0, 'tokens': 0, 'near_duplicates': 0, 'dropped': 0, 'failed': 0}
+    started_at: float = time.monotonic()
+    try:
+        with ProcessPoolExecutor(processes, initializer=_start_worker) as executor, open(metadata_path, 'w') as metadata_fp:
+            # in order, and only a few chunks ahead of the writing so the results do not pile up in memory
+            pending: Deque[Future] = collections.deque()
+            for start in range(0, len(entries), chunk_size):
+                pending.append(executor.submit(reprocess_chunk, archive_path, entries[start:start + chunk_size],
+                                               near_duplicate_index is not None))
+                if len(pending) >= 2 * processes:
+                    _write_chunk(pending.popleft().result(), output_path, corpus_writer, metadata_fp,
+                                 near_duplicate_index, on_near_duplicate, result)
+            while pending:
+                _write_chunk(pending.popleft().result(), output_path, corpus_writer, metadata_fp, near_duplicate_index,
+                             on_near_duplicate, result)
+    finally:
+        if corpus_writer is not None:
+            corpus_writer.close()
+        if near_duplicate_index is not None:
+            near_duplicate_index.close()
+
+    seconds: float = time.monotonic() - started_at
+    result['seconds'] = round(seconds, 1)
+    logger.info(f'reprocessed {result}, {len(entries) / max(seconds, 1e-9):.0f} responses/s')
+
+    return result
+
+
+def reprocess_chunk(archive_path: str, entries: List[response_archive.IndexEntry], minhash: bool) -> ChunkResult:
+    """runs in a worker process"""
+    parsed: List[Tuple[dict, str, str]] = []
+    failures: List[Tuple[str, str]] = []
+    for entry in entries:
+        try:
+            archived: response_archive.ArchivedResponse = response_archive.read_response(archive_path, entry)
+            response = HtmlResponse(url=archived.url, status=archived.status, headers=archived.headers,
+                                    body=archived.body)
+            item: dict = _spider.parse(response)  # type: ignore
+            parsed.append((item, pipelines.document_filename(item), html_extraction.strip_html(item['body'])))
+        except Exception as exception:
+            failures.append((entry.url, repr(exception)))
+    text_metadatas: List[dict] = sentence_segmentation.analyze_batch([content for _, _, content in parsed], minhash)
+
+    return [(item, filename, content, text_metadata)
+            for (item, filename, content), text_metadata in zip(parsed, text_metadatas)], failures
+
+
+def _start_worker():
+    global _spider
+    _spider = SkatDocSpider()
+
+
+def _write_chunk(chunk_result: ChunkResult, output_path: str,
+                 corpus_writer: Optional[sharded_corpus.ShardedCorpusWriter], metadata_fp,
+                 near_duplicate_index: Optional[near_duplicates.NearDuplicateIndex], on_near_duplicate: Optional[str],
+                 result: dict):
+    documents, failures = chunk_result
+    for url, error in failures:
+        logger.warning(f'failed to reprocess {url}: {error}')
+    result['failed'] += len(failures)
+
+    for item, filename, content, text_metadata in documents:
+        minhash: Optional[List[int]] = text_metadata.pop('minhash', None)
+        metadata: dict = pipelines.document_metadata(filename, item, text_metadata)
+
+        if near_duplicate_index is not None and minhash is not None:
+            match: Optional[near_duplicates.Match] = near_duplicate_index.find_or_add(
+                pipelines.NEAR_DUPLICATE_SOURCE, filename, minhash)
+            if match is not None:
+                result['near_duplicates'] += 1
+                if on_near_duplicate == 'drop':
+                    result['dropped'] += 1
+                    continue
+                metadata['near_duplicate_of'] = match._asdict()
+
+        if corpus_writer is not None:
+            corpus_writer.write(filename, content, metadata)
+        else:
+            with open(os.path.join(output_path, filename), 'w') as fp:
+                fp.write(content)
+        metadata_fp.write(f'{json.dumps(metadata)}\n')
+        result['documents'] += 1
+        result['tokens'] += metadata['token_count']
+
+
+def main():
+    # the defaults follow the scrapy settings of the project, as for the crawl
+    settings = get_project_settings()
+    data_folder: str = SkatDocSpider().data_folder
+    on_near_duplicate: Optional[str] = settings.get('SKAT_ON_NEAR_DUPLICATE', 'link')
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--archive', dest='archive_path',
+                            default=settings.get('SKAT_ARCHIVE_PATH') or os.path.join(data_folder, 'archive'))
+    arg_parser.add_argument('--output', dest='output_path', default=os.path.join(data_folder, 'reprocessed'),
+                            help='a new folder, it must not contain a skat.jsonl')
+    arg_parser.add_argument('--output-format', choices=['files', 'shards'],
+                            default=settings.get('SKAT_OUTPUT_FORMAT', 'files'))
+    arg_parser.add_argument('--processes', type=int, help='worker processes, defaults to the number of cpus')
+    arg_parser.add_argument('--chunk-size', type=int, default=64, help='responses handed to a worker at a time')
+    arg_parser.add_argument('--on-near-duplicate', choices=['link', 'drop', 'none'], default=on_near_duplicate or 'none')
+    arg_parser.add_argument('--near-duplicate-index', dest='near_duplicate_index_path',
+                            help='defaults to a new near_duplicates.sqlite in the output folder')
+    arguments = arg_parser.parse_args()
+    if os.path.exists(os.path.join(arguments.output_path, 'skat.jsonl')):
+        arg_parser.error(f'{arguments.output_path} holds an earlier result, choose a new --output')
+
+    logging.basicConfig(level=settings.get('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(message)s')
+    reprocess(arguments.archive_path, arguments.output_path, arguments.output_format, arguments.processes,
+              arguments.chunk_size, arguments.near_duplicate_index_path,
+              None if arguments.on_near_duplicate == 'none' else arguments.on_near_duplicate)
+
+
+if __name__ == '__main__':
+    main()
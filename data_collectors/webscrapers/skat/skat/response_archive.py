@@ -0,0 +1,187 @@
+"""The raw responses SkatDocSpider parses, so a change to SkatDocSpider.parse or the pipeline (strip_html, sentence
+segmentation) can be applied by replaying the archive with skat/reprocess.py instead of crawling skat.dk again.
+
+Responses are WARC/1.0 response records, each compressed as its own gzip member, appended to data/archive/
+skat-NNNNN.warc.gz files of up to max_file_bytes. A file is a valid .warc.gz for standard WARC tools, while a single
+record can be read by decompressing only its member. The index, `<name>.archive.index.jsonl`, holds one line per
+record:
+
+    [url, warc file name, record offset, record length, WARC-Date, http status]
+
+A later line for the same url, from a recrawl, replaces an earlier one.
+"""
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+import base64
+import glob
+import gzip
+import hashlib
+import http.client
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timezone
+
+WARC_SUFFIX = '.warc.gz'
+# the body is stored decoded, these headers would not describe it
+SKIPPED_HEADERS = frozenset(['content-length', 'content-encoding', 'transfer-encoding'])
+
+
+class IndexEntry(NamedTuple):
+    url: str
+    file_name: str
+    offset: int
+    length: int
+    date: str
+    status: int
+
+
+class ArchivedResponse(NamedTuple):
+    url: str
+    status: int
+    headers: List[Tuple[str, str]]
+    body: bytes
+    date: str
+
+
+class ResponseArchiveWriter:
+    """Thread safe. Always starts a new file, so writing to an existing archive appends files and index lines."""
+
+    def __init__(self, archive_path: str, name: str = 'skat', max_file_bytes: int = 1024 ** 3):
+        self.archive_path = archive_path
+        self.name = name
+        self.max_file_bytes = max_file_bytes
+        self._lock = threading.Lock()
+
+        os.makedirs(archive_path, exist_ok=True)
+        self._index_fp = open(index_path(archive_path, name), 'a')
+        self._file_number: int = len(warc_paths(archive_path, name))
+        self._file_fp = None
+        self._file_name: str = ''
+        self.responses_written: int = 0
+
+    def __enter__(self) -> 'ResponseArchiveWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, url: str, status: int, headers: List[Tuple[str, str]], body: bytes) -> IndexEntry:
+        date: str = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        # compressed outside the lock, the threads of the pool only wait for each other to append
+        record: bytes = gzip.compress(warc_record(url, status, headers, body, date))
+
+        with self._lock:
+            if self._file_fp is None:
+                self._open_file()
+            entry = IndexEntry(url, self._file_name, self._file_fp.tell(), len(record), date, status)
+            self._file_fp.write(record)
+            self._file_fp.flush()
+            # the index line is only written once the record it points to is in the file
+            self._index_fp.write(f'{json.dumps(list(entry))}\n')
+            self._index_fp.flush()
+            self.responses_written += 1
+            if self._file_fp.tell() >= self.max_file_bytes:
+                self._close_file()
+
+        return entry
+
+    def close(self):
+        with self._lock:
+            if self._file_fp is not None:
+                self._close_file()
+            self._index_fp.close()
+
+    def _open_file(self):
+        self._file_name = f'{self.name}-{self._file_number:05d}{WARC_SUFFIX}'
+        self._file_fp = open(os.path.join(self.archive_path, self._file_name), 'xb')
+        self._file_number += 1
+
+    def _close_file(self):
+        os.fsync(self._file_fp.fileno())
+        self._file_fp.close()
+        self._file_fp = None
+
+
+class ResponseArchiveReader:
+    """The latest response of every url in an archive written by ResponseArchiveWriter"""
+
+    def __init__(self, archive_path: str, name: str = 'skat'):
+        self.archive_path = archive_path
+        self.name = name
+        self.index: Dict[str, IndexEntry] = {}
+        with open(index_path(archive_path, name), 'rb') as fp:
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    # the writer was killed while appending it
+                    break
+                entry = IndexEntry(*json.loads(line))
+                self.index[entry.url] = entry
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def __getitem__(self, url: str) -> ArchivedResponse:
+        return read_response(self.archive_path, self.index[url])
+
+    def entries(self) -> List[IndexEntry]:
+        """in the order they are stored, so reading them one after another reads the files sequentially"""
+        return sorted(self.index.values(), key=lambda entry: (entry.file_name, entry.offset))
+
+
+def warc_record(url: str, status: int, headers: List[Tuple[str, str]], body: bytes, date: str) -> bytes:
+    http_headers: List[str] = [f'{name}: {value}' for name, value in headers if name.lower() not in SKIPPED_HEADERS]
+    http_headers.append(f'Content-Length: {len(body)}')
+    http_block: bytes = '\r\n'.join([f'HTTP/1.1 {status} {http.client.responses.get(status, "")}'.rstrip(),
+                                     *http_headers, '', '']).encode('latin-1') + body
+    payload_digest: str = base64.b32encode(hashlib.sha1(body).digest()).decode('ascii')
+    warc_headers: List[str] = [
+        'WARC/1.0',
+        'WARC-Type: response',
+        f'WARC-Record-ID: <urn:uuid:{uuid.uuid4()}>',
+        f'WARC-Date: {date}',
+        f'WARC-Target-URI: {url}',
+        f'WARC-Payload-Digest: sha1:{payload_digest}',
+        'Content-Type: application/http; msgtype=response',
+        f'Content-Length: {len(http_block)}',
+    ]
+
+    return '\r\n'.join([*warc_headers, '', '']).encode('utf-8') + http_block + b'\r\n\r\n'
+
+
+def read_response(archive_path: str, entry: IndexEntry) -> ArchivedResponse:
+    with open(os.path.join(archive_path, entry.file_name), 'rb') as fp:
+        fp.seek(entry.offset)
+        record: bytes = gzip.decompress(fp.read(entry.length))
+
+    warc_header_end: int = record.index(b'\r\n\r\n')
+    block_length: Optional[int] = None
+    for line in record[:warc_header_end].split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            block_length = int(value)
+    block_start: int = warc_header_end + 4
+    http_block: bytes = record[block_start:block_start + block_length] if block_length is not None else record[block_start:]
+
+    http_header_end: int = http_block.index(b'\r\n\r\n')
+    status_line, *header_lines = http_block[:http_header_end].decode('latin-1').split('\r\n')
+    headers: List[Tuple[str, str]] = []
+    for line in header_lines:
+        name, _, value = line.partition(':')
+        headers.append((name.strip(), value.strip()))
+
+    return ArchivedResponse(entry.url, int(status_line.split()[1]), headers, http_block[http_header_end + 4:], entry.date)
+
+
+def index_path(archive_path: str, name: str = 'skat') -> str:
+    return os.path.join(archive_path, f'{name}.archive.index.jsonl')
+
+
+def warc_paths(archive_path: str, name: str = 'skat') -> List[str]:
+    return sorted(glob.glob(os.path.join(archive_path, f'{name}-[0-9]*{WARC_SUFFIX}')))
@@ -13,6 +13,40 @@ SPIDER_MODULES = ['skat.spiders']
 NEWSPIDER_MODULE = 'skat.spiders'
 
 LOG_LEVEL = 'INFO'
+
+# How SkatPipeline stores documents: 'files' (one file per document) or 'shards' (compressed JSONL shards with an
+# offset index, see data_writers/sharded_corpus.py)
+SKAT_OUTPUT_FORMAT = 'files'
+
+# SkatPipeline writes the metadata of the documents (skat.jsonl and the crawl state) in batches: every
+# SKAT_METADATA_BATCH_SIZE documents or every SKAT_METADATA_FLUSH_INTERVAL seconds, whichever comes first
+SKAT_METADATA_BATCH_SIZE = 100
+SKAT_METADATA_FLUSH_INTERVAL = 5
+
+# Also request urls SkatDocSpider has scraped before, conditionally (If-None-Match/If-Modified-Since, see
+# skat/middlewares.py), so only documents that changed since are downloaded and written again
+SKAT_RECRAWL = False
+
+# SkatDocSpider keeps reading data/urls.jsonl until SkatUrlSpider has finished, so documents are scraped while their
+# urls are still being found
+SKAT_FOLLOW_URLS = False
+
+# Documents nearly identical to one already written, by SkatDocSpider or the onlaw api builder, are 'link'ed (written
+# with near_duplicate_of in their metadata) or 'drop'ped. None turns the lookup off. SKAT_NEAR_DUPLICATE_INDEX defaults
+# to data/near_duplicates.sqlite in the repository root, shared with builders/build_section_from_onlaw_api.py.
+SKAT_ON_NEAR_DUPLICATE = 'link'
+SKAT_NEAR_DUPLICATE_INDEX = None
+
+# The raw responses SkatDocSpider parses are appended to a gzipped WARC archive with an index (skat/response_archive.py)
+# at SKAT_ARCHIVE_PATH, data/archive by default. `python -m skat.reprocess`, in the skat folder, replays it through the
+# parsing and the pipeline, so a change to either does not need a recrawl.
+SKAT_ARCHIVE_RESPONSES = True
+SKAT_ARCHIVE_PATH = None
+
+# Per stage latency histograms and counters (skat/metrics.py), written to SKAT_METRICS_PATH/<spider name>.metrics.json
+# and .prom every SKAT_METRICS_FLUSH_INTERVAL seconds. SKAT_METRICS_PATH defaults to the data folder.
+SKAT_METRICS_PATH = None
+SKAT_METRICS_FLUSH_INTERVAL = 30
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = 'skat (+http://www.yourdomain.com)'
 
@@ -44,21 +78,23 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-# SPIDER_MIDDLEWARES = {
-#    'skat.middlewares.SkatSpiderMiddleware': 543,
-# }
+SPIDER_MIDDLEWARES = {
+    'skat.metrics.ParseTimingMiddleware': 1000,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    'skat.middlewares.SkatDownloaderMiddleware': 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    'skat.middlewares.ConditionalRequestMiddleware': 950,
+    # below HttpCompressionMiddleware (590), so it archives decoded bodies
+    'skat.middlewares.ResponseArchiveMiddleware': 580,
+}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-# }
+EXTENSIONS = {
+    'skat.metrics.RunMetricsExtension': 500,
+}
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
@@ -1,13 +1,20 @@
-from typing import Set
+from typing import Iterator, Optional
 import os
 import json
 import lxml.html
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from skat import crawl_state
+from skat import middlewares
+from skat import url_checkpoint
 this_file_path = os.path.dirname(os.path.abspath(__file__))
 
 
 class SkatDocSpider(scrapy.Spider):
     name = 'SkatDocSpider'
+    # its responses are stored by ResponseArchiveMiddleware, for skat/reprocess.py
+    archive_responses = True
     custom_settings = {
         'ITEM_PIPELINES': {
             'skat.pipelines.SkatPipeline': 100
@@ -18,46 +25,103 @@ class SkatDocSpider(scrapy.Spider):
         self.collected_tokens: int = 0
         self.data_folder: str = os.path.abspath(os.path.join(this_file_path, '../../data'))
         self.url_file_path: str = os.path.join(self.data_folder, 'urls.json')
+        self.url_checkpoint_reader = url_checkpoint.UrlCheckpointReader(os.path.join(self.data_folder, 'urls.jsonl'))
         self.urls_already_scraped_file_path: str = os.path.join(self.data_folder, 'skat.jsonl')
-        self.urls_to_scrape: Set[str]
-        self.urls_already_scraped: Set[str]
-
-        if os.path.exists(self.urls_already_scraped_file_path):
-            with open(self.urls_already_scraped_file_path, 'r') as fp:
-                urls_already_scraped_info = fp.read()
-
-            self.urls_already_scraped = {json.loads(line)['uri'] for line in urls_already_scraped_info.splitlines()}
-
-            # TODO check tha data files are actually there!!!
-        else:
-            self.urls_already_scraped = set(())
-            self.logger.info(f'No already scraped urls file found at {self.urls_already_scraped_file_path}. Scraping all urls in {self.url_file_path}')
-
-        self.urls_to_scrape: Set[str] = self.load_urls()
-        # TODO load urls already scraped-> set difference
-
-    def load_urls(self):
-
+        self.crawl_state_path: str = os.path.join(self.data_folder, 'skat.state.sqlite')
+        self.crawl_state: crawl_state.CrawlState
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.open_crawl_state()
+        if crawler.settings.getbool('SKAT_FOLLOW_URLS'):
+            crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+
+        return spider
+
+    def open_crawl_state(self):
+        new_state: bool = not os.path.exists(self.crawl_state_path)
+        self.crawl_state = crawl_state.CrawlState(self.crawl_state_path)
+        # crawls from before the crawl state existed resumed from skat.jsonl, which is imported once
+        if new_state and os.path.exists(self.urls_already_scraped_file_path):
+            imported: int = self.crawl_state.import_jsonl(self.urls_already_scraped_file_path, self.output_path)
+            self.logger.info(f'imported #{imported} already scraped urls from {self.urls_already_scraped_file_path}')
+        self.logger.info(f'crawl state of #{len(self.crawl_state)} urls at {self.crawl_state_path}')
+
+    def closed(self, reason):
+        self.crawl_state.close()
+
+    def output_path(self, doc_id: str) -> str:
+        """where SkatPipeline writes a document, for shards the index which lists it"""
+        if self.settings.get('SKAT_OUTPUT_FORMAT', 'files') == 'shards':
+            return os.path.join(self.data_folder, 'skat.index.jsonl')
+
+        return os.path.join(self.data_folder, doc_id)
+
+    def load_urls(self) -> Iterator[str]:
+        if os.path.exists(self.url_checkpoint_reader.checkpoint_path) or self.settings.getbool('SKAT_FOLLOW_URLS'):
+            self.logger.info(f'urls are read from: "{self.url_checkpoint_reader.checkpoint_path}"')
+            yield from self.url_checkpoint_reader.new_urls()
+            return
+
+        # urls.json of SkatUrlSpider versions before the checkpoint
         self.logger.info(f'urls are read from: "{self.url_file_path}"')
         # read download file from local disk
         with open(self.url_file_path, 'r') as file_fp:
             url_dict = json.load(file_fp)
+        self.logger.info(f'loaded #{len(url_dict)} urls')
 
-        self.urls_in_url_file: Set[str] = {info['url']for uid, info in url_dict.items()}
-        self.logger.info(f'loaded #{len(self.urls_in_url_file)} to scrape')
+        for info in url_dict.values():
+            yield info['url']
 
-        urls_to_scrape: Set[str] = self.urls_in_url_file - self.urls_already_scraped
+    def is_scraped(self, url_state: Optional[crawl_state.UrlState]) -> bool:
+        if url_state is None or url_state.status != crawl_state.SCRAPED:
+            return False
+        if url_state.output_path is not None and not os.path.exists(url_state.output_path):
+            self.logger.warning(f'{url_state.url} was scraped but {url_state.output_path} is missing, scraping it again')
+            return False
 
-        return urls_to_scrape
+        return True
 
     def start_requests(self, headers: dict = None):
-
-        self.logger.info(f'Starting to scrape #{len(self.urls_to_scrape)} pages')
-        for url in self.urls_to_scrape:
-            request_args: dict = {'url': url, 'callback': self.parse}
+        return self.requests_for(self.load_urls())
+
+    def spider_idle(self, spider):
+        """with SKAT_FOLLOW_URLS, the spider waits for the urls SkatUrlSpider is still finding"""
+        if self.url_checkpoint_reader.finished:
+            return
+        for request in self.requests_for(self.url_checkpoint_reader.new_urls()):
+            self.crawler.engine.crawl(request, self)
+        raise DontCloseSpider
+
+    def requests_for(self, urls: Iterator[str]) -> Iterator[scrapy.Request]:
+        # requests are made while the urls are read, each url costs one lookup in the crawl state
+        recrawl: bool = self.settings.getbool('SKAT_RECRAWL')
+        already_scraped: int = 0
+        for url in urls:
+            url_state: Optional[crawl_state.UrlState] = self.crawl_state.get(url)
+            meta: dict = {}
+            if self.is_scraped(url_state):
+                already_scraped += 1
+                if not recrawl:
+                    continue
+                # made conditional by ConditionalRequestMiddleware
+                meta[middlewares.URL_STATE_KEY] = url_state
 
             self.logger.info(f'starting to scrape this document\n{50*"-"}\n{url}\n{50*"-"}\n')
-            yield scrapy.Request(**request_args)
+            yield scrapy.Request(url=url, callback=self.parse, errback=self.record_failure, meta=meta)
+        if already_scraped:
+            self.logger.info(f'{"checking" if recrawl else "skipped"} #{already_scraped} already scraped urls')
+
+    def record_failure(self, failure):
+        url: str = failure.request.url
+        if failure.check(middlewares.NotModified):
+            self.crawl_state.not_modified(url)
+            return
+        self.logger.warning(f'failed to scrape {url}: {failure.value!r}')
+        # a document scraped earlier stays scraped when checking it for changes fails
+        if middlewares.URL_STATE_KEY not in failure.request.meta:
+            self.crawl_state.record(url, crawl_state.FAILED)
 
     def parse(self, response):
         content: list = response.xpath('//div[@class="MPtext"]').extract()[0].split('<hr class="LineDelimiter">')
@@ -80,6 +144,9 @@ class SkatDocSpider(scrapy.Spider):
         data['body'] = f'{resume}.\n{body}'
 
         data['url'] = response.url
+        # validators for conditional recrawls, stored in the crawl state by SkatPipeline
+        data['etag'] = response.headers.get('ETag', b'').decode('latin-1') or None
+        data['last_modified'] = response.headers.get('Last-Modified', b'').decode('latin-1') or None
 
         return data
 
@@ -1,73 +1,80 @@
+from typing import Iterable, Iterator, List, Tuple
 import os
-import json
 from datetime import datetime
 import scrapy
+from skat import url_checkpoint
 this_file_path = os.path.dirname(os.path.abspath(__file__))
 
 
 class SkatUrlSpider(scrapy.Spider):
+    """Finds the urls of the rulings in the result tabs of skat.dk. The tabs linked from the start page, and from every
+    tab page, are fetched concurrently and the urls of a tab are appended to the checkpoint, data/urls.jsonl, once it
+    is parsed. See skat/url_checkpoint.py."""
     name = 'SkatUrlSpider'
 
     def __init__(self, **kwargs):
-        self.url_info: dict = {}
-
         self.url_file_folder: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data')
         if not os.path.exists(self.url_file_folder):
             self.logger.info(f'creating data folder at "{self.url_file_folder}"')
             os.mkdir(self.url_file_folder)
 
+        self.url_checkpoint = url_checkpoint.UrlCheckpoint(os.path.join(self.url_file_folder, 'urls.jsonl'))
+        if self.url_checkpoint.completed_tabs:
+            self.logger.info(f'resuming, #{len(self.url_checkpoint.completed_tabs)} tabs were already collected')
+        self.urls_found: int = 0
+
     def closed(self, reason):
-        
         if reason == 'finished':
-            self.logger.info(f'found {len(self.url_info)} urls in total')
-
-            # write url file to local file
-            with open(f'{self.url_file_folder}/urls.json', 'w') as file:
-                json.dump(self.url_info, file)
+            self.url_checkpoint.finish()
+            self.logger.info(f'found {self.urls_found} urls in total')
+        self.url_checkpoint.close()
 
     def start_requests(self):
         start_url = "http://skat.dk/skat.aspx?oid=9464"  # year 2018 view url
 
-        yield scrapy.Request(url=start_url, callback=self.go_to_tab_for_most_recent_year)
+        yield scrapy.Request(url=start_url, callback=self.discover_tabs)
+        yield from self.tab_requests(self.url_checkpoint.linked_tabs)
 
-    def go_to_tab_for_most_recent_year(self, response):
+    def discover_tabs(self, response):
+        """requests every result tab linked from this page"""
+        return self.tab_requests(self.tab_links(response))
 
-        relative_url_to_most_recent_tab: str = response.xpath('//div[@class="reportTab reportTab-n1"]/a/@href').extract_first()
-        absolute_url_to_most_recent_tab: str = response.urljoin(relative_url_to_most_recent_tab)
+    def tab_links(self, response) -> List[str]:
+        relative_urls_to_tabs: List[str] = response.xpath('//div[contains(@class, "reportTab")]//a/@href').extract()
 
-        yield scrapy.Request(url=absolute_url_to_most_recent_tab, callback=self.parse)
+        return [response.urljoin(relative_url_to_tab) for relative_url_to_tab in relative_urls_to_tabs]
+
+    def tab_requests(self, tab_urls: Iterable[str]) -> Iterator[scrapy.Request]:
+        """of the tabs which were not collected before, scrapy drops requests for tabs already requested"""
+        for tab_url in tab_urls:
+            if tab_url not in self.url_checkpoint.completed_tabs:
+                yield scrapy.Request(url=tab_url, callback=self.parse)
 
     def parse(self, response):
         # Logging URL
         self.logger.info('%s URL: %s', 'SkatUrlSpider.parse', response.url)
 
         # get results
-        self.parse_result(response)
-        # Get next tab after active tab
-        next_page = response.xpath(
-            '//div[contains(@class, "reportTabActive")]/following-sibling::div[contains(@class, "reportTab")]//a/@href').extract_first()
-
-        # crawl next result page
-        if next_page is not None:
-            next_page = response.urljoin(next_page)
-            yield scrapy.Request(next_page, callback=self.parse)
+        urls: List[Tuple[str, str]] = list(self.parse_result(response))
+        # a tab may link tabs which the start page does not
+        tab_links: List[str] = self.tab_links(response)
+        self.url_checkpoint.add_tab(response.url, urls, tab_links)
+        self.urls_found += len(urls)
 
-    def parse_result(self, response):
+        yield from self.tab_requests(tab_links)
 
-        # there are many urls on each page. Each of which are collected in this dict of dicts
+    def parse_result(self, response) -> Iterator[Tuple[str, str]]:
+        """(case number, url) of every ruling on the page"""
         rows = response.xpath('//tr[contains(@class, "TableRow TableRowligningsrådet")]')
 
         for row in rows:
             case_number: str = row.xpath('.//td[@class="bleg report report-r3 text-nowrap"]/text()').extract_first()
             # if no case number skip case
             if case_number is None:
-                return None
+                continue
 
             url_relative = row.xpath('.//a[contains(@class, "normal")]/@href').extract_first()
-            url_abs = response.urljoin(url_relative)
-
-            # add to dict holding all urls
-            self.url_info[case_number] = {'url': url_abs}
+            yield case_number, response.urljoin(url_relative)
 
     def get_date(self, strDate):
         if strDate is not None:
@@ -0,0 +1,103 @@
+"""The urls SkatUrlSpider discovers, appended to data/urls.jsonl as soon as a result tab is parsed. One json object per
+line:
+
+    {"started": "<time>"}                       a crawl started
+    {"case_number": "...", "url": "..."}        a document url
+    {"tab": "<tab url>", "links": [...]}        every url of this result tab is above, links: the tabs it links to
+    {"finished": "<time>"}                      the crawl finished
+
+An interrupted crawl resumes after the tabs it completed, and SkatDocSpider can read the urls while they are found.
+A url may be listed more than once.
+"""
+from typing import Iterable, Iterator, List, Set, Tuple
+import json
+import os
+from datetime import datetime, timezone
+
+
+class UrlCheckpoint:
+    """written by SkatUrlSpider"""
+
+    def __init__(self, checkpoint_path: str):
+        self.checkpoint_path = checkpoint_path
+        # tabs linked from completed tabs, a resumed crawl may not find them otherwise
+        self.linked_tabs: Set[str] = set()
+        self.completed_tabs: Set[str] = self._completed_tabs()
+        self.fp = open(checkpoint_path, 'a')
+        if not self.completed_tabs:
+            self._append([{'started': _now()}])
+
+    def close(self):
+        self.fp.close()
+
+    def _completed_tabs(self) -> Set[str]:
+        """tabs completed by an unfinished crawl, which this crawl does not need to fetch again"""
+        completed_tabs: Set[str] = set()
+        if not os.path.exists(self.checkpoint_path):
+            return completed_tabs
+
+        complete_lines_length: int = 0
+        with open(self.checkpoint_path, 'rb') as fp:
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break
+                complete_lines_length += len(line)
+                entry: dict = json.loads(line)
+                if 'tab' in entry:
+                    completed_tabs.add(entry['tab'])
+                    self.linked_tabs.update(entry.get('links', []))
+                elif 'finished' in entry:
+                    completed_tabs, self.linked_tabs = set(), set()
+        # the crawl was killed while writing, the next line must not be appended to half a line
+        os.truncate(self.checkpoint_path, complete_lines_length)
+
+        return completed_tabs
+
+    def add_tab(self, tab_url: str, urls: Iterable[Tuple[str, str]], tab_links: List[str]):
+        """urls: (case number, url) of every document listed on the tab"""
+        entries: list = [{'case_number': case_number, 'url': url} for case_number, url in urls]
+        entries.append({'tab': tab_url, 'links': tab_links})
+        self._append(entries)
+        self.completed_tabs.add(tab_url)
+
+    def finish(self):
+        self._append([{'finished': _now()}])
+        self.completed_tabs, self.linked_tabs = set(), set()
+
+    def _append(self, entries: list):
+        # whole lines only, a reader never sees half a tab
+        self.fp.write(''.join(f'{json.dumps(entry)}\n' for entry in entries))
+        self.fp.flush()
+
+
+class UrlCheckpointReader:
+    """reads the urls from the checkpoint while SkatUrlSpider may still be appending to it"""
+
+    def __init__(self, checkpoint_path: str):
+        self.checkpoint_path = checkpoint_path
+        self.offset: int = 0
+        self.finished: bool = False
+
+    def new_urls(self) -> Iterator[str]:
+        """the urls appended since the last call"""
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, 'rb') as fp:
+            fp.seek(self.offset)
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    # still being written
+                    break
+                self.offset += len(line)
+                entry: dict = json.loads(line)
+                if 'url' in entry:
+                    self.finished = False
+                    yield entry['url']
+                elif 'started' in entry:
+                    self.finished = False
+                elif 'finished' in entry:
+                    self.finished = True
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
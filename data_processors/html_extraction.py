@@ -0,0 +1,170 @@
+from typing import Iterable, List, Optional, Union
+from concurrent.futures import Future, ProcessPoolExecutor
+import asyncio
+import os
+import lxml.html
+import lxml.etree
+
+
+def strip_html(html: str) -> str:
+    """text of html without tables, with all whitespace collapsed to single spaces"""
+    parsed_html = lxml.html.fromstring(html)
+
+    for table in parsed_html.xpath('//table'):
+        table.getparent().remove(table)
+
+    all_content_no_html = ' '.join(lxml.etree.XPath("//text()")(parsed_html))
+
+    content_no_extra_whitespaces = ' '.join(all_content_no_html.split())
+
+    return content_no_extra_whitespaces
+
+
+def strip_html_streaming(html: Union[str, bytes, Iterable[Union[str, bytes]]], chunk_size: int = 65536) -> str:
+    """same output as strip_html, in a single pass over the html without building a tree.
+
+    Table subtrees are skipped while parsing and whitespace is collapsed as text arrives, so peak memory follows
+    the size of the text rather than the size of the DOM. html may also be an iterable of chunks, e.g. an open file.
+    """
+    target = _TextWithoutTablesTarget()
+    parser = lxml.etree.HTMLParser(target=target)
+
+    if isinstance(html, (str, bytes)):
+        for start in range(0, len(html), chunk_size):
+            parser.feed(html[start:start + chunk_size])
+    else:
+        for chunk in html:
+            parser.feed(chunk)
+
+    return parser.close()
+
+
+class _TextWithoutTablesTarget:
+    """lxml parser target collecting whitespace normalised text outside of tables.
+
+    Mirrors strip_html: table subtrees are dropped together with the text following the outermost table (lxml drops
+    an element's tail when it is removed), and every text node is separated from the next by whitespace.
+    """
+
+    def __init__(self):
+        self.text_nodes: List[str] = []
+        self.text_buffer: List[str] = []
+        self.table_depth: int = 0
+        self.in_table_tail: bool = False
+
+    def start(self, tag, attrib):
+        self._end_of_text_node()
+        if tag == 'table':
+            self.table_depth += 1
+
+    def end(self, tag):
+        self._end_of_text_node()
+        if tag == 'table' and self.table_depth:
+            self.table_depth -= 1
+            self.in_table_tail = self.table_depth == 0
+
+    def data(self, data: str):
+        # the parser may deliver one text node in several pieces
+        if not self.table_depth and not self.in_table_tail:
+            self.text_buffer.append(data)
+
+    def comment(self, text: str):
+        self._end_of_text_node()
+
+    def pi(self, target: str, data: str = None):
+        self._end_of_text_node()
+
+    def close(self) -> str:
+        self._end_of_text_node()
+        return ' '.join(self.text_nodes)
+
+    def _end_of_text_node(self):
+        self.in_table_tail = False
+        if self.text_buffer:
+            text_node: str = ' '.join(''.join(self.text_buffer).split())
+            if text_node:
+                self.text_nodes.append(text_node)
+            self.text_buffer = []
+
+
+def strip_html_batch(htmls: List[str], streaming: bool = False) -> List[str]:
+    strip = strip_html_streaming if streaming else strip_html
+    return [strip(html) for html in htmls]
+
+
+def extract_many(htmls: Iterable[str], processes: Optional[int] = None, chunksize: int = 16,
+                 streaming: bool = False) -> List[str]:
+    """strip_html of every html, spread over a short-lived process pool. Output order follows input order."""
+    with HtmlExtractor(processes, chunksize=chunksize, streaming=streaming) as extractor:
+        return extractor.extract_many(htmls)
+
+
+class HtmlExtractor:
+    """Process pool running strip_html.
+
+    Documents are sent to the workers in chunks of `chunksize` so the pickling/IPC cost is paid per chunk instead of
+    per document. Can be used from plain code (extract_many), asyncio (extract_async, extract_many_async) and
+    twisted/scrapy (extract_deferred) without blocking the calling thread or event loop.
+    """
+
+    def __init__(self, processes: Optional[int] = None, chunksize: int = 16, mp_context=None, streaming: bool = False):
+        """streaming: use strip_html_streaming instead of strip_html, which keeps memory low on very large documents"""
+        self.processes: int = processes or os.cpu_count() or 1
+        self.chunksize = chunksize
+        self.streaming = streaming
+        self.strip = strip_html_streaming if streaming else strip_html
+        self.mp_context = mp_context
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self) -> 'HtmlExtractor':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.processes, mp_context=self.mp_context)
+
+    def shutdown(self, wait: bool = True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+    def extract_many(self, htmls: Iterable[str]) -> List[str]:
+        self.start()
+        return list(self.executor.map(self.strip, htmls, chunksize=self.chunksize))  # type: ignore
+
+    def submit(self, html: str) -> Future:
+        self.start()
+        return self.executor.submit(self.strip, html)  # type: ignore
+
+    async def extract_async(self, html: str) -> str:
+        return await asyncio.wrap_future(self.submit(html))
+
+    async def extract_many_async(self, htmls: List[str]) -> List[str]:
+        self.start()
+        loop = asyncio.get_running_loop()
+        chunks = [htmls[i:i + self.chunksize] for i in range(0, len(htmls), self.chunksize)]
+        texts_per_chunk = await asyncio.gather(*[loop.run_in_executor(self.executor, strip_html_batch, chunk, self.streaming)
+                                                 for chunk in chunks])
+
+        return [text for texts in texts_per_chunk for text in texts]
+
+    def extract_deferred(self, html: str):
+        """twisted Deferred firing with the text. Must be called from the reactor thread."""
+        from twisted.internet import defer, reactor
+
+        deferred = defer.Deferred()
+
+        def on_done(future: Future):
+            exception = future.exception()
+            if exception is not None:
+                reactor.callFromThread(deferred.errback, exception)
+            else:
+                reactor.callFromThread(deferred.callback, future.result())
+
+        self.submit(html).add_done_callback(on_done)
+
+        return deferred
@@ -0,0 +1,271 @@
+"""Near-duplicate detection with MinHash signatures and locality sensitive hashing (LSH), so the same ruling fetched
+from the onlaw api and scraped from skat.dk is only stored once.
+
+A signature is a one permutation MinHash (Li, Owen, Zhang 2012): every shingle of SHINGLE_SIZE words is hashed once
+into one of SIGNATURE_SIZE bins and each bin keeps its smallest value, empty bins are filled from the next non-empty
+bin (rotation densification). The fraction of bins two signatures agree on estimates the jaccard similarity of their
+shingles. Signatures of a batch of texts are computed with numpy if it is installed, otherwise in plain python, both
+give the same signatures.
+
+NearDuplicateIndex keeps the signatures in sqlite, indexed by BANDS bands of ROWS bins each: documents sharing a band
+are candidates, which are then compared on the whole signature. Memory use does not grow with the index.
+"""
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple
+from array import array
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+    import numpy
+except ImportError:  # signatures are computed in plain python without numpy, a few times slower
+    numpy = None
+
+SHINGLE_SIZE: int = 5
+SIGNATURE_SIZE: int = 128
+BANDS: int = 16
+ROWS: int = SIGNATURE_SIZE // BANDS
+# candidates share a band with probability 1 - (1 - s^ROWS)^BANDS, about 50% at a similarity s of 0.7 and 99% at 0.85
+
+_MASK: int = 2 ** 64 - 1
+_EMPTY: int = _MASK
+_SHINGLE_MULTIPLIER: int = 0x100000001B3
+_LEAVING_WORD_FACTOR: int = pow(_SHINGLE_MULTIPLIER, SHINGLE_SIZE - 1, 2 ** 64)
+_DENSIFY_OFFSET: int = 0x9E3779B97F4A7C15
+_BIN_BITS: int = SIGNATURE_SIZE.bit_length() - 1
+
+
+class Match(NamedTuple):
+    source: str
+    doc_id: str
+    similarity: float
+
+
+def signature(text: str) -> Optional[List[int]]:
+    return signatures([text])[0]
+
+
+def signatures(texts: Sequence[str]) -> List[Optional[List[int]]]:
+    """None for texts without words"""
+    word_hashes: List[List[int]] = _word_hashes(texts)
+    if numpy is not None:
+        return _signatures_numpy(word_hashes)
+
+    return [_signature_python(hashes) for hashes in word_hashes]
+
+
+def similarity(signature_a: Sequence[int], signature_b: Sequence[int]) -> float:
+    return sum(a == b for a, b in zip(signature_a, signature_b)) / SIGNATURE_SIZE
+
+
+def _word_hashes(texts: Sequence[str]) -> List[List[int]]:
+    """each distinct word of the batch is hashed once, most words of a text are repeats"""
+    words: List[List[str]] = [text.lower().split() for text in texts]
+    hashes: dict = {}
+    for text_words in words:
+        for word in set(text_words).difference(hashes):
+            hashes[word] = zlib.crc32(word.encode('utf-8'))
+
+    return [list(map(hashes.__getitem__, text_words)) for text_words in words]
+
+
+def _signature_python(word_hashes: List[int]) -> Optional[List[int]]:
+    if not word_hashes:
+        return None
+    bins: List[int] = [_EMPTY] * SIGNATURE_SIZE
+    shingle_hash: int = 0
+    for word_hash in word_hashes[:SHINGLE_SIZE]:
+        shingle_hash = (shingle_hash * _SHINGLE_MULTIPLIER + word_hash) & _MASK
+    # the next shingle's hash is rolled from this one: the word leaving it is taken out and the word entering it added
+    leaving_and_entering = zip(word_hashes, word_hashes[SHINGLE_SIZE:])
+    while True:
+        value: int = _mix(shingle_hash)
+        bin_: int = value & (SIGNATURE_SIZE - 1)
+        value >>= _BIN_BITS
+        if value < bins[bin_]:
+            bins[bin_] = value
+        words: Optional[Tuple[int, int]] = next(leaving_and_entering, None)
+        if words is None:
+            break
+        shingle_hash = ((shingle_hash - words[0] * _LEAVING_WORD_FACTOR) * _SHINGLE_MULTIPLIER + words[1]) & _MASK
+
+    return _densify(bins)
+
+
+def _signatures_numpy(word_hashes: List[List[int]]) -> List[Optional[List[int]]]:
+    """all shingles of the batch are hashed and binned at once"""
+    shingle_hashes: List = []
+    for hashes in word_hashes:
+        words = numpy.array(hashes, dtype=numpy.uint64)
+        shingles: int = max(1, len(hashes) - SHINGLE_SIZE + 1)
+        shingle_hash = numpy.zeros(shingles if hashes else 0, dtype=numpy.uint64)
+        for offset in range(min(SHINGLE_SIZE, len(hashes))):
+            # uint64 arithmetic wraps around like the & _MASK in _signature_python
+            shingle_hash = shingle_hash * numpy.uint64(_SHINGLE_MULTIPLIER) + words[offset:offset + shingles]
+        shingle_hashes.append(shingle_hash)
+
+    all_hashes = _mix_numpy(numpy.concatenate(shingle_hashes)) if shingle_hashes else numpy.zeros(0, dtype=numpy.uint64)
+    text_index = numpy.repeat(numpy.arange(len(word_hashes)), [len(hashes) for hashes in shingle_hashes])
+    slots = text_index * SIGNATURE_SIZE + (all_hashes & numpy.uint64(SIGNATURE_SIZE - 1)).astype(numpy.int64)
+    bins = numpy.full(len(word_hashes) * SIGNATURE_SIZE, _EMPTY, dtype=numpy.uint64)
+    numpy.minimum.at(bins, slots, all_hashes >> numpy.uint64(_BIN_BITS))
+
+    rows = bins.reshape(len(word_hashes), SIGNATURE_SIZE).tolist()
+    return [_densify(row) if hashes else None for row, hashes in zip(rows, word_hashes)]
+
+
+def _mix(value: int) -> int:
+    """splitmix64's finaliser, spreads the shingle hashes over all 64 bits"""
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK
+    return value ^ (value >> 31)
+
+
+def _mix_numpy(values):
+    values = (values ^ (values >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return values ^ (values >> numpy.uint64(31))
+
+
+def _densify(bins: List[int]) -> List[int]:
+    """an empty bin takes the value of the next non-empty one, shifted by how far away that is"""
+    if all(value != _EMPTY for value in bins):
+        return bins
+    densified: List[int] = list(bins)
+    for bin_, value in enumerate(bins):
+        if value != _EMPTY:
+            continue
+        distance: int = 1
+        while bins[(bin_ + distance) % SIGNATURE_SIZE] == _EMPTY:
+            distance += 1
+        densified[bin_] = (bins[(bin_ + distance) % SIGNATURE_SIZE] + distance * _DENSIFY_OFFSET) & _MASK
+
+    return densified
+
+
+class NearDuplicateIndex:
+    """Signatures of the documents of every source, kept in sqlite. Thread safe, and several processes may share it.
+
+    find_or_add looks a document up and adds it in one transaction, so of two near-duplicates written at the same
+    time the second one always finds the first. A document never matches itself, i.e. the same source and doc_id, so
+    a rebuild or recrawl replaces a document's signature instead of finding it as its own duplicate.
+    """
+
+    def __init__(self, index_path: str, threshold: float = 0.8, timeout: float = 60.0):
+        """threshold: estimated jaccard similarity of the shingles from which documents are near-duplicates"""
+        self.index_path = index_path
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(index_path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS signatures (
+                source TEXT NOT NULL,
+                doc_id TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                added_at REAL NOT NULL,
+                PRIMARY KEY (source, doc_id)
+            );
+            CREATE TABLE IF NOT EXISTS bands (
+                band_hash INTEGER NOT NULL,
+                source TEXT NOT NULL,
+                doc_id TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS bands_band_hash ON bands (band_hash);
+            CREATE INDEX IF NOT EXISTS bands_document ON bands (source, doc_id);
+        ''')
+
+    def __enter__(self) -> 'NearDuplicateIndex':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.connection.execute('SELECT COUNT(*) FROM signatures').fetchone()[0]
+
+    def find(self, signature_: Sequence[int], source: Optional[str] = None, doc_id: Optional[str] = None) -> Optional[Match]:
+        """the most similar document at or above the threshold, other than source/doc_id itself"""
+        with self._lock:
+            return self._find(signature_, _band_hashes(signature_), source, doc_id)
+
+    def add(self, source: str, doc_id: str, signature_: Sequence[int]):
+        with self._lock, _Transaction(self.connection):
+            self._add(source, doc_id, signature_, _band_hashes(signature_))
+
+    def find_or_add(self, source: str, doc_id: str, signature_: Sequence[int]) -> Optional[Match]:
+        """the near-duplicate of the document if there is one, otherwise the document is added"""
+        band_hashes: List[int] = _band_hashes(signature_)
+        with self._lock, _Transaction(self.connection):
+            match: Optional[Match] = self._find(signature_, band_hashes, source, doc_id)
+            if match is None:
+                self._add(source, doc_id, signature_, band_hashes)
+
+        return match
+
+    def remove(self, source: str, doc_ids: Iterable[str]):
+        with self._lock, _Transaction(self.connection):
+            for doc_id in doc_ids:
+                self._remove(source, doc_id)
+
+    def remove_source(self, source: str):
+        """all documents of a source, e.g. before it is built again from scratch under new doc_ids"""
+        with self._lock, _Transaction(self.connection):
+            self.connection.execute('DELETE FROM signatures WHERE source = ?', (source,))
+            self.connection.execute('DELETE FROM bands WHERE source = ?', (source,))
+
+    def _find(self, signature_: Sequence[int], band_hashes: List[int], source: Optional[str],
+              doc_id: Optional[str]) -> Optional[Match]:
+        candidates = self.connection.execute(
+            f'SELECT DISTINCT s.source, s.doc_id, s.signature FROM bands b JOIN signatures s '
+            f'ON s.source = b.source AND s.doc_id = b.doc_id WHERE b.band_hash IN ({", ".join("?" * len(band_hashes))})',
+            band_hashes).fetchall()
+        best: Optional[Match] = None
+        for candidate_source, candidate_doc_id, candidate_signature in candidates:
+            if candidate_source == source and candidate_doc_id == doc_id:
+                continue
+            similarity_: float = similarity(signature_, array('Q', candidate_signature))
+            if similarity_ >= self.threshold and (best is None or similarity_ > best.similarity):
+                best = Match(candidate_source, candidate_doc_id, similarity_)
+
+        return best
+
+    def _add(self, source: str, doc_id: str, signature_: Sequence[int], band_hashes: List[int]):
+        self._remove(source, doc_id)
+        self.connection.execute('INSERT INTO signatures (source, doc_id, signature, added_at) VALUES (?, ?, ?, ?)',
+                                (source, doc_id, array('Q', signature_).tobytes(), time.time()))
+        self.connection.executemany('INSERT INTO bands (band_hash, source, doc_id) VALUES (?, ?, ?)',
+                                    [(band_hash, source, doc_id) for band_hash in band_hashes])
+
+    def _remove(self, source: str, doc_id: str):
+        self.connection.execute('DELETE FROM signatures WHERE source = ? AND doc_id = ?', (source, doc_id))
+        self.connection.execute('DELETE FROM bands WHERE source = ? AND doc_id = ?', (source, doc_id))
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE, so two processes sharing the index cannot both miss each other's duplicate"""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+def _band_hashes(signature_: Sequence[int]) -> List[int]:
+    """one signed 64 bit integer per band, the band number is part of the hash"""
+    band_hashes: List[int] = []
+    for band in range(BANDS):
+        rows: bytes = array('Q', [band, *signature_[band * ROWS:(band + 1) * ROWS]]).tobytes()
+        band_hashes.append(int.from_bytes(hashlib.blake2b(rows, digest_size=8).digest(), 'little', signed=True))
+
+    return band_hashes
@@ -0,0 +1,50 @@
+"""Text of pdf files through poppler's `pdftotext` (apt install poppler-utils).
+
+pdftotext runs in its own process and reads the pdf from disk, so even very large files never have to be held in
+memory by the build, and a thread pool is enough to keep all cores busy.
+"""
+from typing import Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import subprocess
+
+
+def pdf_to_text(pdf: Union[str, bytes], timeout: Optional[float] = 600) -> str:
+    """pdf: path of a pdf file or the pdf itself. Whitespace is collapsed like in html_extraction.strip_html"""
+    if isinstance(pdf, bytes):
+        source, pdf_bytes = '-', pdf
+    else:
+        source, pdf_bytes = pdf, None
+
+    completed_process = subprocess.run(['pdftotext', '-q', '-enc', 'UTF-8', source, '-'],
+                                       input=pdf_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                       timeout=timeout, check=True)
+
+    return ' '.join(completed_process.stdout.decode('utf-8', errors='replace').split())
+
+
+class PdfExtractor:
+    def __init__(self, workers: Optional[int] = None):
+        self.workers: int = workers or os.cpu_count() or 1
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def __enter__(self) -> 'PdfExtractor':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers)
+
+    def shutdown(self, wait: bool = True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+    async def extract_async(self, pdf: Union[str, bytes]) -> str:
+        self.start()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, pdf_to_text, pdf)
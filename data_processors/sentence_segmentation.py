@@ -0,0 +1,214 @@
+"""Sentence boundaries and token counts of Danish (legal) text, written into the metadata of every document so users of
+the corpus do not have to segment it again.
+
+A sentence ends at . ! ? or … followed by whitespace, unless
+    - the next word starts with a lower case letter (ordinals, "den 1. januar", and most abbreviations)
+    - the word before the full stop is in ABBREVIATIONS ("jf. § 2", "stk. 3", "nr. 5", "bl.a. SKM2019.123")
+    - the word before the full stop is a single capital letter (initials)
+Tokens are the whitespace separated words with at least one letter or digit, so "SKM2019.123.LSR", "1.000,50" and
+"(jf." are single tokens and a "§" or "–" on its own is none.
+"""
+from typing import Iterable, List, Optional, Tuple
+from concurrent.futures import Future, ProcessPoolExecutor
+import asyncio
+import itertools
+import os
+import re
+import threading
+from data_processors import near_duplicates
+
+# lower case, without the final full stop
+ABBREVIATIONS: frozenset = frozenset([
+    'jf', 'jfr', 'jvf', 'cf', 'sml', 'stk', 'nr', 'j.nr', 'jnr', 'pkt', 'litra', 'afsn', 'kap', 'art', 'bek', 'lbk',
+    'cirk', 'vejl', 'skr', 'udg', 's', 'ff', 'bl.a', 'bl', 'f.eks', 'f.x', 'fx', 'm.fl', 'mfl', 'm.m', 'o.l', 'ol',
+    'ca', 'evt', 'inkl', 'ekskl', 'vedr', 'ang', 'iflg', 'ifm', 'i.h.t', 'iht', 'pga', 'p.g.a', 'mht', 'm.h.t', 'dvs',
+    'd.v.s', 'hhv', 'h.h.v', 'tilsv', 'tidl', 'fhv', 'pr', 'kl', 'tlf', 'adm', 'dir', 'afd', 'dr', 'hr', 'fr', 'prof',
+    'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'okt', 'nov', 'dec',
+])
+
+SENTENCE_END = re.compile(r'[.!?…]+["\')\]»”’]*(?=\s|$)')
+WORD_BEFORE = re.compile(r'[("\'«“‘\[]*(\S*?)$')
+NEXT_CHARACTER = re.compile(r'\s*(\S)')
+# the extractors collapse whitespace into single spaces, elsewhere punctuation next to a line break counts as a token
+PUNCTUATION_WORD = re.compile(r' [^\w\s]+(?= )')
+# words are looked for this far back, longer words are no abbreviations
+WORD_BEFORE_MAX_LENGTH = 24
+
+
+def sentence_spans(text: str) -> List[Tuple[int, int]]:
+    """[start, end) character offsets of the sentences, without surrounding whitespace"""
+    spans: List[Tuple[int, int]] = []
+    start: int = 0
+    for match in SENTENCE_END.finditer(text):
+        if _ends_sentence(text, match):
+            _append_span(spans, text, start, match.end())
+            start = match.end()
+    _append_span(spans, text, start, len(text))
+
+    return spans
+
+
+def sentences(text: str) -> List[str]:
+    return [text[start:end] for start, end in sentence_spans(text)]
+
+
+def count_tokens(text: str) -> int:
+    # a few times faster than matching every word with a regex
+    return len(text.split()) - len(PUNCTUATION_WORD.findall(f' {text} '))
+
+
+def analyze(text: str, minhash: bool = False) -> dict:
+    """metadata of a document: 'sentences', the [start, end) offsets of its sentences, and 'token_count'.
+    minhash: also 'minhash', the near_duplicates.signature of the text"""
+    return analyze_batch([text], minhash)[0]
+
+
+def analyze_batch(texts: List[str], minhash: bool = False) -> List[dict]:
+    metadatas: List[dict] = [{'sentences': [list(span) for span in sentence_spans(text)], 'token_count': count_tokens(text)}
+                             for text in texts]
+    if minhash:
+        for metadata, signature in zip(metadatas, near_duplicates.signatures(texts)):
+            metadata['minhash'] = signature
+
+    return metadatas
+
+
+def _ends_sentence(text: str, match) -> bool:
+    next_character = NEXT_CHARACTER.match(text, match.end())
+    if next_character is None:
+        return True
+    if next_character.group(1).islower():
+        return False
+    if not match.group().startswith('.'):
+        return True
+
+    word: str = WORD_BEFORE.search(text, max(0, match.start() - WORD_BEFORE_MAX_LENGTH), match.start()).group(1)
+    if word.lower() in ABBREVIATIONS:
+        return False
+
+    return not (len(word) == 1 and word.isupper())
+
+
+def _append_span(spans: List[Tuple[int, int]], text: str, start: int, end: int):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    if start < end:
+        spans.append((start, end))
+
+
+class TextAnalyzer:
+    """Process pool running analyze on batches of documents.
+
+    Documents submitted one at a time are collected into batches of batch_size, or whatever arrived within
+    max_delay seconds, so the pickling/IPC cost is paid per batch. Like html_extraction.HtmlExtractor it can be used
+    from plain code (analyze_many), asyncio (analyze_async) and twisted/scrapy (analyze_deferred).
+    """
+
+    def __init__(self, processes: Optional[int] = None, batch_size: int = 32, max_delay: float = 0.01, mp_context=None,
+                 minhash: bool = False):
+        """minhash: add the near_duplicates.signature of every text, computed for the whole batch at once"""
+        self.processes: int = processes or os.cpu_count() or 1
+        self.minhash = minhash
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.mp_context = mp_context
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._batch: List[Tuple[str, Future]] = []
+        self._timer: Optional[threading.Timer] = None
+
+    def __enter__(self) -> 'TextAnalyzer':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.processes, mp_context=self.mp_context)
+
+    def shutdown(self, wait: bool = True):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+    def analyze_many(self, texts: Iterable[str]) -> List[dict]:
+        self.start()
+        return list(self.executor.map(analyze, texts, itertools.repeat(self.minhash), chunksize=self.batch_size))  # type: ignore
+
+    def submit(self, text: str) -> Future:
+        self.start()
+        future: Future = Future()
+        with self._lock:
+            self._batch.append((text, future))
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        return future
+
+    async def analyze_async(self, text: str) -> dict:
+        return await asyncio.wrap_future(self.submit(text))
+
+    def analyze_deferred(self, text: str):
+        """twisted Deferred firing with the metadata. Must be called from the reactor thread."""
+        from twisted.internet import defer, reactor
+
+        deferred = defer.Deferred()
+
+        def on_done(future: Future):
+            exception = future.exception()
+            if exception is not None:
+                reactor.callFromThread(deferred.errback, exception)
+            else:
+                reactor.callFromThread(deferred.callback, future.result())
+
+        self.submit(text).add_done_callback(on_done)
+
+        return deferred
+
+    def flush(self):
+        """sends the documents collected so far to a worker"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        if self.executor is None:
+            _resolve(batch, exception=RuntimeError('TextAnalyzer was shut down'))
+            return
+
+        def on_done(batch_future: Future):
+            exception = batch_future.exception()
+            _resolve(batch, None if exception is not None else batch_future.result(), exception)
+
+        try:
+            self.executor.submit(analyze_batch, [text for text, _ in batch], self.minhash).add_done_callback(on_done)
+        except RuntimeError as exception:
+            # the executor was shut down meanwhile
+            _resolve(batch, exception=exception)
+
+
+def _resolve(batch: List[Tuple[str, Future]], results: Optional[List[dict]] = None,
+             exception: Optional[BaseException] = None):
+    """sets the result or exception of every future of a batch, but of those cancelled meanwhile, e.g. by the
+    cancellation of the task awaiting analyze_async"""
+    for index, (_, future) in enumerate(batch):
+        if not future.set_running_or_notify_cancel():
+            continue
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(results[index])  # type: ignore
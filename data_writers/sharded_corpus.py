@@ -0,0 +1,203 @@
+"""Corpus stored as size bounded JSONL shards with a sidecar offset index.
+
+Records ({'doc_id', 'text', **metadata}) are grouped into blocks which are compressed independently (one gzip
+member or zstd frame per block), so a shard is still a valid .jsonl.gz/.jsonl.zst file while a single document can
+be read by decompressing only its block. The index, `<name>.index.jsonl`, holds one line per document:
+
+    [doc_id, shard file name, block offset, block length, record offset in block, record length]
+
+A later line for the same doc_id replaces an earlier one, and a line with shard file name null deletes the document.
+
+For uncompressed shards a block is the raw bytes and the reader memory maps the shard instead.
+"""
+from typing import Dict, Iterator, List, Optional, Tuple
+import glob
+import gzip
+import json
+import mmap
+import os
+import threading
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, gzip is always available
+    zstandard = None
+
+SHARD_SUFFIXES: Dict[Optional[str], str] = {None: '.jsonl', 'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+IndexEntry = Tuple[str, int, int, int, int]
+
+
+class ShardedCorpusWriter:
+    """Thread safe. Always starts a new shard, so writing to an existing corpus appends shards and index lines."""
+
+    def __init__(self, corpus_path: str, name: str = 'data', compression: Optional[str] = 'gzip',
+                 max_shard_bytes: int = 256 * 1024 ** 2, block_bytes: int = 1024 ** 2):
+        if compression not in SHARD_SUFFIXES:
+            raise ValueError(f'unknown compression "{compression}", use one of {list(SHARD_SUFFIXES)}')
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('compression="zstd" requires the zstandard package')
+        self.corpus_path = corpus_path
+        self.name = name
+        self.compression = compression
+        self.max_shard_bytes = max_shard_bytes
+        self.block_bytes = block_bytes
+        self._lock = threading.Lock()
+        self._zstd_compressor = zstandard.ZstdCompressor() if compression == 'zstd' else None
+
+        os.makedirs(corpus_path, exist_ok=True)
+        self._index_fp = open(os.path.join(corpus_path, f'{name}.index.jsonl'), 'a')
+        self._shard_number: int = len(shard_paths(corpus_path, name))
+        self._shard_fp = None
+        self._shard_name: str = ''
+        self._block: List[bytes] = []
+        self._block_records: List[Tuple[str, int, int]] = []
+        self._block_size: int = 0
+        self.documents_written: int = 0
+
+    def __enter__(self) -> 'ShardedCorpusWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, doc_id: str, text: str, metadata: Optional[dict] = None):
+        record: dict = {'doc_id': doc_id, 'text': text}
+        if metadata:
+            record.update(metadata)
+        line: bytes = f'{json.dumps(record, ensure_ascii=False)}\n'.encode('utf-8')
+
+        with self._lock:
+            self._block_records.append((doc_id, self._block_size, len(line)))
+            self._block.append(line)
+            self._block_size += len(line)
+            self.documents_written += 1
+            if self._block_size >= self.block_bytes:
+                self._flush_block()
+
+    def delete(self, doc_id: str):
+        with self._lock:
+            # records still in the block would be indexed after the tombstone
+            self._flush_block()
+            self._index_fp.write(f'{json.dumps([doc_id, None, 0, 0, 0, 0])}\n')
+
+    def close(self):
+        with self._lock:
+            self._flush_block()
+            if self._shard_fp is not None:
+                self._close_shard()
+            self._index_fp.close()
+
+    def _flush_block(self):
+        if not self._block:
+            return
+        if self._shard_fp is None:
+            self._open_shard()
+
+        block: bytes = self._compress(b''.join(self._block))
+        block_offset: int = self._shard_fp.tell()
+        self._shard_fp.write(block)
+        # index lines are only written once the data they point to is in the shard
+        for doc_id, record_offset, record_length in self._block_records:
+            self._index_fp.write(f'{json.dumps([doc_id, self._shard_name, block_offset, len(block), record_offset, record_length])}\n')
+
+        self._block, self._block_records, self._block_size = [], [], 0
+        if self._shard_fp.tell() >= self.max_shard_bytes:
+            self._close_shard()
+
+    def _compress(self, block: bytes) -> bytes:
+        if self.compression == 'gzip':
+            return gzip.compress(block)
+        if self.compression == 'zstd':
+            return self._zstd_compressor.compress(block)  # type: ignore
+        return block
+
+    def _open_shard(self):
+        self._shard_name = f'{self.name}-{self._shard_number:05d}{SHARD_SUFFIXES[self.compression]}'
+        self._shard_fp = open(os.path.join(self.corpus_path, self._shard_name), 'xb')
+        self._shard_number += 1
+
+    def _close_shard(self):
+        self._shard_fp.flush()
+        os.fsync(self._shard_fp.fileno())
+        self._shard_fp.close()
+        self._shard_fp = None
+        self._index_fp.flush()
+
+
+class ShardedCorpusReader:
+    """Random access to documents of a corpus written by ShardedCorpusWriter"""
+
+    def __init__(self, corpus_path: str, name: str = 'data'):
+        self.corpus_path = corpus_path
+        self.name = name
+        self.index: Dict[str, IndexEntry] = {}
+        with open(os.path.join(corpus_path, f'{name}.index.jsonl'), 'r') as fp:
+            for line in fp:
+                doc_id, *entry = json.loads(line)
+                if entry[0] is None:
+                    self.index.pop(doc_id, None)
+                else:
+                    self.index[doc_id] = tuple(entry)  # type: ignore
+        self._zstd_decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+        self._mmaps: Dict[str, mmap.mmap] = {}
+
+    def __enter__(self) -> 'ShardedCorpusReader':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def __getitem__(self, doc_id: str) -> dict:
+        shard_name, block_offset, block_length, record_offset, record_length = self.index[doc_id]
+
+        if shard_name.endswith(SHARD_SUFFIXES[None]):
+            shard = self._mmap(shard_name)
+            start: int = block_offset + record_offset
+            record: bytes = shard[start:start + record_length]
+        else:
+            with open(os.path.join(self.corpus_path, shard_name), 'rb') as fp:
+                fp.seek(block_offset)
+                block: bytes = self._decompress(shard_name, fp.read(block_length))
+            record = block[record_offset:record_offset + record_length]
+
+        return json.loads(record)
+
+    def close(self):
+        for shard in self._mmaps.values():
+            shard.close()
+        self._mmaps = {}
+
+    def _mmap(self, shard_name: str) -> mmap.mmap:
+        if shard_name not in self._mmaps:
+            with open(os.path.join(self.corpus_path, shard_name), 'rb') as fp:
+                self._mmaps[shard_name] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self._mmaps[shard_name]
+
+    def _decompress(self, shard_name: str, block: bytes) -> bytes:
+        if shard_name.endswith(SHARD_SUFFIXES['gzip']):
+            return gzip.decompress(block)
+        if self._zstd_decompressor is None:
+            raise ImportError(f'reading {shard_name} requires the zstandard package')
+        return self._zstd_decompressor.decompress(block)
+
+
+def shard_paths(corpus_path: str, name: str = 'data') -> List[str]:
+    return sorted(path for suffix in SHARD_SUFFIXES.values()
+                  for path in glob.glob(os.path.join(corpus_path, f'{name}-[0-9]*{suffix}')))
+
+
+def remove_corpus(corpus_path: str, name: str = 'data'):
+    """removes the shards and the index, e.g. before a corpus is written again from scratch"""
+    for path in shard_paths(corpus_path, name) + [os.path.join(corpus_path, f'{name}.index.jsonl')]:
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,235 @@
+"""Per stage timings and counters of a build or a crawl.
+
+Every stage (a prisma query, a gcloud download, stripping html, writing a file, ...) records the latency of each call
+in a histogram plus the documents, bytes and tokens it handled. RunMetrics writes a snapshot of all stages every
+flush_interval seconds, as `<report_path>.json` and as `<report_path>.prom` in the Prometheus text format (point a
+node_exporter textfile collector at it), and summary() gives the end of run report.
+
+    metrics = RunMetrics('skat', report_path='data/skat.metrics')
+    with metrics:
+        with metrics.timed('download') as observation:
+            data = download()
+            observation.bytes = len(data)
+"""
+from typing import Dict, Iterator, List, Optional
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+# upper bounds in seconds, from a cache hit to a very large pdf
+LATENCY_BUCKETS: List[float] = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                                60.0, 120.0, 300.0]
+
+
+class Histogram:
+    def __init__(self, buckets: List[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)  # the last one counts everything above the largest bucket
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """estimated by interpolating linearly within the bucket the quantile falls into"""
+        if self.count == 0:
+            return None
+        rank: float = q * self.count
+        cumulative: int = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower: float = self.buckets[index - 1] if index > 0 else 0.0
+                upper: float = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - cumulative) / count)
+            cumulative += count
+
+        return self.max
+
+    def cumulative_counts(self) -> Iterator:
+        """(upper bound, observations <= upper bound) pairs as in a prometheus histogram"""
+        cumulative: int = 0
+        for upper, count in zip(self.buckets + [float('inf')], self.counts):
+            cumulative += count
+            yield upper, cumulative
+
+
+class Observation:
+    """what one timed call handled, set by the caller inside RunMetrics.timed"""
+
+    def __init__(self):
+        self.documents: int = 1
+        self.bytes: int = 0
+        self.tokens: int = 0
+
+
+class StageMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self.latency = Histogram()
+        self.documents: int = 0
+        self.bytes: int = 0
+        self.tokens: int = 0
+        self.errors: int = 0
+
+    def snapshot(self, elapsed_seconds: float) -> dict:
+        elapsed_seconds = max(elapsed_seconds, 1e-9)
+        return {'calls': self.latency.count, 'errors': self.errors, 'documents': self.documents, 'bytes': self.bytes,
+                'tokens': self.tokens,
+                'documents_per_second': round(self.documents / elapsed_seconds, 3),
+                'bytes_per_second': round(self.bytes / elapsed_seconds, 3),
+                'tokens_per_second': round(self.tokens / elapsed_seconds, 3),
+                'busy_seconds': round(self.latency.sum, 3),
+                'latency_seconds': {'mean': round(self.latency.sum / self.latency.count, 6) if self.latency.count else None,
+                                    'p50': _rounded(self.latency.quantile(0.5)),
+                                    'p90': _rounded(self.latency.quantile(0.9)),
+                                    'p99': _rounded(self.latency.quantile(0.99)),
+                                    'max': round(self.latency.max, 6)}}
+
+
+class RunMetrics:
+    """Thread safe, so stages running in an executor record into the same instance as the event loop."""
+
+    def __init__(self, run_name: str, report_path: Optional[str] = None, flush_interval: float = 30.0):
+        """report_path: files are written to report_path + '.json' and '.prom'. Without one nothing is written and
+            only summary() reports the metrics."""
+        self.logger = logging.getLogger(__name__)
+        self.run_name = run_name
+        self.report_path = report_path
+        self.flush_interval = flush_interval
+        self.stages: Dict[str, StageMetrics] = {}
+        self.started_at: datetime = datetime.now(timezone.utc)
+        self._started_monotonic: float = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flush_thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> 'RunMetrics':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        """starts flushing periodically"""
+        if self.report_path is None or self._flush_thread is not None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.report_path)), exist_ok=True)
+        self._stop.clear()
+        self._flush_thread = threading.Thread(target=self._flush_periodically, name=f'{self.run_name} metrics', daemon=True)
+        self._flush_thread.start()
+
+    def stop(self):
+        """stops flushing, writes the final snapshot and logs the summary"""
+        if self._flush_thread is not None:
+            self._stop.set()
+            self._flush_thread.join()
+            self._flush_thread = None
+        self.flush()
+        self.logger.info(self.summary())
+
+    def observe(self, stage: str, seconds: float, documents: int = 1, bytes: int = 0, tokens: int = 0, error: bool = False):
+        with self._lock:
+            stage_metrics: StageMetrics = self.stages.get(stage) or self.stages.setdefault(stage, StageMetrics(stage))
+            stage_metrics.latency.observe(seconds)
+            if error:
+                stage_metrics.errors += 1
+            else:
+                stage_metrics.documents += documents
+                stage_metrics.bytes += bytes
+                stage_metrics.tokens += tokens
+
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[Observation]:
+        """records the time the block takes and what it sets on the yielded Observation. A block raising an exception
+        counts as an error of the stage."""
+        observation = Observation()
+        started_at: float = time.monotonic()
+        try:
+            yield observation
+        except BaseException:
+            self.observe(stage, time.monotonic() - started_at, error=True)
+            raise
+        self.observe(stage, time.monotonic() - started_at, observation.documents, observation.bytes, observation.tokens)
+
+    def elapsed_seconds(self) -> float:
+        return time.monotonic() - self._started_monotonic
+
+    def snapshot(self) -> dict:
+        elapsed_seconds: float = self.elapsed_seconds()
+        with self._lock:
+            stages: dict = {name: stage.snapshot(elapsed_seconds) for name, stage in self.stages.items()}
+
+        return {'run': self.run_name, 'started_at': self.started_at.isoformat(),
+                'elapsed_seconds': round(elapsed_seconds, 3), 'stages': stages}
+
+    def to_prometheus(self) -> str:
+        labels: str = f'run="{_escape_label(self.run_name)}"'
+        lines: List[str] = ['# TYPE odagw_stage_latency_seconds histogram']
+        with self._lock:
+            stages: List[StageMetrics] = list(self.stages.values())
+            for stage in stages:
+                stage_labels: str = f'{labels},stage="{_escape_label(stage.name)}"'
+                for upper, cumulative in stage.latency.cumulative_counts():
+                    le: str = '+Inf' if upper == float('inf') else repr(upper)
+                    lines.append(f'odagw_stage_latency_seconds_bucket{{{stage_labels},le="{le}"}} {cumulative}')
+                lines.append(f'odagw_stage_latency_seconds_sum{{{stage_labels}}} {stage.latency.sum}')
+                lines.append(f'odagw_stage_latency_seconds_count{{{stage_labels}}} {stage.latency.count}')
+            for counter in ('documents', 'bytes', 'tokens', 'errors'):
+                lines.append(f'# TYPE odagw_stage_{counter}_total counter')
+                lines.extend(f'odagw_stage_{counter}_total{{{labels},stage="{_escape_label(stage.name)}"}} {getattr(stage, counter)}'
+                             for stage in stages)
+        lines.append('# TYPE odagw_run_elapsed_seconds gauge')
+        lines.append(f'odagw_run_elapsed_seconds{{{labels}}} {self.elapsed_seconds()}')
+
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        if self.report_path is None:
+            return
+        _write_atomically(f'{self.report_path}.json', json.dumps(self.snapshot(), indent=2))
+        _write_atomically(f'{self.report_path}.prom', self.to_prometheus())
+
+    def summary(self) -> str:
+        snapshot: dict = self.snapshot()
+        lines: List[str] = [f'{self.run_name}: finished in {snapshot["elapsed_seconds"]}s']
+        for name, stage in snapshot['stages'].items():
+            latency: dict = stage['latency_seconds']
+            lines.append(f'  {name}: {stage["calls"]} calls, {stage["errors"]} errors, {stage["documents"]} docs '
+                         f'({stage["documents_per_second"]}/s), {stage["bytes"]} bytes, {stage["tokens"]} tokens '
+                         f'({stage["tokens_per_second"]}/s), latency p50 {latency["p50"]}s p90 {latency["p90"]}s '
+                         f'p99 {latency["p99"]}s max {latency["max"]}s')
+
+        return '\n'.join(lines)
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                self.logger.warning(f'could not write metrics to {self.report_path}: {e}')
+
+
+def _rounded(value: Optional[float]) -> Optional[float]:
+    return round(value, 6) if value is not None else None
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomically(path: str, content: str):
+    """readers such as a prometheus textfile collector never see a half written file"""
+    with open(f'{path}.tmp', 'w') as fp:
+        fp.write(content)
+    os.replace(f'{path}.tmp', path)
@@ -0,0 +1,41 @@
+"""python -m unittest discover tests"""
+from typing import List
+import asyncio
+import os
+import sys
+import unittest
+this_file_path = os.path.dirname(os.path.abspath(__file__))  # get directory of this file
+sys.path.append(this_file_path + '/..')
+from data_processors import sentence_segmentation
+
+
+class TextAnalyzerTest(unittest.TestCase):
+    TEXTS: List[str] = [f'Dokument nr. {number}. Det har to sætninger.' for number in range(4)]
+
+    def test_cancelled_waiter_does_not_keep_the_rest_of_its_batch_waiting(self):
+        async def analyze_and_cancel_one(analyzer: sentence_segmentation.TextAnalyzer) -> List[dict]:
+            tasks: List[asyncio.Task] = [asyncio.create_task(analyzer.analyze_async(text)) for text in self.TEXTS]
+            # the tasks submit their texts, which fills the batch and sends it to a worker
+            await asyncio.sleep(0)
+            tasks[0].cancel()
+
+            return await asyncio.wait_for(asyncio.gather(*tasks[1:]), timeout=30)
+
+        with sentence_segmentation.TextAnalyzer(processes=1, batch_size=len(self.TEXTS), max_delay=60) as analyzer:
+            metadatas: List[dict] = asyncio.run(analyze_and_cancel_one(analyzer))
+
+        self.assertEqual(metadatas, [sentence_segmentation.analyze(text) for text in self.TEXTS[1:]])
+
+    def test_texts_queued_after_shutdown_fail(self):
+        analyzer = sentence_segmentation.TextAnalyzer(processes=1, batch_size=len(self.TEXTS), max_delay=60)
+        future = analyzer.submit(self.TEXTS[0])
+        analyzer.executor.shutdown()
+        analyzer.executor = None
+        analyzer.flush()
+
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""python -m unittest discover tests"""
+from typing import Optional
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+this_file_path = os.path.dirname(os.path.abspath(__file__))  # get directory of this file
+sys.path.append(this_file_path + '/..')
+from builders import work_manifest
+
+
+class WorkManifestLeaseTest(unittest.TestCase):
+    LEASE_SECONDS = 0.5
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.manifest_path: str = os.path.join(self.directory.name, 'test.work.sqlite')
+        with work_manifest.WorkManifest(self.manifest_path) as manifest:
+            manifest.plan([work_manifest.WorkRange(0, None, 'ck0000000009', 0, 10)], {'base_save_name': 'test'})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_heartbeat_from_executor_keeps_a_range_that_outlives_its_lease(self):
+        """as partitioned_build.renew_lease does while the range is built"""
+        async def build_range(manifest: work_manifest.WorkManifest, other_worker: work_manifest.WorkManifest) -> list:
+            loop = asyncio.get_running_loop()
+            claims_of_other_worker: list = []
+            started_at: float = time.monotonic()
+            while time.monotonic() - started_at < 3 * self.LEASE_SECONDS:
+                await asyncio.sleep(self.LEASE_SECONDS / 5)
+                self.assertTrue(await loop.run_in_executor(None, manifest.heartbeat, 0, 'worker-a'))
+                claims_of_other_worker.append(other_worker.claim('worker-b', self.LEASE_SECONDS))
+
+            return claims_of_other_worker
+
+        with work_manifest.WorkManifest(self.manifest_path) as manifest, \
+                work_manifest.WorkManifest(self.manifest_path) as other_worker:
+            self.assertIsNotNone(manifest.claim('worker-a', self.LEASE_SECONDS))
+            self.assertEqual(asyncio.run(build_range(manifest, other_worker)), [None] * 15)
+            manifest.done(0, 'worker-a', built=10, failed=0)
+            self.assertEqual(other_worker.progress(), {'pending': 0, 'claimed': 0, 'done': 1, 'built': 10, 'failed': 0})
+
+    def test_range_is_reclaimed_once_its_lease_expired(self):
+        with work_manifest.WorkManifest(self.manifest_path) as manifest, \
+                work_manifest.WorkManifest(self.manifest_path) as other_worker:
+            self.assertIsNotNone(manifest.claim('worker-a', self.LEASE_SECONDS))
+            self.assertIsNone(other_worker.claim('worker-b', self.LEASE_SECONDS))
+            time.sleep(1.5 * self.LEASE_SECONDS)
+
+            reclaimed: Optional[work_manifest.WorkRange] = other_worker.claim('worker-b', self.LEASE_SECONDS)
+            self.assertEqual(reclaimed, work_manifest.WorkRange(0, None, 'ck0000000009', 0, 10))
+            self.assertFalse(manifest.heartbeat(0, 'worker-a'))
+
+
+if __name__ == '__main__':
+    unittest.main()